@@ -10,9 +10,19 @@
 # ================================================== #
 
 
-from app.api.processor import Processor
+from app.api import bulk
+from app.api.cache import ResponseCache
+from app.api import leaderboard
+from app.api.leaderboard import Leaderboard
+from app.api.processor import BatchProcessor, Processor
+from app.api import reputes
+from app.storage.record import check_strings, check_value
 from app.storage.storage import Data
+from app.storage.write_queue import WriteQueue
 import falcon
+from falcon import uri
+import os
+import threading
 
 # If ujson is availalbe use it (it has better
 # performance than Python's standard json library,
@@ -26,6 +36,84 @@ except ImportError:
     import json
 
 
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of reputes committed to the database at once by a bulk POST
+BATCH_SIZE = 500
+
+# Number of a reputer's reputees returned by default and at most
+REPUTER_DEFAULT_LIMIT = 100
+REPUTER_MAX_LIMIT = 1000
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to format a reputee's processed data for output
+def format_scores(reputee, processed_data):
+    return {"reputee": reputee, "clout": {
+        "score": processed_data[0][0],
+        "confidence": processed_data[0][1]}, "reach": {
+        "score": processed_data[1][0],
+        "confidence": processed_data[1][1]}, "clarity": {
+        "score": processed_data[2][0],
+        "confidence": processed_data[2][1]}}
+
+# ================================================== #
+
+
+# Define function to build the ETag of a reputee's scores from its version.
+# Versions only ever increase, so the scores cannot change without the
+# ETag changing too.
+def make_etag(version):
+    return '"' + str(version) + '"'
+
+# ================================================== #
+
+
+# Define function to check if an If-None-Match header lists an ETag.
+# Weak tags are compared by their value, as If-None-Match requires.
+def etag_matches(header, etag):
+    if not header:
+        return False
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag[:2] == 'W/':
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+# ================================================== #
+
+
+# Define function to pull the repute fields out of a posted json object.
+# Raises TypeError if the reputer, reputee or feature is not a string,
+# the rid is not a string or integer, or the value is not a number, and
+# ValueError if the value is an integer too large to store or the rid,
+# reputer or feature is too long.
+def parse_repute(json_object):
+    reputer = json_object['reputer']
+    reputee = json_object['reputee']
+    rid = json_object['repute']['rid']
+    feature = json_object['repute']['feature']
+    value = json_object['repute']['value']
+    if not all(type(field) is str for field in (reputer, reputee, feature)) or type(rid) not in (str, int):
+        raise TypeError("The reputer, reputee, rid and feature of a repute must be strings.")
+    rid = str(rid)
+    check_strings(rid, reputer, feature)
+    check_value(value)
+
+    return reputer, reputee, rid, feature, value
+
+
 # ================================================== #
 #                  CLASS DEFINITIONS                 #
 # ================================================== #
@@ -34,9 +122,81 @@ except ImportError:
 # Define reputation API object
 class ReputationAPI(object):
 
-    # Define init function
-    def __init__(self, mode="Production"):
+    # Define init function. A write_batch_size above 0 makes single POSTs
+    # go through a write queue that commits up to that many reputes at once,
+    # waiting at most write_batch_wait seconds to fill a batch.
+    def __init__(self, mode="Production", engine="shelve", cache_size=1024, leaderboard_refresh=60,
+                 engine_options=None, write_batch_size=0, write_batch_wait=0.002):
         self.mode = mode
+        self.engine = engine
+        self.engine_options = engine_options
+        self.write_batch_size = write_batch_size
+        self.write_batch_wait = write_batch_wait
+        # Create a cache of serialized GET responses (a size of 0 disables it)
+        self.cache = ResponseCache(cache_size)
+        # Create a ranking of reputees that is rebuilt every leaderboard_refresh seconds
+        self.leaderboard = Leaderboard(leaderboard_refresh)
+        # Create variables to hold the database handle, its write queue and the process that opened them
+        self.data = None
+        self.writer = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # ============================================= #
+
+    # Define function to get the process's database handle
+    def get_data(self):
+        # The handle is opened on first use rather than in __init__ so that
+        # gunicorn workers forked from a preloaded app each open their own
+        if self.data is None or self.pid != os.getpid():
+            with self.lock:
+                if self.data is None or self.pid != os.getpid():
+                    data = Data(self.mode, self.engine, self.engine_options)
+                    data.open()
+                    self.data = data
+                    self.pid = os.getpid()
+
+        return self.data
+
+    # ============================================= #
+
+    # Define function to map (building it if needed) the leaderboard before
+    # gunicorn forks its workers, then close the database handle so each
+    # worker opens its own. The workers share the mapped pages read-only.
+    def preload(self):
+        try:
+            self.leaderboard.refresh(self.get_data())
+        finally:
+            self.close()
+
+    # ============================================= #
+
+    # Define function to get the write queue of the process's database handle
+    def get_writer(self):
+        # The writer thread does not survive a fork, so each process starts its own
+        data = self.get_data()
+        if self.writer is None or self.writer.data is not data:
+            with self.lock:
+                if self.writer is None or self.writer.data is not data:
+                    self.writer = WriteQueue(data, self.write_batch_size, self.write_batch_wait,
+                                             self._commit_queued)
+
+        return self.writer
+
+    # ============================================= #
+
+    # Define function to close the write queue and database handle
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                # Commit anything still queued before closing the database
+                if self.writer is not None and self.writer.data is self.data:
+                    self.writer.close()
+                if self.data is not None:
+                    self.data.close()
+            self.data = None
+            self.writer = None
+            self.pid = None
 
     # ============================================= #
 
@@ -44,24 +204,28 @@ class ReputationAPI(object):
     def on_get(self, req, resp, reputee=None):
         # Check for query parameter
         if reputee is None:
-            # If no query parameter is found, output 400 error
-            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid query is required.')
+            return self.on_get_batch(req, resp, self.get_query_reputees(req))
 
-        # Set a boolean to check for reputee in database
-        reputee_found = False
-        # Open database
-        data = Data(self.mode)
-        data.open()
+        data = self.get_data()
+        version = data.get_version(reputee)
+        etag = make_etag(version)
 
-        # Look through database to see if any reputees match query
-        for key in data.db:
-            if data.db[key]['reputee'] == reputee:
-                # If a matching reputee is found, record that reputee is found and exit loop
-                reputee_found = True
-                break
+        # Tell the client its copy is current if the reputee has not changed since it was fetched
+        if version and etag_matches(req.get_header('If-None-Match'), etag):
+            resp.status = falcon.HTTP_304
+            resp.set_header('ETag', etag)
+            return
 
-        # Close database
-        data.close()
+        # Return the cached response if the reputee has not changed since it was built
+        body = self.cache.get(reputee, version)
+        if body is not None:
+            resp.status = falcon.HTTP_200
+            resp.set_header('ETag', etag)
+            resp.body = body
+            return
+
+        # Look up query in the reputee index
+        reputee_found = data.has_reputee(reputee)
 
         # Check if any reputees matching query were found
         if not reputee_found:
@@ -69,18 +233,56 @@ class ReputationAPI(object):
             raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Reputee could not be found.')
 
         # Process query request
-        processor = Processor(reputee, self.mode)
+        processor = Processor(reputee, data)
         processed_data = processor.get_all()
 
+        # Return processed data and cache it under the version read before processing
+        resp.status = falcon.HTTP_200
+        resp.set_header('ETag', etag)
+        resp.body = json.dumps(format_scores(reputee, processed_data))
+        self.cache.put(reputee, version, resp.body)
+
+    # ============================================= #
+
+    # Define function to get the reputees of a batch GET from the query string
+    def get_query_reputees(self, req):
+        # Commas are not treated as separators since they may appear in reputees
+        reputees = uri.parse_query_string(req.query_string, False, False).get('reputee')
+        if not reputees:
+            # If no query parameter is found, output 400 error
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid query is required.')
+
+        return reputees if isinstance(reputees, list) else [reputees]
+
+    # ============================================= #
+
+    # Define handler for GET request of many reputees
+    def on_get_batch(self, req, resp, reputees):
         # Return processed data
         resp.status = falcon.HTTP_200
-        resp.body = json.dumps({"reputee": reputee, "clout": {
-            "score": processed_data[0][0],
-            "confidence": processed_data[0][1]}, "reach": {
-            "score": processed_data[1][0],
-            "confidence": processed_data[1][1]}, "clarity": {
-            "score": processed_data[2][0],
-            "confidence": processed_data[2][1]}})
+        resp.body = json.dumps(self.score_batch(self.get_data(), reputees))
+
+    # ============================================= #
+
+    # Define function to score many reputees. Every reputee gets the result
+    # a single GET would have returned, or the error it would have raised.
+    def score_batch(self, data, reputees):
+        # Process query request for every reputee at once
+        processor = BatchProcessor(reputees, data)
+        processed_data = processor.get_all()
+
+        results = []
+        for reputee in reputees:
+            if reputee not in processed_data:
+                results.append({"reputee": reputee, "status": 400, "title": "Error",
+                                "description": "Reputee could not be found."})
+            elif processed_data[reputee] is None:
+                results.append({"reputee": reputee, "status": 500, "title": "Error",
+                                "description": "Reputee does not have enough reputes to be scored."})
+            else:
+                results.append(format_scores(reputee, processed_data[reputee]))
+
+        return {"results": results}
 
     # ============================================= #
 
@@ -93,17 +295,67 @@ class ReputationAPI(object):
         # posted json has the correct fields.
 
         # Check that posted json is readable
+        items = None
         try:
-            raw_json = req.stream.read()
+            raw_json = req.stream.read(bulk.CHUNK_SIZE)
 
             # Check that posted json has content
             if not raw_json:
                 # If no content is present, output 400 error
                 raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid JSON document is required.')
+
+            # Parse NDJSON bodies and JSON arrays item by item, or read the rest of a single JSON document
+            if bulk.is_ndjson(req.content_type):
+                items = bulk.iter_ndjson(req.stream, raw_json)
+            elif raw_json.lstrip()[:1] == b'[':
+                items = bulk.iter_json_array(req.stream, raw_json)
+            else:
+                raw_json += req.stream.read()
+        except falcon.HTTPError:
+            raise
         except Exception:
                 # If json is unreadable output 400 error
                 raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid JSON document is required.')
 
+        # Hand bulk bodies to the bulk handler. This is done outside the check
+        # above, so a storage error after some batches have been committed is
+        # not reported as an unreadable body.
+        if items is not None:
+            return self.on_post_bulk(req, resp, items)
+
+        reputer, reputee, rid, feature, value = self.decode_repute(raw_json)
+
+        # Add data to database if posted data is not a duplicate
+        created = self.store_repute(self.get_data(), (reputer, reputee, rid, feature, value))
+        resp.status, body = self.post_result(rid, created)
+        resp.body = json.dumps(body)
+
+    # ============================================= #
+
+    # Define function to store a repute and rescore its reputee if it is new
+    def store_repute(self, data, repute):
+        # Wait for the write queue to commit the repute's batch, which rescores it
+        if self.write_batch_size > 0:
+            return self.get_writer().add(repute)
+
+        created = data.add(*repute)
+        if created:
+            self.leaderboard.update(data, [repute[1]])
+
+        return created
+
+    # ============================================= #
+
+    # Define function to rescore the reputees of a batch committed by the write queue
+    def _commit_queued(self, data, reputes, created):
+        reputees = [repute[1] for repute, new in zip(reputes, created) if new]
+        if reputees:
+            self.leaderboard.update(data, reputees)
+
+    # ============================================= #
+
+    # Define function to decode and validate a single posted repute
+    def decode_repute(self, raw_json):
         # Check if posted json is encoded correctly
         try:
             json_object = json.loads(raw_json)
@@ -116,39 +368,287 @@ class ReputationAPI(object):
 
         # Check if posted json is formatted correctly
         try:
-            reputer = json_object['reputer']
-            reputee = json_object['reputee']
-            rid = str(json_object['repute']['rid'])
-            feature = json_object['repute']['feature']
-            value = json_object['repute']['value']
-        except KeyError:
+            return parse_repute(json_object)
+        except (KeyError, TypeError, ValueError):
             # If json is formatted incorrectly, output 400 error
             raise falcon.HTTPError(falcon.HTTP_400, 'Malformed JSON',
                                    'Could not decode the request body. The '
                                    'JSON was formatted incorrectly.')
 
-        # Open database
-        data = Data(self.mode)
-        data.open()
-
-        # Check if posted data is a duplicate
-        if (rid+"-"+reputer+"-"+reputee) not in data.db:
-            # If posted data is not a duplicate, add data to database
-            data.db[rid+"-"+reputer+"-"+reputee] = {"reputer": reputer,
-                            "reputee": reputee,
-                            "repute": {"rid": rid, "feature": feature, "value": value}}
-            # Close database
-            data.close()
+    # ============================================= #
+
+    # Define function to get the status and body of a single POST
+    def post_result(self, rid, created):
+        if created:
             # Return a 201 status
-            resp.status = falcon.HTTP_201
-            resp.body = json.dumps({'message': 'rid-' + rid + ' successfully created.'})
+            return falcon.HTTP_201, {'message': 'rid-' + rid + ' successfully created.'}
+
+        # Return a 200 status
+        return falcon.HTTP_200, {'message': 'rid-' + rid + ' already exists.'}
+
+    # ============================================= #
+
+    # Define handler for bulk POST request
+    def on_post_bulk(self, req, resp, items):
+        # Return the results of every item
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(self.post_bulk(self.get_data(), items))
+
+    # ============================================= #
+
+    # Define function to store the items of a bulk POST. Each item is
+    # validated and reported the same way as a single POST, and valid
+    # items are committed to the database in batches.
+    def post_bulk(self, data, items):
+        results = []
+        batch = []
+        pending = []
+        counts = {"created": 0, "duplicate": 0, "invalid": 0}
+
+        for decoded, json_object in items:
+            # Check if the item was encoded correctly
+            if not decoded:
+                counts["invalid"] += 1
+                results.append({"status": 422, "title": "Malformed JSON",
+                                "description": "Could not decode the item. The JSON was incorrect or not "
+                                               "encoded as UTF-8."})
+                continue
+
+            # Check if the item is formatted correctly
+            try:
+                repute = parse_repute(json_object)
+            except (KeyError, TypeError, ValueError):
+                counts["invalid"] += 1
+                results.append({"status": 400, "title": "Malformed JSON",
+                                "description": "Could not decode the item. The JSON was formatted incorrectly."})
+                continue
+
+            # Queue the item for the next batch
+            result = {"rid": repute[2]}
+            results.append(result)
+            batch.append(repute)
+            pending.append(result)
+
+            if len(batch) >= BATCH_SIZE:
+                self._commit_batch(data, batch, pending, counts)
+                batch = []
+                pending = []
+
+        # Commit the last batch
+        if batch:
+            self._commit_batch(data, batch, pending, counts)
+
+        return {"created": counts["created"], "duplicate": counts["duplicate"],
+                "invalid": counts["invalid"], "results": results}
+
+    # ============================================= #
+
+    # Define function to commit a batch of reputes and record their results
+    def _commit_batch(self, data, batch, pending, counts):
+        created_reputees = []
+        for result, repute, created in zip(pending, batch, data.add_many(batch)):
+            if created:
+                created_reputees.append(repute[1])
+                counts["created"] += 1
+                result["status"] = 201
+                result["message"] = 'rid-' + result["rid"] + ' successfully created.'
+            else:
+                counts["duplicate"] += 1
+                result["status"] = 200
+                result["message"] = 'rid-' + result["rid"] + ' already exists.'
+
+        # Rescore the reputees with new reputes
+        if created_reputees:
+            self.leaderboard.update(data, created_reputees)
+
+
+
+# ================================================== #
+
+
+# Define cache statistics API object
+class CacheAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api):
+        self.reputation_api = reputation_api
+
+    # ============================================= #
+
+    # Define handler for GET request
+    def on_get(self, req, resp):
+        # Return the response cache's counters
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(self.reputation_api.cache.stats())
+
+
+
+# ================================================== #
+
+
+# Define leaderboard API object
+class LeaderboardAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api):
+        self.reputation_api = reputation_api
+
+    # ============================================= #
+
+    # Define function to read and check the leaderboard's query parameters
+    def parse_query(self, req):
+        params = uri.parse_query_string(req.query_string, False, False)
+        query = {"by": params.get('by', 'clout'), "cursor": params.get('cursor')}
+
+        # Check that a single cursor was given
+        if isinstance(query["cursor"], list):
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The cursor is not valid.')
+
+        # Check that the scores to rank by exist
+        if query["by"] not in leaderboard.METRICS:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Leaderboards can be ranked by clout, reach, '
+                                                             'or clarity.')
+
+        # Check that the page size and minimum confidence are numbers in range
+        try:
+            query["limit"] = int(params.get('limit', leaderboard.DEFAULT_LIMIT))
+            query["min_confidence"] = float(params.get('min_confidence', 0))
+        except (TypeError, ValueError):
+            query["limit"] = None
+        if query["limit"] is None or not 1 <= query["limit"] <= leaderboard.MAX_LIMIT \
+                or not 0 <= query["min_confidence"] <= 1:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The limit must be between 1 and ' +
+                                   str(leaderboard.MAX_LIMIT) + ' and the minimum confidence between 0 and 1.')
+
+        return query
+
+    # ============================================= #
+
+    # Define function to get a page of the leaderboard
+    def get_page(self, data, query):
+        results, next_cursor = self.reputation_api.leaderboard.page(data, query["by"], query["limit"],
+                                                                    query["min_confidence"], query["cursor"])
+        return {"by": query["by"], "results": [format_scores(reputee, scores) for reputee, scores in results],
+                "next_cursor": next_cursor}
+
+    # ============================================= #
+
+    # Define handler for GET request
+    def on_get(self, req, resp):
+        query = self.parse_query(req)
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(self.get_page(self.reputation_api.get_data(), query))
+
+
+
+# ================================================== #
+
+
+# Define raw reputes API object
+class ReputesAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api):
+        self.reputation_api = reputation_api
+
+    # ============================================= #
+
+    # Define function to read and check the query parameters of a page of reputes
+    def parse_query(self, req):
+        params = uri.parse_query_string(req.query_string, False, False)
+        query = {"feature": params.get('feature'), "reputer": params.get('reputer')}
+
+        # Check that a single cursor was given
+        if isinstance(params.get('cursor'), list):
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The cursor is not valid.')
+        query["start"] = reputes.decode_cursor(params['cursor']) if params.get('cursor') else 0
+
+        # Check that the page size is a number in range
+        try:
+            query["limit"] = int(params.get('limit', reputes.DEFAULT_LIMIT))
+        except (TypeError, ValueError):
+            query["limit"] = None
+        if query["limit"] is None or not 1 <= query["limit"] <= reputes.MAX_LIMIT:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The limit must be between 1 and ' +
+                                   str(reputes.MAX_LIMIT) + '.')
+
+        # Check that each filter was only given once
+        if isinstance(query["feature"], list) or isinstance(query["reputer"], list):
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Only one feature and reputer may be given.')
+
+        return query
+
+    # ============================================= #
+
+    # Define handler for GET request
+    def on_get(self, req, resp, reputee):
+        query = self.parse_query(req)
+        data = self.reputation_api.get_data()
+
+        # Check that the reputee exists before streaming anything
+        if not data.has_reputee(reputee):
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Reputee could not be found.')
+
+        # Stream the page as it is read
+        resp.status = falcon.HTTP_200
+        resp.content_type = reputes.CONTENT_TYPE
+        resp.stream = reputes.iter_page(data, reputee, query)
+
+
+
+# ================================================== #
+
+
+# Define reputer API object
+class ReputerAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api):
+        self.reputation_api = reputation_api
+
+    # ============================================= #
+
+    # Define function to read and check the number of reputees to return
+    def parse_limit(self, req):
+        params = uri.parse_query_string(req.query_string, False, False)
+        try:
+            limit = int(params.get('limit', REPUTER_DEFAULT_LIMIT))
+        except (TypeError, ValueError):
+            limit = None
+        if limit is None or not 1 <= limit <= REPUTER_MAX_LIMIT:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The limit must be between 1 and ' +
+                                   str(REPUTER_MAX_LIMIT) + '.')
+
+        return limit
+
+    # ============================================= #
+
+    # Define function to summarize what a reputer has posted. Reputees are
+    # listed from most to fewest reputes, with the count of each feature.
+    def get_summary(self, data, reputer, limit):
+        breakdown = data.get_reputer_breakdown(reputer)
+        if not breakdown:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Reputer could not be found.')
+
+        features = {}
+        reputees = []
+        for reputee, counts in breakdown.items():
+            for feature, count in counts.items():
+                features[feature] = features.get(feature, 0) + count
+            reputees.append({"reputee": reputee, "count": sum(counts.values()), "features": counts})
+        reputees.sort(key=lambda item: (-item["count"], item["reputee"]))
+
+        return {"reputer": reputer, "count": sum(features.values()), "features": features,
+                "reputee_count": len(reputees), "reputees": reputees[:limit]}
+
+    # ============================================= #
+
+    # Define handler for GET request
+    def on_get(self, req, resp, reputer):
+        limit = self.parse_limit(req)
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(self.get_summary(self.reputation_api.get_data(), reputer, limit))
 
-        else:
-            # Close database
-            data.close()
-            # Return a 200 status
-            resp.status = falcon.HTTP_200
-            resp.body = json.dumps({'message': 'rid-' + rid + ' already exists.'})
 
 
 # ================================================== #
@@ -0,0 +1,317 @@
+# ================================================== #
+#                     ASYNC API                      #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api import bulk
+from app.api import reputes
+from app.api.api import (LeaderboardAPI, ReputationAPI, ReputerAPI, ReputesAPI, etag_matches, format_scores,
+                         make_etag)
+from app.api.metrics import CONTENT_TYPE, MetricsAPI
+from app.api.processor import Processor
+from app.storage.async_storage import AsyncData
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import falcon
+import itertools
+import os
+
+# falcon.asgi was added in Falcon 3.0. Without it the
+# API can still be served over WSGI with run.py.
+try:
+    from falcon import asgi
+except ImportError:
+    asgi = None
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of lines of a streamed response produced on the thread pool at a time
+STREAM_LINES = 100
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to create an ASGI app that behaves like the WSGI one
+def create_asgi_app(middleware=None):
+    if asgi is None:
+        raise RuntimeError("Serving the API over ASGI requires Falcon 3.0 or later.")
+
+    app = asgi.App(middleware=middleware)
+    # Match Falcon 1.x, which ignored trailing slashes and wrote compact error bodies.
+    # Routes must then be added without a trailing slash.
+    app.req_options.strip_url_path_trailing_slash = True
+    app.resp_options.media_handlers[falcon.MEDIA_JSON] = falcon.media.JSONHandler(dumps=json.dumps,
+                                                                                  loads=json.loads)
+    return app
+
+# ================================================== #
+
+
+# Define function to run a blocking iterator of lines on the thread pool,
+# a batch of lines at a time, so its output can be streamed over ASGI
+async def iter_in_executor(data, lines):
+    while True:
+        batch = await data.run(list, itertools.islice(lines, STREAM_LINES))
+        if not batch:
+            return
+        yield b''.join(batch)
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define stream object that lets a blocking parser on the
+# thread pool read an ASGI request body from the event loop
+class _BlockingStream(object):
+
+    # Define init function
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+
+    # ============================================= #
+
+    # Define function to read from the body
+    def read(self, size=None):
+        return asyncio.run_coroutine_threadsafe(self.stream.read(size), self.loop).result()
+
+# ================================================== #
+
+
+# Define asyncio reputation API object. Requests are handled
+# the same way as ReputationAPI, but every storage call is
+# awaited on a thread pool so one process can hold many
+# connections open at once.
+class AsyncReputationAPI(ReputationAPI):
+
+    # Define init function
+    def __init__(self, mode="Production", engine="shelve", cache_size=1024, leaderboard_refresh=60,
+                 engine_options=None, workers=None, write_batch_size=0, write_batch_wait=0.002):
+        super(AsyncReputationAPI, self).__init__(mode, engine, cache_size, leaderboard_refresh, engine_options,
+                                                 write_batch_size, write_batch_wait)
+        # Create variables to hold the thread pool size and the process's pool and async handle
+        self.workers = workers
+        self.executor = None
+        self.async_data = None
+
+    # ============================================= #
+
+    # Define function to get the process's async database handle
+    async def get_async_data(self):
+        # Thread pools do not survive a fork, so each process creates its own
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ThreadPoolExecutor(self.workers)
+            self.async_data = None
+
+        # Open the database on the thread pool
+        if self.async_data is None or self.async_data.data is not self.data:
+            data = await asyncio.get_event_loop().run_in_executor(self.executor, self.get_data)
+            self.async_data = AsyncData(data, self.executor)
+
+        return self.async_data
+
+    # ============================================= #
+
+    # Define function to close the database handle and thread pool
+    def close(self):
+        super(AsyncReputationAPI, self).close()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = None
+        self.async_data = None
+
+    # ============================================= #
+
+    # Define handler for GET request
+    async def on_get(self, req, resp, reputee=None):
+        # Check for query parameter
+        if reputee is None:
+            return await self.on_get_batch(req, resp, self.get_query_reputees(req))
+
+        data = await self.get_async_data()
+        version = await data.get_version(reputee)
+        etag = make_etag(version)
+
+        # Tell the client its copy is current if the reputee has not changed since it was fetched
+        if version and etag_matches(req.get_header('If-None-Match'), etag):
+            resp.status = falcon.HTTP_304
+            resp.set_header('ETag', etag)
+            return
+
+        # Return the cached response if the reputee has not changed since it was built
+        body = self.cache.get(reputee, version)
+        if body is None:
+            # Check if any reputees matching query were found
+            if not await data.has_reputee(reputee):
+                raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Reputee could not be found.')
+
+            # Process query request and cache it under the version read before processing
+            processed_data = await data.run(Processor(reputee, data.data).get_all)
+            body = json.dumps(format_scores(reputee, processed_data))
+            self.cache.put(reputee, version, body)
+
+        resp.status = falcon.HTTP_200
+        resp.set_header('ETag', etag)
+        resp.text = body
+
+    # ============================================= #
+
+    # Define handler for GET request of many reputees
+    async def on_get_batch(self, req, resp, reputees):
+        data = await self.get_async_data()
+        resp.status = falcon.HTTP_200
+        resp.text = json.dumps(await data.run(self.score_batch, data.data, reputees))
+
+    # ============================================= #
+
+    # Define handler for POST request
+    async def on_post(self, req, resp):
+        # Check that posted json is readable
+        items = None
+        try:
+            raw_json = await req.stream.read(bulk.CHUNK_SIZE)
+
+            # Check that posted json has content
+            if not raw_json:
+                raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid JSON document is required.')
+
+            # NDJSON bodies and JSON arrays are parsed on the thread pool as the
+            # rest of the body arrives, while a single JSON document is read whole
+            stream = _BlockingStream(req.stream, asyncio.get_event_loop())
+            if bulk.is_ndjson(req.content_type):
+                items = bulk.iter_ndjson(stream, raw_json)
+            elif raw_json.lstrip()[:1] == b'[':
+                items = bulk.iter_json_array(stream, raw_json)
+            else:
+                raw_json += await req.stream.read()
+        except falcon.HTTPError:
+            raise
+        except Exception:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'A valid JSON document is required.')
+
+        # Hand bulk bodies to the bulk handler outside the check above
+        if items is not None:
+            return await self.on_post_bulk(req, resp, items)
+
+        reputer, reputee, rid, feature, value = self.decode_repute(raw_json)
+
+        # Add data to database if posted data is not a duplicate. With a write
+        # queue the commit of the repute's batch is awaited without using a thread.
+        data = await self.get_async_data()
+        repute = (reputer, reputee, rid, feature, value)
+        if self.write_batch_size > 0:
+            created = await asyncio.wrap_future(self.get_writer().submit(repute))
+        else:
+            created = await data.run(self.store_repute, data.data, repute)
+        resp.status, body = self.post_result(rid, created)
+        resp.text = json.dumps(body)
+
+    # ============================================= #
+
+    # Define handler for bulk POST request
+    async def on_post_bulk(self, req, resp, items):
+        data = await self.get_async_data()
+        resp.status = falcon.HTTP_200
+        resp.text = json.dumps(await data.run(self.post_bulk, data.data, items))
+
+# ================================================== #
+
+
+# Define asyncio cache statistics API object
+class AsyncCacheAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api):
+        self.reputation_api = reputation_api
+
+    # ============================================= #
+
+    # Define handler for GET request
+    async def on_get(self, req, resp):
+        # Return the response cache's counters
+        resp.status = falcon.HTTP_200
+        resp.text = json.dumps(self.reputation_api.cache.stats())
+
+# ================================================== #
+
+
+# Define asyncio leaderboard API object
+class AsyncLeaderboardAPI(LeaderboardAPI):
+
+    # Define handler for GET request
+    async def on_get(self, req, resp):
+        query = self.parse_query(req)
+        data = await self.reputation_api.get_async_data()
+        resp.status = falcon.HTTP_200
+        resp.text = json.dumps(await data.run(self.get_page, data.data, query))
+
+# ================================================== #
+
+
+# Define asyncio raw reputes API object
+class AsyncReputesAPI(ReputesAPI):
+
+    # Define handler for GET request
+    async def on_get(self, req, resp, reputee):
+        query = self.parse_query(req)
+        data = await self.reputation_api.get_async_data()
+
+        # Check that the reputee exists before streaming anything
+        if not await data.has_reputee(reputee):
+            raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'Reputee could not be found.')
+
+        # Stream the page as it is read
+        resp.status = falcon.HTTP_200
+        resp.content_type = reputes.CONTENT_TYPE
+        resp.stream = iter_in_executor(data, reputes.iter_page(data.data, reputee, query))
+
+# ================================================== #
+
+
+# Define asyncio reputer API object
+class AsyncReputerAPI(ReputerAPI):
+
+    # Define handler for GET request
+    async def on_get(self, req, resp, reputer):
+        limit = self.parse_limit(req)
+        data = await self.reputation_api.get_async_data()
+        resp.status = falcon.HTTP_200
+        resp.text = json.dumps(await data.run(self.get_summary, data.data, reputer, limit))
+
+# ================================================== #
+
+
+# Define asyncio metrics API object
+class AsyncMetricsAPI(MetricsAPI):
+
+    # Define handler for GET request
+    async def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+        resp.content_type = CONTENT_TYPE
+        resp.text = self.render()
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
@@ -0,0 +1,143 @@
+# ================================================== #
+#                        BULK                        #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+import codecs
+import json
+
+# ujson has no incremental decoder, so JSON arrays are
+# parsed with the standard json library. NDJSON lines
+# are whole documents and can still use ujson.
+try:
+    import ujson
+    loads = ujson.loads
+except ImportError:
+    loads = json.loads
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of bytes read from the request body at a time
+CHUNK_SIZE = 64 * 1024
+
+# Content types treated as newline delimited JSON
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Whitespace allowed between JSON array items
+WHITESPACE = ' \t\n\r'
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to check if a request body is newline delimited JSON
+def is_ndjson(content_type):
+    if not content_type:
+        return False
+    return content_type.split(';')[0].strip().lower() in NDJSON_TYPES
+
+# ================================================== #
+
+
+# Define function to parse the items of a JSON array as they are read.
+# Yields (True, item) for every decoded item, or (False, None) once if
+# the array is malformed, after which parsing stops.
+def iter_json_array(stream, buffer=b''):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    finished = False
+    started = False
+    text = ''
+    position = 0
+
+    while True:
+        # Skip whitespace, the opening bracket and separators
+        while position < len(text) and (text[position] in WHITESPACE or text[position] == ','
+                                        or (not started and text[position] == '[')):
+            started = started or text[position] == '['
+            position += 1
+
+        # Stop at the closing bracket
+        if started and position < len(text) and text[position] == ']':
+            return
+
+        # Try to decode the next item if there is text left to decode
+        if started and position < len(text):
+            try:
+                item, end = decoder.raw_decode(text, position)
+                # An item ending exactly at the end of the text might be cut short
+                if end < len(text) or finished:
+                    yield True, item
+                    position = end
+                    continue
+            except ValueError:
+                if finished:
+                    yield False, None
+                    return
+
+        # Stop if the body ended before the array did
+        if finished:
+            yield False, None
+            return
+
+        # Read more of the body
+        chunk = buffer or stream.read(CHUNK_SIZE)
+        buffer = b''
+        finished = not chunk
+        try:
+            text = text[position:] + text_decoder.decode(chunk, final=finished)
+        except UnicodeDecodeError:
+            yield False, None
+            return
+        position = 0
+
+# ================================================== #
+
+
+# Define function to parse the lines of an NDJSON body as they are read.
+# Yields (True, item) for every decoded line and (False, None) for every
+# line that could not be decoded.
+def iter_ndjson(stream, buffer=b''):
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+
+        if not chunk:
+            break
+
+    if buffer.strip():
+        yield _parse_line(buffer)
+
+# ================================================== #
+
+
+# Define function to decode a single NDJSON line
+def _parse_line(line):
+    try:
+        return True, loads(line.decode('utf-8'))
+    except ValueError:
+        return False, None
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
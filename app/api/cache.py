@@ -0,0 +1,82 @@
+# ================================================== #
+#                       CACHE                        #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from collections import OrderedDict
+import threading
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define response cache object. Responses are stored with the
+# reputee version they were built from and are only returned
+# while the stored version is unchanged, so a POST in any
+# worker invalidates them.
+class ResponseCache(object):
+
+    # Define init function
+    def __init__(self, size):
+        # Create an ordered dictionary of (version, body) pairs keyed by reputee,
+        # ordered from least to most recently used
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Create counters for sizing the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ============================================= #
+
+    # Define function to get a cached response body
+    def get(self, reputee, version):
+        with self.lock:
+            entry = self.entries.get(reputee)
+            # Check that the response was built from the current version
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(reputee)
+            self.hits += 1
+            return entry[1]
+
+    # ============================================= #
+
+    # Define function to cache a response body
+    def put(self, reputee, version, body):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.entries[reputee] = (version, body)
+            self.entries.move_to_end(reputee)
+
+            # Evict the least recently used responses
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # ============================================= #
+
+    # Define function to get the cache's counters
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
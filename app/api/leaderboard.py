@@ -0,0 +1,319 @@
+# ================================================== #
+#                    LEADERBOARD                     #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api.processor import BatchProcessor
+from app.api import snapshot
+from app.api.snapshot import ScoreSnapshot
+from app.storage.storage import leaderboard_path
+import base64
+import bisect
+import falcon
+import os
+import pickle
+import threading
+import time
+
+# If ujson is available use it, otherwise use the
+# standard json library.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Scores a leaderboard can be ranked by, in the order Processor.get_all returns them
+METRICS = ("clout", "reach", "clarity")
+
+# Number of reputees returned by default and at most
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Number of reputees scored at a time while rebuilding
+REBUILD_CHUNK_SIZE = 5000
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define leaderboard object. The ranking as of the last build is a
+# snapshot file of every scorable reputee's scores with one ranking
+# per metric, ordered from highest to lowest score (then by reputee),
+# which every worker memory-maps and shares. Reputees the API has
+# rescored since are kept in memory in sorted lists of their own, and
+# a page merges the two, so it costs a binary search plus the page
+# itself. The snapshot is rebuilt from the stored aggregates every
+# refresh_interval seconds to pick up other workers' writes. Only one
+# process rebuilds it at a time, and the others map the file it wrote.
+# The scores saved by manage.py rebuild are used instead of scoring
+# every reputee when they are less than refresh_interval seconds old.
+# A rebuild does not hold the lock that pages and updates take, so
+# POSTs are not held up by it and pages are served from the old
+# snapshot until the new one is mapped.
+class Leaderboard(object):
+
+    # Define init function
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        # Create a variable to hold the mapped snapshot
+        self.snapshot = None
+        # Create a dictionary of the [clout, reach, clarity] lists of reputees
+        # rescored since the snapshot was built (None for those that can no
+        # longer be scored), the times they were rescored, and a sorted list
+        # of their (-score, reputee) keys for every metric
+        self.scores = {}
+        self.updated = {}
+        self.rankings = [[] for _ in METRICS]
+        self.lock = threading.RLock()
+        # Create a lock held by the thread mapping or rebuilding the snapshot
+        self.refresh_lock = threading.Lock()
+
+    # ============================================= #
+
+    # Define function to check if the mapped snapshot is no older than the refresh interval
+    def is_fresh(self):
+        current = self.snapshot
+        return current is not None and time.time() - current.created < self.refresh_interval
+
+    # ============================================= #
+
+    # Define function to map a snapshot no older than the refresh interval,
+    # rebuilding it if no other process has. Only one thread at a time
+    # refreshes, and the others keep using the old snapshot meanwhile
+    # (or wait for the first one to be mapped).
+    def refresh(self, data):
+        if self.is_fresh() or not self.refresh_lock.acquire(self.snapshot is None):
+            return
+
+        try:
+            if self.is_fresh():
+                return
+
+            path = leaderboard_path(data.prefix, data.engine_name)
+            with snapshot.locked(path + '.lock'):
+                current = ScoreSnapshot(path)
+                if not current.open() or time.time() - current.created >= self.refresh_interval:
+                    current.close()
+                    self.rebuild(data, path)
+                    current = ScoreSnapshot(path)
+                    current.open()
+
+            with self.lock:
+                self._install(current)
+        finally:
+            self.refresh_lock.release()
+
+    # ============================================= #
+
+    # Define function to write a new snapshot from every stored aggregate,
+    # or from the scores saved by manage.py rebuild if they are recent
+    def rebuild(self, data, path):
+        saved = self.load(data)
+        if saved is None:
+            saved = (time.time(), score_aggregates(data.iter_aggregates()))
+        snapshot.write_snapshot(path, saved[1], saved[0])
+
+    # ============================================= #
+
+    # Define function to read the scores saved for every shard as a
+    # (time, scores) pair. Returns None if any are missing or they are
+    # too old to stand in for a rebuild.
+    def load(self, data):
+        scores = {}
+        created = time.time()
+        for path in data.scores_paths():
+            saved = load_scores(path)
+            if saved is None:
+                return None
+            created = min(created, saved[0])
+            scores.update(saved[1])
+
+        if time.time() - created >= self.refresh_interval:
+            return None
+        return created, scores
+
+    # ============================================= #
+
+    # Define function to switch to a newly mapped snapshot
+    def _install(self, current):
+        # Keep the reputees rescored after the snapshot's scores were made
+        self.scores = {reputee: self.scores[reputee] for reputee, updated in self.updated.items()
+                       if updated >= current.created}
+        self.updated = {reputee: self.updated[reputee] for reputee in self.scores}
+        self.rankings = [sorted((-value[index][0], reputee) for reputee, value in self.scores.items()
+                                if value is not None)
+                         for index in range(len(METRICS))]
+
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = current
+
+    # ============================================= #
+
+    # Define function to rescore reputees that have new reputes
+    def update(self, data, reputees):
+        with self.lock:
+            # Nothing to update until the ranking is first built. Reputees
+            # rescored while it is being built are kept, since the build
+            # may have read their aggregates before the new reputes.
+            if self.snapshot is None and not self.refresh_lock.locked():
+                return
+
+            updated = time.time()
+            for reputee, value in BatchProcessor(list(set(reputees)), data).get_all().items():
+                self._remove(reputee)
+                self.scores[reputee] = value
+                self.updated[reputee] = updated
+                if value is not None:
+                    for index, ranking in enumerate(self.rankings):
+                        bisect.insort(ranking, (-value[index][0], reputee))
+
+    # ============================================= #
+
+    # Define function to remove a rescored reputee from every ranking
+    def _remove(self, reputee):
+        value = self.scores.pop(reputee, None)
+        if value is None:
+            return
+
+        for index, ranking in enumerate(self.rankings):
+            position = bisect.bisect_left(ranking, (-value[index][0], reputee))
+            if position < len(ranking) and ranking[position][1] == reputee:
+                del ranking[position]
+
+    # ============================================= #
+
+    # Define function to get a page of the ranking. Returns a list of
+    # (reputee, [clout, reach, clarity]) pairs and the cursor of the
+    # next page, or None if this is the last page.
+    def page(self, data, metric, limit, min_confidence=0, cursor=None):
+        self.refresh(data)
+        with self.lock:
+            index = METRICS.index(metric)
+            ranking = self.rankings[index]
+            key = decode_cursor(cursor) if cursor else None
+            position = bisect.bisect_right(ranking, key) if key else 0
+            snapshot_position = self.snapshot.bisect_right(index, key) if key else 0
+
+            # Walk down both rankings at once, taking the lower key each
+            # time and skipping reputees below the minimum confidence
+            results = []
+            while len(results) < limit:
+                snapshot_position = self._skip_rescored(index, snapshot_position)
+                snapshot_key = self.snapshot.key(index, snapshot_position) \
+                    if snapshot_position < len(self.snapshot) else None
+                if position < len(ranking) and (snapshot_key is None or ranking[position] < snapshot_key):
+                    key = ranking[position]
+                    value = self.scores[key[1]]
+                    position += 1
+                elif snapshot_key is not None:
+                    key = snapshot_key
+                    value = self.snapshot.value(self.snapshot.ranked(index, snapshot_position))
+                    snapshot_position += 1
+                else:
+                    break
+
+                if value[index][1] >= min_confidence:
+                    results.append((key[1], value))
+
+            snapshot_position = self._skip_rescored(index, snapshot_position)
+            more = position < len(ranking) or snapshot_position < len(self.snapshot)
+            return results, encode_cursor(key) if more else None
+
+    # ============================================= #
+
+    # Define function to move past snapshot entries of reputees that have
+    # been rescored, since their current scores are in the in-memory rankings
+    def _skip_rescored(self, index, position):
+        while position < len(self.snapshot) and \
+                self.snapshot.reputee(self.snapshot.ranked(index, position)) in self.scores:
+            position += 1
+
+        return position
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to score (reputee, aggregate) pairs a chunk at a
+# time. Returns a dictionary of [clout, reach, clarity] lists keyed by
+# reputee, leaving out reputees that a GET could not score.
+def score_aggregates(aggregates):
+    scores = {}
+    processor = BatchProcessor(None, None)
+    chunk = {}
+    for reputee, aggregate in aggregates:
+        chunk[reputee] = aggregate
+        if len(chunk) >= REBUILD_CHUNK_SIZE:
+            scores.update(processor.score(chunk))
+            chunk = {}
+    scores.update(processor.score(chunk))
+
+    return {reputee: value for reputee, value in scores.items() if value is not None}
+
+# ================================================== #
+
+
+# Define function to save scores with the time they were made, now by
+# default. The file is replaced in one step, so readers see either the
+# old or new scores.
+def save_scores(path, scores, created=None):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        pickle.dump((time.time() if created is None else created, scores), file, pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+# ================================================== #
+
+
+# Define function to load saved scores as a (time, scores) pair, or None if there are none
+def load_scores(path):
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+# ================================================== #
+
+
+# Define function to encode a ranking key as an opaque cursor. The
+# score is written with repr so it is read back as the same float.
+def encode_cursor(key):
+    text = json.dumps([repr(key[0]), key[1]])
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+# ================================================== #
+
+
+# Define function to decode a cursor back into a ranking key
+def decode_cursor(cursor):
+    try:
+        score, reputee = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return (float(score), str(reputee))
+    except (ValueError, TypeError, UnicodeError):
+        raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The cursor is not valid.')
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
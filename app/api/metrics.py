@@ -0,0 +1,105 @@
+# ================================================== #
+#                      METRICS                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.metrics import REGISTRY
+import falcon
+import time
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define timing middleware object. Records how long every
+# request takes under its method and route template, so a
+# slow route can be told apart from a slow reputee.
+class TimingMiddleware(object):
+
+    # Define init function
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    # ============================================= #
+
+    # Define function to note when a request starts
+    def process_request(self, req, resp):
+        req.context['start_time'] = time.perf_counter()
+
+    # ============================================= #
+
+    # Define function to record a request once it has been handled
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = req.context.get('start_time')
+        if start is None:
+            return
+
+        labels = (("method", req.method), ("route", req.uri_template or "unrouted"))
+        self.registry.observe("reputation_request_duration_seconds", time.perf_counter() - start, labels)
+        self.registry.increment("reputation_requests_total", labels=labels + (("status", str(resp.status)[:3]),))
+
+    # ============================================= #
+
+    # Define the same functions for ASGI apps
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+# ================================================== #
+
+
+# Define metrics API object
+class MetricsAPI(object):
+
+    # Define init function
+    def __init__(self, reputation_api=None, registry=REGISTRY):
+        # Store the reputation API whose response cache is reported
+        self.reputation_api = reputation_api
+        self.registry = registry
+
+    # ============================================= #
+
+    # Define function to render the metrics
+    def render(self):
+        extra = {}
+        if self.reputation_api is not None:
+            stats = self.reputation_api.cache.stats()
+            extra = {"reputation_cache_entries": [((), stats["size"])],
+                     "reputation_cache_hits_total": [((), stats["hits"])],
+                     "reputation_cache_misses_total": [((), stats["misses"])],
+                     "reputation_cache_evictions_total": [((), stats["evictions"])]}
+
+        return self.registry.render(extra)
+
+    # ============================================= #
+
+    # Define handler for GET request
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+        resp.content_type = CONTENT_TYPE
+        resp.body = self.render()
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
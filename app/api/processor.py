@@ -10,7 +10,15 @@
 # ================================================== #
 
 
-from app.storage.storage import Data
+from app.metrics import REGISTRY
+
+# If NumPy is available use it to score batches of
+# reputees as array operations, otherwise score each
+# reputee in turn with the same math as a single GET.
+# It is imported the first time a batch is scored, since
+# it takes longer to import than the rest of the API.
+numpy = None
+numpy_loaded = False
 
 
 # ================================================== #
@@ -22,15 +30,17 @@ from app.storage.storage import Data
 class Processor(object):
 
     # Define init function
-    def __init__(self, reputee, mode):
-        # Store the queried reputee
+    def __init__(self, reputee, data):
+        # Store the queried reputee and the open database
         self.reputee = reputee
-        self.mode = mode
+        self.data = data
 
     # ============================================= #
 
     # Define function to get reach, clarity, and clout
     def get_all(self):
+        REGISTRY.increment("reputation_processor_reputees_scored_total")
+
         # Calculate reach, clarity, and clout
         reach = self.get_reach()
         clarity = self.get_clarity()
@@ -43,28 +53,16 @@ class Processor(object):
 
     # Define function to get reach
     def get_reach(self):
-        # Open database
-        data = Data(self.mode)
-        data.open()
-        # Initialize a list
-        reach_list = []
-
-        # Loop through the database and append to list any entries matching queried reputee
-        for key in data.db:
-            if data.db[key]['reputee'] == self.reputee:
-                if data.db[key]['repute']['feature'] == "reach":
-                    reach_list.append(data.db[key]['repute']['value'])
-
-        # Close database
-        data.close()
+        # Get the running count and sum of the queried reputee's reach entries
+        count, total = self.data.get_aggregate(self.reputee, "reach")
 
         # Calculate score
-        if len(reach_list) == 0:
+        if count == 0:
             score = 0
         else:
-            score = sum(reach_list)/len(reach_list)
+            score = total/count
         # Calculate confidence
-        confidence = self.s_function(2, 6, len(reach_list))
+        confidence = self.s_function(2, 6, count)
 
         # Return calculated values
         return (score, confidence)
@@ -73,27 +71,16 @@ class Processor(object):
 
     # Define function to get clarity
     def get_clarity(self):
-        # Open database
-        data = Data(self.mode)
-        data.open()
-        # Initialize a list
-        clarity_list = []
-
-        # Loop through the database and append to list any entries matching queried reputee
-        for key in data.db:
-            if data.db[key]['reputee'] == self.reputee:
-                if data.db[key]['repute']['feature'] == "clarity":
-                    clarity_list.append(data.db[key]['repute']['value'])
-        # Close database
-        data.close()
+        # Get the running count and sum of the queried reputee's clarity entries
+        count, total = self.data.get_aggregate(self.reputee, "clarity")
 
         # Calculate score
-        if len(clarity_list) == 0:
+        if count == 0:
             score = 0
         else:
-            score = sum(clarity_list) / len(clarity_list)
+            score = total/count
         # Calculate confidence
-        confidence = self.s_function(4, 8, len(clarity_list))
+        confidence = self.s_function(4, 8, count)
 
         # Return calculated values
         return (score, confidence)
@@ -129,6 +116,150 @@ class Processor(object):
             return 1
 
 
+# ================================================== #
+
+
+# Define batch processor object
+class BatchProcessor(object):
+
+    # Define init function
+    def __init__(self, reputees, data):
+        # Store the queried reputees and the open database
+        self.reputees = reputees
+        self.data = data
+
+    # ============================================= #
+
+    # Define function to get reach, clarity, and clout of every queried reputee.
+    # Returns a dictionary of [clout, reach, clarity] lists keyed by reputee, in
+    # the same format as Processor.get_all. Reputees that could not be found are
+    # left out and reputees whose scores are undefined are mapped to None.
+    def get_all(self):
+        # Get the running counts and sums of every queried reputee
+        return self.score(self.data.get_aggregates(self.reputees))
+
+    # ============================================= #
+
+    # Define function to get reach, clarity, and clout from a dictionary of
+    # aggregates keyed by reputee, in the same format as get_all
+    def score(self, aggregates):
+        REGISTRY.increment("reputation_processor_reputees_scored_total", len(aggregates))
+
+        reputees = list(aggregates)
+        reach = [aggregates[reputee].get("reach", (0, 0)) for reputee in reputees]
+        clarity = [aggregates[reputee].get("clarity", (0, 0)) for reputee in reputees]
+
+        # Calculate values
+        if not reputees or load_numpy() is None:
+            return self._get_all_python(reputees, reach, clarity)
+        return self._get_all_numpy(reputees, reach, clarity)
+
+    # ============================================= #
+
+    # Define function to calculate values one reputee at a time
+    def _get_all_python(self, reputees, reach, clarity):
+        processed_data = {}
+        processor = Processor(None, self.data)
+
+        for reputee, (reach_count, reach_total), (clarity_count, clarity_total) in zip(reputees, reach, clarity):
+            reach_values = (0 if reach_count == 0 else reach_total/reach_count,
+                            processor.s_function(2, 6, reach_count))
+            clarity_values = (0 if clarity_count == 0 else clarity_total/clarity_count,
+                              processor.s_function(4, 8, clarity_count))
+            try:
+                clout_values = processor.get_clout(clarity_values, reach_values)
+            except ZeroDivisionError:
+                processed_data[reputee] = None
+                continue
+            processed_data[reputee] = [clout_values, reach_values, clarity_values]
+
+        return processed_data
+
+    # ============================================= #
+
+    # Define function to calculate values for every reputee with array operations
+    def _get_all_numpy(self, reputees, reach, clarity):
+        reach_count, reach_total = numpy.array(reach, dtype=float).T
+        clarity_count, clarity_total = numpy.array(clarity, dtype=float).T
+
+        # Calculate scores and confidences
+        reach_score = numpy.divide(reach_total, reach_count, out=numpy.zeros(len(reputees)), where=reach_count != 0)
+        clarity_score = numpy.divide(clarity_total, clarity_count, out=numpy.zeros(len(reputees)),
+                                     where=clarity_count != 0)
+        reach_confidence = self.s_function(2, 6, reach_count)
+        clarity_confidence = self.s_function(4, 8, clarity_count)
+
+        # Calculate clout the same way as Processor.get_clout, leaving out
+        # reputees whose weights are undefined because both confidences are 0
+        weight_total = clarity_confidence + reach_confidence
+        scored = weight_total != 0
+        safe_total = numpy.where(scored, weight_total, 1)
+        clout_score = ((reach_confidence/safe_total)*reach_score + (clarity_confidence/safe_total)*clarity_score)/10
+        clout_confidence = numpy.minimum(reach_confidence, clarity_confidence)
+
+        # Convert the arrays back to the same int and float values Processor
+        # returns, so a batch GET serializes a reputee the same way as a GET
+        processed_data = {}
+        for i, reputee in enumerate(reputees):
+            if not scored[i]:
+                processed_data[reputee] = None
+                continue
+            reach_values = (self._score(reach_count[i], reach_score[i]),
+                            self._confidence(2, 6, reach_count[i], reach_confidence[i]))
+            clarity_values = (self._score(clarity_count[i], clarity_score[i]),
+                              self._confidence(4, 8, clarity_count[i], clarity_confidence[i]))
+            # Processor.get_clout takes the lower confidence, preferring reach's on a tie
+            processed_data[reputee] = [(float(clout_score[i]), min([reach_values[1], clarity_values[1]])),
+                                       reach_values, clarity_values]
+
+        return processed_data
+
+    # ============================================= #
+
+    # Define function to convert a score to the value Processor returns,
+    # which is the int 0 when there are no entries
+    def _score(self, count, score):
+        return 0 if count == 0 else float(score)
+
+    # ============================================= #
+
+    # Define function to convert a confidence to the value Processor's s
+    # function returns, which is an int at either end of the curve
+    def _confidence(self, a, b, count, confidence):
+        if count <= a:
+            return 0
+        if count > b:
+            return 1
+        return float(confidence)
+
+    # ============================================= #
+
+    # Define s function over an array of counts
+    def s_function(self, a, b, x):
+        # Piecewise function used to calculate confidence
+        return numpy.select([x <= a, x <= ((a+b)/2), x <= b],
+                            [0, 2*((x-a)/(b-a))**2, 1-2*((x-b)/(b-a))**2], 1)
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to import NumPy the first time it is needed. Returns
+# the module, or None if it is not installed.
+def load_numpy():
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+
 # ================================================== #
 #                        EOF                         #
 # ================================================== #
@@ -0,0 +1,80 @@
+# ================================================== #
+#                      REPUTES                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+import base64
+import falcon
+
+# If ujson is available use it, otherwise use the
+# standard json library.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of reputes returned by default and at most
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+# Content type of a page of reputes
+CONTENT_TYPE = 'application/x-ndjson'
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to stream a page of a reputee's reputes as NDJSON.
+# Every repute is written on its own line in the POST format, and the
+# last line holds the cursor of the next page, or null if this is the
+# last page.
+def iter_page(data, reputee, query):
+    count = 0
+    position = None
+    for position, record in data.iter_reputes_page(reputee, query["start"], query["limit"], query["feature"],
+                                                    query["reputer"]):
+        count += 1
+        yield json.dumps(record).encode('utf-8') + b"\n"
+
+    next_cursor = encode_cursor(position) if count == query["limit"] else None
+    yield json.dumps({"next_cursor": next_cursor}).encode('utf-8') + b"\n"
+
+# ================================================== #
+
+
+# Define function to encode a position as an opaque cursor
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps([position]).encode('utf-8')).decode('ascii')
+
+# ================================================== #
+
+
+# Define function to decode a cursor back into a position
+def decode_cursor(cursor):
+    try:
+        position, = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+            raise ValueError(cursor)
+        return position
+    except (ValueError, TypeError, UnicodeError):
+        raise falcon.HTTPError(falcon.HTTP_400, 'Error', 'The cursor is not valid.')
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
@@ -0,0 +1,225 @@
+# ================================================== #
+#                      SNAPSHOT                      #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from array import array
+import contextlib
+import mmap
+import os
+import struct
+
+# fcntl is only available on POSIX systems. Without it
+# every process rebuilds the snapshot for itself.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# File header: magic, number of reputees, time the scores were made.
+# The arrays after it are in the machine's byte order, since the file
+# is rebuilt rather than moved between machines, and each starts on a
+# multiple of its item size so it can be read in place:
+#   scores    6 doubles per reputee (clout, reach and clarity score and confidence)
+#   offsets   (count + 1) unsigned 64-bit offsets of the names
+#   rankings  count unsigned 32-bit reputee numbers per metric, best first
+#   names     every reputee's name in UTF-8, sorted
+HEADER = struct.Struct('=4s4xQd')
+MAGIC = b'LBS1'
+
+# Number of metrics a reputee is ranked by
+METRIC_COUNT = 3
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define score snapshot object. Holds every scorable reputee's scores
+# and one ranking per metric in a memory-mapped file. The pages are
+# only ever read, so every worker that maps the file (or inherits the
+# mapping from a gunicorn master started with --preload) shares them,
+# rather than each building its own dictionaries and sorted lists.
+class ScoreSnapshot(object):
+
+    # Define init function
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        # Create variables to hold the views of the file's arrays, the
+        # position of its names, its number of reputees and when it was made
+        self.views = []
+        self.scores = None
+        self.offsets = None
+        self.rankings = None
+        self.names = 0
+        self.count = 0
+        self.created = None
+
+    # ============================================= #
+
+    # Define function to map the file. Returns False if it is missing or damaged.
+    def open(self):
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if size < HEADER.size:
+                return False
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, created = HEADER.unpack_from(self.map)
+        scores_end = HEADER.size + count * METRIC_COUNT * 16
+        offsets_end = scores_end + (count + 1) * 8
+        rankings_end = offsets_end + count * METRIC_COUNT * 4
+        if magic != MAGIC or size < rankings_end:
+            self.map.close()
+            self.map = None
+            return False
+
+        # Read the arrays in place
+        view = memoryview(self.map)
+        self.views = [view, view[HEADER.size:scores_end].cast('d'), view[scores_end:offsets_end].cast('Q'),
+                      view[offsets_end:rankings_end].cast('I')]
+        self.scores, self.offsets, self.rankings = self.views[1:]
+        self.names = rankings_end
+        self.count = count
+        self.created = created
+        return True
+
+    # ============================================= #
+
+    # Define function to get the number of reputees
+    def __len__(self):
+        return self.count
+
+    # ============================================= #
+
+    # Define function to get the name of a reputee by its number
+    def reputee(self, number):
+        return self.map[self.names + self.offsets[number]:self.names + self.offsets[number + 1]].decode('utf-8')
+
+    # ============================================= #
+
+    # Define function to get a reputee's [clout, reach, clarity] list by its number
+    def value(self, number):
+        start = number * METRIC_COUNT * 2
+        scores = self.scores[start:start + METRIC_COUNT * 2]
+        return [(scores[index], scores[index + 1]) for index in range(0, METRIC_COUNT * 2, 2)]
+
+    # ============================================= #
+
+    # Define function to get the number of the reputee at a position of a metric's ranking
+    def ranked(self, metric, position):
+        return self.rankings[metric * self.count + position]
+
+    # ============================================= #
+
+    # Define function to get the (-score, reputee) key at a position of a
+    # metric's ranking, which sorts the same way as the in-memory rankings
+    def key(self, metric, position):
+        number = self.ranked(metric, position)
+        return (-self.scores[number * METRIC_COUNT * 2 + metric * 2], self.reputee(number))
+
+    # ============================================= #
+
+    # Define function to find the first position of a metric's ranking after a key
+    def bisect_right(self, metric, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if key < self.key(metric, middle):
+                high = middle
+            else:
+                low = middle + 1
+
+        return low
+
+    # ============================================= #
+
+    # Define function to unmap the file
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to write a snapshot of a dictionary of [clout, reach,
+# clarity] lists keyed by reputee, made at the given time. The file is
+# replaced in one step, so processes that have the old one mapped keep
+# reading it and new ones map the new one.
+def write_snapshot(path, scores, created):
+    reputees = sorted(scores)
+    numbers = {reputee: number for number, reputee in enumerate(reputees)}
+
+    values = array('d')
+    offsets = array('Q', [0])
+    names = []
+    for reputee in reputees:
+        for score, confidence in scores[reputee]:
+            values.extend((score, confidence))
+        names.append(reputee.encode('utf-8'))
+        offsets.append(offsets[-1] + len(names[-1]))
+
+    rankings = array('I')
+    for metric in range(METRIC_COUNT):
+        rankings.extend(numbers[reputee] for _, reputee in
+                        sorted((-scores[reputee][metric][0], reputee) for reputee in reputees))
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(reputees), created))
+        for part in (values, offsets, rankings):
+            file.write(part.tobytes())
+        file.write(b''.join(names))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+# ================================================== #
+
+
+# Define function to hold an exclusive lock on a file, so only one
+# process at a time rebuilds a snapshot
+@contextlib.contextmanager
+def locked(path):
+    if fcntl is None:
+        yield
+        return
+
+    file = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(file)
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
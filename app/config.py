@@ -0,0 +1,59 @@
+# ================================================== #
+#                       CONFIG                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+import os
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to read the storage engine from the environment.
+# REPUTATION_ENGINE chooses it; use "sqlite" when running more than
+# one gunicorn worker.
+def engine():
+    return os.environ.get("REPUTATION_ENGINE", "shelve")
+
+# ================================================== #
+
+
+# Define function to read an engine's options from the environment.
+# REPUTATION_BLOOM_CAPACITY and REPUTATION_BLOOM_ERROR_RATE size the
+# shelve engine's filter of stored reputes.
+def engine_options(engine):
+    if engine != "shelve":
+        return {}
+
+    return {"bloom_capacity": int(os.environ.get("REPUTATION_BLOOM_CAPACITY", 1000000)),
+            "bloom_error_rate": float(os.environ.get("REPUTATION_BLOOM_ERROR_RATE", 0.01))}
+
+# ================================================== #
+
+
+# Define function to read the API's settings from the environment.
+# REPUTATION_CACHE_SIZE sets how many GET responses each worker
+# caches, and REPUTATION_LEADERBOARD_REFRESH how often (in seconds)
+# the leaderboard is rebuilt to pick up other workers' POSTs.
+# REPUTATION_WRITE_BATCH_SIZE turns on group commit of single POSTs
+# in batches of up to that many reputes, waiting at most
+# REPUTATION_WRITE_BATCH_WAIT milliseconds to fill a batch.
+def api_settings():
+    return {"cache_size": int(os.environ.get("REPUTATION_CACHE_SIZE", 1024)),
+            "leaderboard_refresh": float(os.environ.get("REPUTATION_LEADERBOARD_REFRESH", 60)),
+            "write_batch_size": int(os.environ.get("REPUTATION_WRITE_BATCH_SIZE", 0)),
+            "write_batch_wait": float(os.environ.get("REPUTATION_WRITE_BATCH_WAIT", 2)) / 1000}
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
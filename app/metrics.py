@@ -0,0 +1,185 @@
+# ================================================== #
+#                      METRICS                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+import bisect
+import threading
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Type and help text of every metric, keyed by name
+DESCRIPTIONS = {
+    "reputation_requests_total":
+        ("counter", "Requests handled, by method, route and status."),
+    "reputation_request_duration_seconds":
+        ("histogram", "Time spent handling a request, by method and route."),
+    "reputation_storage_operation_duration_seconds":
+        ("histogram", "Time spent in a storage operation, including waiting for its locks."),
+    "reputation_storage_records_read_total":
+        ("counter", "Raw repute records read (and unpickled) from storage."),
+    "reputation_storage_records_written_total":
+        ("counter", "New repute records written to storage."),
+    "reputation_storage_duplicates_total":
+        ("counter", "Posted reputes that were already stored."),
+    "reputation_storage_dedupe_filter_total":
+        ("counter", "Duplicate checks answered by the filter of stored keys, by whether the key was "
+                    "definitely new or had to be looked up."),
+    "reputation_storage_aggregates_read_total":
+        ("counter", "Per-reputee aggregates read from storage."),
+    "reputation_write_batches_total":
+        ("counter", "Batches of POSTed reputes committed by the write queue."),
+    "reputation_write_batch_reputes_total":
+        ("counter", "Reputes committed by the write queue. Divide by the batches for the mean batch size."),
+    "reputation_processor_reputees_scored_total":
+        ("counter", "Reputees scored by a processor."),
+    "reputation_cache_entries":
+        ("gauge", "GET responses held in the response cache."),
+    "reputation_cache_hits_total":
+        ("counter", "GET requests answered from the response cache."),
+    "reputation_cache_misses_total":
+        ("counter", "GET requests that missed the response cache."),
+    "reputation_cache_evictions_total":
+        ("counter", "Responses evicted from the response cache."),
+}
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define histogram object
+class Histogram(object):
+
+    # Define init function
+    def __init__(self, buckets=BUCKETS):
+        # Create a count for every bucket plus one for values above the last bucket
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # ============================================= #
+
+    # Define function to record a value
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# ================================================== #
+
+
+# Define metrics registry object. Every process keeps its own
+# counts, so each gunicorn worker reports only its own requests.
+class Registry(object):
+
+    # Define init function
+    def __init__(self):
+        # Create dictionaries of counters and histograms keyed by (name, labels),
+        # where labels is a tuple of (label, value) pairs
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    # ============================================= #
+
+    # Define function to add to a counter
+    def increment(self, name, amount=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    # ============================================= #
+
+    # Define function to record a value in a histogram
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    # ============================================= #
+
+    # Define function to get the value of a counter
+    def get(self, name, labels=()):
+        with self.lock:
+            return self.counters.get((name, labels), 0)
+
+    # ============================================= #
+
+    # Define function to reset every metric
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    # ============================================= #
+
+    # Define function to render every metric in the Prometheus text format.
+    # Metrics kept outside the registry can be added as a dictionary of
+    # [(labels, value)] lists keyed by name.
+    def render(self, extra=None):
+        samples = {}
+        for name, values in (extra or {}).items():
+            samples[name] = [format_sample(name, labels, value) for labels, value in values]
+
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(format_sample(name, labels, value))
+
+            for (name, labels), histogram in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(format_sample(name + "_bucket", labels + (("le", repr(bound)),), cumulative))
+                lines.append(format_sample(name + "_bucket", labels + (("le", "+Inf"),), histogram.count))
+                lines.append(format_sample(name + "_sum", labels, histogram.sum))
+                lines.append(format_sample(name + "_count", labels, histogram.count))
+
+        output = []
+        for name in sorted(samples):
+            kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+            output.append("# HELP " + name + " " + description)
+            output.append("# TYPE " + name + " " + kind)
+            output.extend(samples[name])
+
+        return "\n".join(output) + "\n" if output else ""
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to format one sample in the Prometheus text format
+def format_sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join('%s="%s"' % (label, str(text).replace("\\", "\\\\").replace('"', '\\"')
+                                             .replace("\n", "\\n"))
+                               for label, text in labels) + "}"
+    return name + " " + repr(value)
+
+
+# ================================================== #
+#                      REGISTRY                      #
+# ================================================== #
+
+# Registry shared by the API and storage objects of the process
+REGISTRY = Registry()
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
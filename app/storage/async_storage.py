@@ -0,0 +1,97 @@
+# ================================================== #
+#                   ASYNC STORAGE                    #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+import asyncio
+import functools
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define async Data object. Every call is run on a thread pool
+# so the event loop keeps serving other connections while the
+# storage engine blocks on disk or on another worker's lock.
+class AsyncData(object):
+
+    # Define init function
+    def __init__(self, data, executor):
+        # Store the open Data object and the thread pool that calls into it
+        self.data = data
+        self.executor = executor
+
+    # ============================================= #
+
+    # Define function to run a blocking function on the thread pool.
+    # Scans that iterate over the database should be run as a single
+    # function, since the Data object's locks belong to one thread.
+    async def run(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    # ============================================= #
+
+    # Define function to add a repute to the database
+    async def add(self, reputer, reputee, rid, feature, value):
+        return await self.run(self.data.add, reputer, reputee, rid, feature, value)
+
+    # ============================================= #
+
+    # Define function to add a batch of reputes in one write
+    async def add_many(self, reputes):
+        return await self.run(self.data.add_many, reputes)
+
+    # ============================================= #
+
+    # Define function to check for a reputee
+    async def has_reputee(self, reputee):
+        return await self.run(self.data.has_reputee, reputee)
+
+    # ============================================= #
+
+    # Define function to get a reputee's version
+    async def get_version(self, reputee):
+        return await self.run(self.data.get_version, reputee)
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's reputes
+    async def get_keys(self, reputee):
+        return await self.run(self.data.get_keys, reputee)
+
+    # ============================================= #
+
+    # Define function to get a reputee's reputes
+    async def get_reputes(self, reputee):
+        return await self.run(self.data.get_reputes, reputee)
+
+    # ============================================= #
+
+    # Define function to get the count and sum of a reputee's feature
+    async def get_aggregate(self, reputee, feature):
+        return await self.run(self.data.get_aggregate, reputee, feature)
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees
+    async def get_aggregates(self, reputees):
+        return await self.run(self.data.get_aggregates, reputees)
+
+    # ============================================= #
+
+    # Define function to clear database
+    async def clear(self):
+        return await self.run(self.data.clear)
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
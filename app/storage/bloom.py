@@ -0,0 +1,132 @@
+# ================================================== #
+#                       BLOOM                        #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# File header: magic, number of bits, number of hash functions
+HEADER = struct.Struct('>4sQI')
+MAGIC = b'BLM1'
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define Bloom filter object. The bits are kept in a memory-mapped
+# file, so every process that opens the same file shares them and
+# they persist across restarts. Callers must hold a write lock that
+# excludes other processes while adding keys.
+class BloomFilter(object):
+
+    # Define init function
+    def __init__(self, path, capacity, error_rate):
+        # Size the filter so that holding capacity keys gives the requested false positive rate
+        self.path = path
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.file = None
+        self.map = None
+
+    # ============================================= #
+
+    # Define function to open the filter. Returns True if the file was
+    # missing or damaged and has been created empty, in which case the
+    # caller must add every stored key to it. An existing file keeps the
+    # size it was created with, since other processes may have it open;
+    # delete it while the API is stopped to resize the filter.
+    def open(self):
+        created = False
+        self.file = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        header = os.read(self.file, HEADER.size)
+
+        # Use the size of an existing file
+        if len(header) == HEADER.size:
+            magic, bits, hashes = HEADER.unpack(header)
+            if magic == MAGIC and bits > 0 and hashes > 0 \
+                    and os.fstat(self.file).st_size == HEADER.size + (bits + 7) // 8:
+                self.bits, self.hashes = bits, hashes
+            else:
+                header = b''
+
+        # Create the file if it is new or damaged
+        if len(header) < HEADER.size:
+            os.ftruncate(self.file, 0)
+            os.ftruncate(self.file, HEADER.size + self._length())
+            os.lseek(self.file, 0, os.SEEK_SET)
+            os.write(self.file, HEADER.pack(MAGIC, self.bits, self.hashes))
+            created = True
+
+        self.map = mmap.mmap(self.file, HEADER.size + self._length())
+        return created
+
+    # ============================================= #
+
+    # Define function to get the number of bytes holding the bits
+    def _length(self):
+        return (self.bits + 7) // 8
+
+    # ============================================= #
+
+    # Define function to get the bit positions of a key
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = struct.unpack('>QQ', digest)
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    # ============================================= #
+
+    # Define function to add a key. Returns True if the key was
+    # definitely not in the filter before, or False if it might be.
+    def add(self, key):
+        new = False
+        for position in self._positions(key):
+            index = HEADER.size + (position >> 3)
+            mask = 1 << (position & 7)
+            byte = self.map[index]
+            if not byte & mask:
+                self.map[index] = byte | mask
+                new = True
+
+        return new
+
+    # ============================================= #
+
+    # Define function to check if a key might be in the filter
+    def __contains__(self, key):
+        return all(self.map[HEADER.size + (position >> 3)] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    # ============================================= #
+
+    # Define function to remove every key. The bits are zeroed in
+    # place so other processes with the file open see the change.
+    def clear(self):
+        self.map[HEADER.size:] = bytes(self._length())
+
+    # ============================================= #
+
+    # Define function to close the filter
+    def close(self):
+        self.map.close()
+        os.close(self.file)
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
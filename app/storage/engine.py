@@ -0,0 +1,264 @@
+# ================================================== #
+#                       ENGINE                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+import contextlib
+import os
+import zlib
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define base storage engine object
+class Engine(object):
+
+    # Whether several processes may open the engine's files at once
+    multiprocess = True
+
+    # Define init function
+    def __init__(self, directory, prefix):
+        # Store the location of the engine's files
+        self.directory = directory
+        self.prefix = prefix
+
+    # ============================================= #
+
+    # Define function to get the path of one of the engine's files
+    def path(self, name):
+        return os.path.join(self.directory, self.prefix + name)
+
+    # ============================================= #
+
+    # Define function to open the engine
+    def open(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to hold the engine's read lock while reading.
+    # Engines that handle locking themselves need not override it.
+    @contextlib.contextmanager
+    def reading(self):
+        yield
+
+    # ============================================= #
+
+    # Define function to hold the engine's write lock while writing
+    @contextlib.contextmanager
+    def writing(self):
+        yield
+
+    # ============================================= #
+
+    # Define function to close the engine
+    def close(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to remove every record
+    def clear(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to delete the engine's files. The engine must not be open.
+    def remove(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to store a record (a Repute) if its key is new
+    # and update the reputee index, aggregates and version with it
+    def put_if_absent(self, key, record):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to store a batch of (key, record) pairs, returning
+    # whether each was new. Engines with transactions should commit the
+    # whole batch at once.
+    def put_many(self, items):
+        return [self.put_if_absent(key, record) for key, record in items]
+    # ============================================= #
+
+    # Define function to check for a reputee
+    def has_reputee(self, reputee):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get a reputee's version. Versions start at 0,
+    # increase whenever a new record is stored for the reputee or the
+    # engine is cleared, and never decrease.
+    def get_version(self, reputee):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get every (reputee, version) pair, including
+    # those of reputees whose records have been cleared
+    def iter_versions(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to raise the versions of reputees to at least the
+    # ones given in a dictionary keyed by reputee. Versions lower than
+    # the stored ones are ignored, so versions never decrease.
+    def raise_versions(self, versions):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's records in insertion
+    # order. A rebuild of the shelve engine lists them in key order instead.
+    def get_keys(self, reputee):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get a reputee's records as Repute objects
+    def get_reputes(self, reputee):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get a page of a reputee's records, optionally only
+    # those with the given feature or reputer. Returns a list of up to limit
+    # (position, record) pairs in insertion order, starting at position
+    # start, and the position the next page starts at, or None if there
+    # are no more records. Pages may be short when records are filtered
+    # out. Records are never moved, so positions are stable until the
+    # engine is cleared.
+    def get_reputes_page(self, reputee, start, limit, feature=None, reputer=None):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get the number of records with each feature that a
+    # reputer stored for each of its reputees, as a dictionary of
+    # {feature: count} dictionaries keyed by reputee. Engines keep an index
+    # by reputer so this never scans every record.
+    def get_reputer_breakdown(self, reputer):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get every record as a Repute object
+    def iter_reputes(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get a batch of at most limit records, starting at
+    # a cursor returned with the previous batch (None for the first).
+    # Returns the records and the next batch's cursor, or None after the
+    # last. Every record stored before the first batch is returned once.
+    def get_reputes_batch(self, cursor, limit):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get the count and sum of a reputee's feature
+    def get_aggregate(self, reputee, feature):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees.
+    # Reputees without any records are left out of the result.
+    def get_aggregates(self, reputees):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to get every reputee's stored aggregates
+    def iter_aggregates(self):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to replace the stored aggregates and bump the version
+    # of every reputee whose aggregate changed, so nothing cached from the
+    # old aggregates is reused
+    def replace_aggregates(self, aggregates):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to rebuild the reputee index from the records
+    def rebuild_index(self):
+        pass
+
+    # ============================================= #
+
+    # Define function to rebuild everything derived from the records (the
+    # indexes and aggregates) of the reputees in one partition, or of every
+    # reputee by default, and bump their versions so nothing cached before
+    # the rebuild is reused. The engine takes its own locks, so the
+    # partitions of a shard can be rebuilt by several processes at once.
+    # Returns the partition's aggregates.
+    def rebuild(self, partition=0, partitions=1):
+        raise NotImplementedError
+
+    # ============================================= #
+
+    # Define function to convert records written by earlier versions to
+    # the current format, returning how many were converted
+    def migrate(self):
+        return 0
+
+    # ============================================= #
+
+    # Define function to calculate aggregates from the records
+    def compute_aggregates(self):
+        aggregates = {}
+        for record in self.iter_reputes():
+            aggregate = aggregates.setdefault(record.reputee, {})
+            count, total = aggregate.get(record.feature, (0, 0))
+            aggregate[record.feature] = (count + 1, total + record.value)
+
+        return aggregates
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to check if a record has the given feature and reputer.
+# None matches anything.
+def matches(record, feature=None, reputer=None):
+    return (feature is None or record.feature == feature) and (reputer is None or record.reputer == reputer)
+
+# ================================================== #
+
+
+# Define function to get the reputees whose aggregates differ between
+# two dictionaries of aggregates keyed by reputee
+def changed_reputees(old, new):
+    return [reputee for reputee in set(old) | set(new) if old.get(reputee) != new.get(reputee)]
+
+# ================================================== #
+
+
+# Define function to get the partition holding a reputee when a shard is
+# rebuilt in parts. Every reputee of a shard has the same crc32 modulo the
+# number of shards, so a different hash is used to spread them out.
+def partition_index(reputee, partitions):
+    return zlib.adler32(reputee.encode('utf-8')) % partitions if partitions > 1 else 0
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
@@ -0,0 +1,644 @@
+# ================================================== #
+#                     LOG ENGINE                     #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+from app.storage.engine import changed_reputees, Engine, matches
+from app.storage.record import Repute, check_value
+import bisect
+import contextlib
+import json
+import os
+import pickle
+import shutil
+import struct
+import threading
+import zlib
+
+# fcntl is only available on POSIX systems. Without it
+# nothing stops two processes opening the same log.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# Every entry starts with the payload's length and CRC32
+HEADER = struct.Struct('>II')
+
+# Payload kinds. A record payload is a repute, while a
+# version payload sets the starting version of a reputee
+# after the log has been cleared or rebuilt. A merged
+# payload starts every segment written by a compaction.
+RECORD = b'R'
+VERSION = b'V'
+MERGED = b'M'
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define log-structured storage engine object. Reputes are
+# appended to segment files and every lookup structure is
+# kept in memory, so only one process may open a log.
+class LogEngine(Engine):
+
+    # Only one process may open a log
+    multiprocess = False
+
+    # Size at which the active segment is sealed and a new one started
+    segment_size = 64 * 1024 * 1024
+    # Number of sealed segments not yet compacted that triggers a compaction
+    compaction_segments = 4
+    # Seconds between checks for segments to compact
+    compaction_interval = 60
+
+    # Define init function
+    def __init__(self, directory, prefix):
+        super(LogEngine, self).__init__(directory, prefix)
+        # Create variables to hold the log's directory, lock and segments
+        self.log_directory = self.path('log')
+        self.lock_file = None
+        self.lock = threading.RLock()
+        self.segments = []
+        self.readers = {}
+        self.active = None
+        # Create variables to hold the in-memory index
+        self._reset()
+        self.versions = {}
+        # Create variables to control the compaction thread
+        self.epoch = 0
+        self.stopping = threading.Event()
+        self.compactor = None
+
+    # ============================================= #
+
+    # Define function to empty the in-memory index
+    def _reset(self):
+        # Dedupe keys, (segment, offset) pairs of each reputee's
+        # records, running aggregates of each reputee, and the number
+        # of records with each feature every reputer stored for each
+        # of its reputees
+        self.keys = set()
+        self.offsets = {}
+        self.aggregates = {}
+        self.reputers = {}
+
+    # ============================================= #
+
+    # Define function to open the engine
+    def open(self):
+        if not os.path.isdir(self.log_directory):
+            os.makedirs(self.log_directory)
+
+        # Stop other processes from opening the log
+        self.lock_file = os.open(os.path.join(self.log_directory, 'LOCK'), os.O_RDWR | os.O_CREAT)
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(self.lock_file)
+                raise RuntimeError("The log in " + self.log_directory + " is already open in another process.")
+
+        # Rebuild the index from the checkpoint and whatever was written after it
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(self.log_directory) if name.endswith('.seg'))
+        positions = self._load_checkpoint()
+        for segment in self.segments:
+            self._replay(segment, positions.get(segment, 0))
+
+        # Start a new segment if there is none to append to
+        if not self.segments:
+            self.segments.append(1)
+        self.active = open(self._segment_path(self.segments[-1]), 'ab')
+
+        # Start compacting in the background
+        self.stopping.clear()
+        self.compactor = threading.Thread(target=self._compact_periodically, name="log-compactor")
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    # ============================================= #
+
+    # Define function to close the engine
+    def close(self):
+        # Stop the compaction thread
+        self.stopping.set()
+        self.compactor.join()
+
+        with self.lock:
+            self.active.close()
+            self._write_checkpoint()
+            for reader in self.readers.values():
+                os.close(reader)
+            self.readers = {}
+
+        os.close(self.lock_file)
+
+    # ============================================= #
+
+    # Define function to hold the engine's lock while reading
+    @contextlib.contextmanager
+    def reading(self):
+        with self.lock:
+            yield
+
+    # ============================================= #
+
+    # Define function to hold the engine's lock while writing
+    @contextlib.contextmanager
+    def writing(self):
+        with self.lock:
+            try:
+                yield
+            finally:
+                self.active.flush()
+                # Seal the active segment once it is full
+                if self.active.tell() >= self.segment_size:
+                    self.active.close()
+                    self.segments.append(self.segments[-1] + 1)
+                    self.active = open(self._segment_path(self.segments[-1]), 'ab')
+
+    # ============================================= #
+
+    # Define function to remove every record
+    def clear(self):
+        # Tell any running compaction that its segments are gone
+        self.epoch += 1
+
+        # Delete every segment and the checkpoint
+        self.active.close()
+        for reader in self.readers.values():
+            os.close(reader)
+        self.readers = {}
+        for segment in self.segments:
+            os.remove(self._segment_path(segment))
+        if os.path.exists(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+        self._reset()
+
+        # Start a new segment with every version bumped, so nothing
+        # cached before the clear is reused
+        self.segments = [self.segments[-1] + 1]
+        self.active = open(self._segment_path(self.segments[-1]), 'ab')
+        for reputee in self.versions:
+            self.versions[reputee] += 1
+            self._append(VERSION + json.dumps([reputee, self.versions[reputee]]).encode('utf-8'))
+
+    # ============================================= #
+
+    # Define function to delete the engine's files
+    def remove(self):
+        if os.path.isdir(self.log_directory):
+            shutil.rmtree(self.log_directory)
+
+    # ============================================= #
+
+    # Define function to store a record if its key is new
+    def put_if_absent(self, key, record):
+        # Check if record is a duplicate
+        if key in self.keys:
+            return False
+
+        # Check the value before it is logged, since replaying a value
+        # that cannot be summed would stop the log from being opened
+        check_value(record.value)
+
+        # Append the record and add it to the index
+        payload = RECORD + json.dumps([record.reputer, record.reputee, record.rid, record.feature, record.value],
+                                      separators=(',', ':')).encode('utf-8')
+        offset = self._append(payload)
+        self._apply(payload, self.segments[-1], offset)
+        return True
+
+    # ============================================= #
+
+    # Define function to store a batch of records. Every value is checked
+    # before the first record is logged, so a record that cannot be stored
+    # fails the batch without logging any of it.
+    def put_many(self, items):
+        for _, record in items:
+            check_value(record.value)
+
+        return [self.put_if_absent(key, record) for key, record in items]
+
+    # ============================================= #
+
+    # Define function to check for a reputee
+    def has_reputee(self, reputee):
+        return reputee in self.offsets
+
+    # ============================================= #
+
+    # Define function to get a reputee's version
+    def get_version(self, reputee):
+        return self.versions.get(reputee, 0)
+
+    # ============================================= #
+
+    # Define function to get every reputee's version
+    def iter_versions(self):
+        return iter(list(self.versions.items()))
+
+    # ============================================= #
+
+    # Define function to raise reputees' versions, logging the new ones for the next replay
+    def raise_versions(self, versions):
+        for reputee, version in versions.items():
+            if version > self.versions.get(reputee, 0):
+                self.versions[reputee] = version
+                self._append(VERSION + json.dumps([reputee, version]).encode('utf-8'))
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's records
+    def get_keys(self, reputee):
+        return [record.key for record in self.get_reputes(reputee)]
+
+    # ============================================= #
+
+    # Define function to get a reputee's records
+    def get_reputes(self, reputee):
+        for segment, offset in self.offsets.get(reputee, []):
+            yield _record(self._read(segment, offset))
+
+    # ============================================= #
+
+    # Define function to get a page of a reputee's records
+    def get_reputes_page(self, reputee, start, limit, feature=None, reputer=None):
+        offsets = self.offsets.get(reputee, [])
+        end = min(len(offsets), start + limit)
+        records = []
+        for position in range(start, end):
+            record = _record(self._read(*offsets[position]))
+            if matches(record, feature, reputer):
+                records.append((position, record))
+
+        return records, end if end < len(offsets) else None
+
+    # ============================================= #
+
+    # Define function to get the number of records with each feature
+    # that a reputer stored for each of its reputees
+    def get_reputer_breakdown(self, reputer):
+        return dict((reputee, dict(breakdown)) for reputee, breakdown in self.reputers.get(reputer, {}).items())
+
+    # ============================================= #
+
+    # Define function to get every record
+    def iter_reputes(self):
+        for segment in list(self.segments):
+            for offset, payload in self._scan(segment, 0):
+                if payload[:1] == RECORD:
+                    record = _record(payload)
+                    if self._indexed(record.reputee, segment, offset):
+                        yield record
+
+    # ============================================= #
+
+    # Define function to get a batch of records from a cursor, which is the
+    # segment and offset of the first entry not read yet
+    def get_reputes_batch(self, cursor, limit):
+        self.active.flush()
+        start, position = (self.segments[0], 0) if cursor is None else cursor
+        records = []
+        for segment in [segment for segment in self.segments if segment >= start]:
+            for offset, payload in self._scan(segment, position if segment == start else 0):
+                if len(records) == limit:
+                    return records, (segment, offset)
+                if payload[:1] == RECORD:
+                    record = _record(payload)
+                    if self._indexed(record.reputee, segment, offset):
+                        records.append(record)
+
+        return records, None
+
+    # ============================================= #
+
+    # Define function to get the count and sum of a reputee's feature
+    def get_aggregate(self, reputee, feature):
+        return self.aggregates.get(reputee, {}).get(feature, (0, 0))
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees
+    def get_aggregates(self, reputees):
+        aggregates = {}
+        for reputee in reputees:
+            if reputee in self.aggregates:
+                aggregates[reputee] = dict(self.aggregates[reputee])
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to get every reputee's stored aggregates
+    def iter_aggregates(self):
+        for reputee in list(self.aggregates):
+            yield reputee, dict(self.aggregates[reputee])
+
+    # ============================================= #
+
+    # Define function to replace the in-memory aggregates and bump the
+    # versions of the reputees whose aggregates changed, logging them for
+    # the next replay
+    def replace_aggregates(self, aggregates):
+        changed = changed_reputees(self.aggregates, aggregates)
+        self.aggregates = dict((reputee, dict(aggregates[reputee])) for reputee in aggregates)
+        self.raise_versions(dict((reputee, self.versions.get(reputee, 0) + 1) for reputee in changed))
+        self.active.flush()
+
+    # ============================================= #
+
+    # Define function to rebuild the in-memory index by replaying every
+    # segment from the start, ignoring the checkpoint, and save a new one.
+    # Every segment is replayed whatever the partition, so the log is
+    # always rebuilt as a single partition.
+    def rebuild(self, partition=0, partitions=1):
+        if partitions != 1:
+            raise ValueError("The log engine is rebuilt as a single partition.")
+
+        with self.writing():
+            self.active.flush()
+            versions = self.versions
+            self._reset()
+            self.versions = {}
+            for segment in self.segments:
+                self._replay(segment, 0)
+
+            # Replaying counts versions up from 0, so continue from the higher of
+            # the old and replayed versions and log them for the next replay
+            for reputee in set(versions) | set(self.versions):
+                self.versions[reputee] = max(versions.get(reputee, 0), self.versions.get(reputee, 0)) + 1
+                self._append(VERSION + json.dumps([reputee, self.versions[reputee]]).encode('utf-8'))
+            self.active.flush()
+            self._write_checkpoint()
+
+        return self.aggregates
+
+    # ============================================= #
+
+    # Define function to append a payload to the active segment and return its offset
+    def _append(self, payload):
+        offset = self.active.tell()
+        self.active.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        return offset
+
+    # ============================================= #
+
+    # Define function to add a payload to the in-memory index
+    def _apply(self, payload, segment, offset):
+        if payload[:1] == MERGED:
+            return
+        if payload[:1] == VERSION:
+            reputee, version = json.loads(payload[1:].decode('utf-8'))
+            self.versions[reputee] = version
+            return
+
+        # Skip records already indexed, which a compaction interrupted
+        # before it removed the segments it merged can leave behind
+        reputer, reputee, rid, feature, value = json.loads(payload[1:].decode('utf-8'))
+        key = rid + "-" + reputer + "-" + reputee
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        self.offsets.setdefault(reputee, []).append((segment, offset))
+
+        # Update the reputee's running count and sum for the feature and bump its version
+        aggregate = self.aggregates.setdefault(reputee, {})
+        count, total = aggregate.get(feature, (0, 0))
+        aggregate[feature] = (count + 1, total + value)
+        self.versions[reputee] = self.versions.get(reputee, 0) + 1
+
+        # Count the record under its reputer
+        breakdown = self.reputers.setdefault(reputer, {}).setdefault(reputee, {})
+        breakdown[feature] = breakdown.get(feature, 0) + 1
+
+    # ============================================= #
+
+    # Define function to read a segment's entries from a position. A
+    # torn or corrupt entry ends the segment and is truncated away.
+    def _scan(self, segment, position, truncate=False):
+        with open(self._segment_path(segment), 'rb') as file:
+            file.seek(position)
+            while True:
+                header = file.read(HEADER.size)
+                if not header:
+                    return
+
+                payload = b''
+                if len(header) == HEADER.size:
+                    length, checksum = HEADER.unpack(header)
+                    payload = file.read(length)
+                if len(header) < HEADER.size or len(payload) < length or zlib.crc32(payload) != checksum:
+                    if truncate:
+                        os.truncate(self._segment_path(segment), position)
+                    return
+
+                yield position, payload
+                position += HEADER.size + length
+
+    # ============================================= #
+
+    # Define function to add a segment's entries from a position to the index
+    def _replay(self, segment, position):
+        for offset, payload in self._scan(segment, position, truncate=True):
+            self._apply(payload, segment, offset)
+
+    # ============================================= #
+
+    # Define function to read the payload of the entry at an offset
+    def _read(self, segment, offset):
+        if segment not in self.readers:
+            self.readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+
+        length = HEADER.unpack(os.pread(self.readers[segment], HEADER.size, offset))[0]
+        return os.pread(self.readers[segment], length, offset + HEADER.size)
+
+    # ============================================= #
+
+    # Define function to get the path of a segment
+    def _segment_path(self, segment):
+        return os.path.join(self.log_directory, '%08d.seg' % segment)
+
+    # ============================================= #
+
+    # Define function to get the path of the checkpoint
+    def _checkpoint_path(self):
+        return os.path.join(self.log_directory, 'checkpoint')
+
+    # ============================================= #
+
+    # Define function to save the in-memory index and the segment sizes it covers
+    def _write_checkpoint(self):
+        state = {"segments": dict((segment, os.path.getsize(self._segment_path(segment)))
+                                  for segment in self.segments if os.path.exists(self._segment_path(segment))),
+                 "keys": self.keys, "offsets": self.offsets, "aggregates": self.aggregates,
+                 "reputers": self.reputers, "versions": self.versions}
+
+        # Write to a temporary file first so a crash never leaves a partial checkpoint
+        temporary = self._checkpoint_path() + '.tmp'
+        with open(temporary, 'wb') as file:
+            pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self._checkpoint_path())
+
+    # ============================================= #
+
+    # Define function to load the checkpoint, returning the position in each
+    # segment that replay should start from
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path(), 'rb') as file:
+                state = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+
+        # Ignore checkpoints written before the reputer index existed
+        if "reputers" not in state:
+            return {}
+
+        # Ignore the checkpoint unless every segment it covers is still intact
+        for segment, size in state["segments"].items():
+            if segment not in self.segments or os.path.getsize(self._segment_path(segment)) < size:
+                return {}
+
+        self.keys = state["keys"]
+        self.offsets = state["offsets"]
+        self.aggregates = state["aggregates"]
+        self.reputers = state["reputers"]
+        self.versions = state["versions"]
+        return state["segments"]
+
+    # ============================================= #
+
+    # Define function to compact segments until the engine is closed
+    def _compact_periodically(self):
+        while not self.stopping.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except OSError:
+                # A clear can delete segments while they are being copied
+                pass
+
+    # ============================================= #
+
+    # Define function to merge the sealed segments that have not been
+    # compacted yet into one, leaving out the records the index does not
+    # point at (the duplicates an interrupted compaction leaves behind)
+    # and every version entry followed by a later one for its reputee.
+    # Merged segments are never merged again, so every entry is copied
+    # at most once. Returns whether anything was compacted.
+    def compact(self):
+        with self.lock:
+            epoch = self.epoch
+            segments = self.segments[:-1]
+        # Compaction merges every sealed segment after the last merged one,
+        # so the segments still to be merged are always at the end
+        sealed = []
+        for segment in reversed(segments):
+            if self._merged(segment):
+                break
+            sealed.insert(0, segment)
+        if len(sealed) < self.compaction_segments:
+            return False
+
+        with self.lock:
+            if epoch != self.epoch:
+                return False
+            merging = set(sealed)
+            indexed = set(location for locations in self.offsets.values() for location in locations
+                          if location[0] in merging)
+
+        # Find the last version entry of every reputee. Sealed segments
+        # are never written to, so no lock is needed.
+        versions = {}
+        for segment in sealed:
+            for offset, payload in self._scan(segment, 0):
+                if payload[:1] == VERSION:
+                    versions[json.loads(payload[1:].decode('utf-8'))[0]] = (segment, offset)
+        latest = set(versions.values())
+
+        # Copy the entries that are still needed into a new file
+        moved = {}
+        temporary = self._segment_path(sealed[0]) + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(HEADER.pack(len(MERGED), zlib.crc32(MERGED)) + MERGED)
+            for segment in sealed:
+                for offset, payload in self._scan(segment, 0):
+                    if (segment, offset) not in (indexed if payload[:1] == RECORD else latest):
+                        continue
+                    moved[(segment, offset)] = file.tell()
+                    file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+        with self.lock:
+            # Give up if the log was cleared in the meantime
+            if epoch != self.epoch:
+                os.remove(temporary)
+                return False
+
+            # Replace the first sealed segment with the new file and remove the
+            # rest. The checkpoint is removed first since it no longer matches,
+            # and replay skips the duplicates left if this is interrupted.
+            for segment in sealed:
+                if segment in self.readers:
+                    os.close(self.readers.pop(segment))
+            if os.path.exists(self._checkpoint_path()):
+                os.remove(self._checkpoint_path())
+            os.replace(temporary, self._segment_path(sealed[0]))
+            for segment in sealed[1:]:
+                os.remove(self._segment_path(segment))
+            start = self.segments.index(sealed[0])
+            self.segments[start:start + len(sealed)] = [sealed[0]]
+
+            # Point the index at the new file
+            for reputee in self.offsets:
+                self.offsets[reputee] = [(sealed[0], moved[location]) if location in moved else location
+                                         for location in self.offsets[reputee]]
+            self._write_checkpoint()
+
+        return True
+
+    # ============================================= #
+
+    # Define function to check if the index points at a record. A copy the
+    # index does not point at is a duplicate left by an interrupted
+    # compaction. Each reputee's locations are kept in log order, since
+    # records are appended in order and a compaction keeps their order, so
+    # they are bisected.
+    def _indexed(self, reputee, segment, offset):
+        locations = self.offsets.get(reputee, ())
+        position = bisect.bisect_left(locations, (segment, offset))
+        return position < len(locations) and locations[position] == (segment, offset)
+
+    # ============================================= #
+
+    # Define function to check if a segment was written by a compaction
+    def _merged(self, segment):
+        for _, payload in self._scan(segment, 0):
+            return payload == MERGED
+
+        return False
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to convert a record payload into a record
+def _record(payload):
+    return Repute(*json.loads(payload[1:].decode('utf-8')))
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
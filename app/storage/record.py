@@ -0,0 +1,229 @@
+# ================================================== #
+#                       RECORD                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+import pickle
+import struct
+import sys
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# Features stored as a code in the low 4 bits of the flags byte.
+# Any other feature is stored as a string after the value.
+FEATURES = ("reach", "clarity")
+FEATURE_CODES = {feature: code for code, feature in enumerate(FEATURES)}
+OTHER_FEATURE = 0x0F
+
+# Kinds of value stored in bits 4 and 5 of the flags byte
+INTEGER = 0x00
+FLOAT = 0x10
+PICKLED = 0x20
+
+# Flag set when the strings are stored in the record rather than
+# read back from the record's key
+EXPLICIT = 0x40
+
+# Record header: flags, then the UTF-8 lengths of the rid and reputer.
+# The flags byte never has its high bit set, which tells records apart
+# from the pickles stored by earlier versions (they start with 0x80).
+HEADER = struct.Struct('>BHH')
+LENGTH = struct.Struct('>H')
+INTEGER_VALUE = struct.Struct('>q')
+FLOAT_VALUE = struct.Struct('>d')
+
+# Longest rid, reputer or feature, in UTF-8 bytes, that a length field can hold
+MAX_STRING_LENGTH = 2 ** 16 - 1
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define repute object
+class Repute(object):
+    __slots__ = ('reputer', 'reputee', 'rid', 'feature', 'value')
+
+    # Define init function
+    def __init__(self, reputer, reputee, rid, feature, value):
+        self.reputer = reputer
+        self.reputee = reputee
+        self.rid = rid
+        self.feature = feature
+        self.value = value
+
+    # ============================================= #
+
+    # Define function to get the repute's dedupe key
+    @property
+    def key(self):
+        return self.rid + "-" + self.reputer + "-" + self.reputee
+
+    # ============================================= #
+
+    # Define function to convert the repute into the POST format
+    def to_dict(self):
+        return {"reputer": self.reputer,
+                "reputee": self.reputee,
+                "repute": {"rid": self.rid, "feature": self.feature, "value": self.value}}
+
+    # ============================================= #
+
+    # Define function to create a repute from the POST format
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record['reputer'], record['reputee'], record['repute']['rid'], record['repute']['feature'],
+                   record['repute']['value'])
+
+    # ============================================= #
+
+    # Define function to compare reputes
+    def __eq__(self, other):
+        return isinstance(other, Repute) and all(getattr(self, name) == getattr(other, name)
+                                                 for name in self.__slots__)
+
+    # ============================================= #
+
+    # Define function to describe the repute
+    def __repr__(self):
+        return "Repute(%r, %r, %r, %r, %r)" % (self.reputer, self.reputee, self.rid, self.feature, self.value)
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to serialize a repute stored under the given key.
+# When the key is the repute's own key its strings are left out.
+def encode(repute, key=None):
+    rid = repute.rid.encode('utf-8')
+    reputer = repute.reputer.encode('utf-8')
+    flags = FEATURE_CODES.get(repute.feature, OTHER_FEATURE)
+    explicit = key != repute.key
+    if explicit:
+        flags |= EXPLICIT
+
+    # Store integers and floats as fixed-width numbers, and anything else as a pickle
+    value = repute.value
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        packed = INTEGER_VALUE.pack(value)
+    elif type(value) is float:
+        flags |= FLOAT
+        packed = FLOAT_VALUE.pack(value)
+    else:
+        flags |= PICKLED
+        pickled = pickle.dumps(value)
+        packed = LENGTH.pack(len(pickled)) + pickled
+
+    parts = [HEADER.pack(flags, len(rid), len(reputer)), packed]
+    if flags & 0x0F == OTHER_FEATURE:
+        feature = repute.feature.encode('utf-8')
+        parts.extend((LENGTH.pack(len(feature)), feature))
+    if explicit:
+        parts.extend((rid, reputer, repute.reputee.encode('utf-8')))
+
+    return b''.join(parts)
+
+# ================================================== #
+
+
+# Define function to deserialize a repute stored under the given key.
+# Pickled records written by earlier versions are also accepted.
+def decode(key, data):
+    if data[:1] == b'\x80':
+        return Repute.from_dict(pickle.loads(data))
+
+    flags, rid_length, reputer_length = HEADER.unpack_from(data)
+    position = HEADER.size
+
+    # Read the value
+    kind = flags & 0x30
+    if kind == INTEGER:
+        value = INTEGER_VALUE.unpack_from(data, position)[0]
+        position += INTEGER_VALUE.size
+    elif kind == FLOAT:
+        value = FLOAT_VALUE.unpack_from(data, position)[0]
+        position += FLOAT_VALUE.size
+    else:
+        length = LENGTH.unpack_from(data, position)[0]
+        position += LENGTH.size
+        value = pickle.loads(data[position:position + length])
+        position += length
+
+    # Read the feature
+    if flags & 0x0F == OTHER_FEATURE:
+        length = LENGTH.unpack_from(data, position)[0]
+        position += LENGTH.size
+        feature = sys.intern(data[position:position + length].decode('utf-8'))
+        position += length
+    else:
+        feature = FEATURES[flags & 0x0F]
+
+    # Read the strings from the record or the key, which is "rid-reputer-reputee"
+    if flags & EXPLICIT:
+        strings = data[position:]
+        separator = 0
+    else:
+        strings = key.encode('utf-8') if isinstance(key, str) else key
+        separator = 1
+    reputer_start = rid_length + separator
+    reputee_start = reputer_start + reputer_length + separator
+    return Repute(sys.intern(strings[reputer_start:reputee_start - separator].decode('utf-8')),
+                  sys.intern(strings[reputee_start:].decode('utf-8')),
+                  strings[:rid_length].decode('utf-8'), feature, value)
+
+# ================================================== #
+
+
+# Define function to read the reputee of a stored record without
+# decoding the rest of it, which a rebuild does for every record
+def read_reputee(key, data):
+    if data[:1] == b'\x80' or data[0] & EXPLICIT:
+        return decode(key, data).reputee
+
+    rid_length, reputer_length = HEADER.unpack_from(data)[1:]
+    strings = key.encode('utf-8') if isinstance(key, str) else key
+    return strings[rid_length + reputer_length + 2:].decode('utf-8')
+
+# ================================================== #
+
+
+# Define function to check that a repute's rid, reputer and feature fit
+# in the record's length fields. Raises ValueError otherwise.
+def check_strings(rid, reputer, feature):
+    if any(len(string.encode('utf-8')) > MAX_STRING_LENGTH for string in (rid, reputer, feature)):
+        raise ValueError("The rid, reputer and feature of a repute must be at most " + str(MAX_STRING_LENGTH) +
+                         " bytes long.")
+
+# ================================================== #
+
+
+# Define function to check that a repute's value is a number, since it
+# is added to its reputee's running sums. Raises TypeError otherwise, and
+# ValueError for an integer that every engine cannot store as 64 bits.
+def check_value(value):
+    if type(value) not in (int, float):
+        raise TypeError("The value of a repute must be a number, not " + type(value).__name__ + ".")
+    if type(value) is int and not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError("The value of a repute must fit in a 64-bit integer.")
+
+# ================================================== #
+
+
+# Define function to check if a stored value was written by an earlier version
+def is_legacy(data):
+    return data[:1] == b'\x80'
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
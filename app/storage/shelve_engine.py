@@ -0,0 +1,687 @@
+# ================================================== #
+#                    SHELVE ENGINE                   #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+from app.metrics import REGISTRY
+from app.storage.bloom import BloomFilter
+from app.storage import record as record_format
+from app.storage.record import check_value
+from app.storage.engine import changed_reputees, Engine, matches, partition_index
+import contextlib
+import dbm
+import glob
+import os
+import pickle
+import shelve
+import struct
+
+# fcntl is only available on POSIX systems. Without it the
+# shelve engine can only be used by a single process.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# dbm.gnu is only available where Python was built with
+# gdbm. dbm.open prefers it to every other module.
+try:
+    import dbm.gnu as gdbm
+except ImportError:
+    gdbm = None
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# Entries of a list stored in a dbm database. The length of a list
+# is stored under COUNT + name, and its item at each position under
+# POSITION + position + name, so adding an item or reading a few never
+# loads the whole list. The reputee index (keys.db) holds the list of
+# every reputee's record keys.
+COUNT = b'n'
+POSITION = b'k'
+POSITION_FORMAT = struct.Struct('>Q')
+
+# The reputer index (reputers.db) holds the list of every reputer's
+# reputees, and the number of records with each feature that the
+# reputer stored for each of them under BREAKDOWN + the reputer's
+# length + reputer + reputee
+BREAKDOWN = b'b'
+LENGTH_FORMAT = struct.Struct('>I')
+
+# Databases used by every version of the engine
+DATABASES = ('data.db', 'keys.db', 'reputers.db', 'aggregates.db', 'versions.db')
+
+# Reputee index of earlier versions, which stored every reputee's keys as one pickled list
+LEGACY_INDEX = 'index.db'
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define shelve storage engine object
+class ShelveEngine(Engine):
+
+    # Number of reputes the duplicate filter is sized for (0 disables it)
+    bloom_capacity = 1000000
+    # Chance that the duplicate filter mistakes a new repute for a stored one
+    bloom_error_rate = 0.01
+
+    # Define init function
+    def __init__(self, directory, prefix):
+        super(ShelveEngine, self).__init__(directory, prefix)
+        # Create variables to hold the database, reputee index, running aggregates and reputee versions
+        self.db = None
+        self.index = None
+        self.reputers = None
+        self.aggregates = None
+        self.versions = None
+        # Create variables to hold the lock file and the generation of the open shelves
+        self.lock_file = None
+        self.generation = 0
+        # Create a variable to hold the filter of stored keys
+        self.bloom = None
+
+    # ============================================= #
+
+    # Define function to open the engine
+    def open(self):
+        # The lock file holds a generation counter that every
+        # write increments, so other processes holding the
+        # shelves open can tell when their view is stale.
+        self.lock_file = os.open(self.path('data.lock'), os.O_RDWR | os.O_CREAT)
+
+        # Open the filter of stored keys, filling it from the database if it was missing
+        if self.bloom_capacity > 0:
+            self.bloom = BloomFilter(self.path('dedupe.bloom'), self.bloom_capacity, self.bloom_error_rate)
+            with self._locked(fcntl and fcntl.LOCK_EX):
+                if self.bloom.open():
+                    self._refresh()
+                    for key in self.db.keys():
+                        self.bloom.add(key.decode('utf-8'))
+
+        # Check if the database predates the index and aggregates
+        with self.reading():
+            outdated = len(self.db) != 0 and (len(self.index) == 0 or len(self.reputers) == 0 or
+                                              len(self.aggregates) == 0)
+
+        # Build the index and aggregates if they are missing
+        if outdated:
+            with self.writing():
+                if len(self.index) == 0 or len(self.reputers) == 0:
+                    self.rebuild_index()
+                    self._remove_files([LEGACY_INDEX])
+                if len(self.aggregates) == 0:
+                    self.replace_aggregates(self.compute_aggregates())
+
+    # ============================================= #
+
+    # Define function to hold a shared lock while reading
+    @contextlib.contextmanager
+    def reading(self):
+        with self._locked(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            yield
+
+    # ============================================= #
+
+    # Define function to hold an exclusive lock while writing
+    @contextlib.contextmanager
+    def writing(self):
+        with self._locked(fcntl and fcntl.LOCK_EX):
+            self._refresh()
+            try:
+                yield
+            finally:
+                # Flush the writes and tell other processes about them
+                for shelf in self._shelves():
+                    if hasattr(shelf, 'sync'):
+                        shelf.sync()
+                self.generation += 1
+                os.lseek(self.lock_file, 0, os.SEEK_SET)
+                os.write(self.lock_file, self.generation.to_bytes(8, 'big'))
+
+    # ============================================= #
+
+    # Define function to hold the lock file
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        if fcntl is None:
+            yield
+            return
+
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    # ============================================= #
+
+    # Define function to reopen the shelves if another process has written to them
+    def _refresh(self):
+        generation = self._read_generation()
+        if self.db is not None and generation == self.generation:
+            return
+
+        if self.db is not None:
+            self._discard_shelves()
+        self._open_shelves('c')
+        self.generation = generation
+
+    # ============================================= #
+
+    # Define function to open the shelves. Records are stored in
+    # data.db in the compact binary format rather than pickled, and
+    # keys.db and reputers.db hold raw index entries, so they are
+    # opened as plain dbm databases instead of shelves.
+    def _open_shelves(self, flag):
+        self.db = open_database(self.path('data.db'), flag)
+        self.index = open_database(self.path('keys.db'), flag)
+        self.reputers = open_database(self.path('reputers.db'), flag)
+        self.aggregates = shelve.Shelf(open_database(self.path('aggregates.db'), flag))
+        # Versions are never recreated empty, so they keep counting up across clears
+        self.versions = shelve.Shelf(open_database(self.path('versions.db'), 'c'))
+
+    # ============================================= #
+
+    # Define function to get every open shelf
+    def _shelves(self):
+        return (self.db, self.index, self.reputers, self.aggregates, self.versions)
+
+    # ============================================= #
+
+    # Define function to read the generation counter from the lock file
+    def _read_generation(self):
+        os.lseek(self.lock_file, 0, os.SEEK_SET)
+        return int.from_bytes(os.read(self.lock_file, 8), 'big')
+
+    # ============================================= #
+
+    # Define function to close stale shelves without writing them back.
+    # dbm.dumb rewrites its directory file from memory when closed, which
+    # would undo any writes other processes made since it was opened.
+    def _discard_shelves(self):
+        for shelf in self._shelves():
+            database = getattr(shelf, 'dict', shelf)
+            if hasattr(database, '_modified'):
+                database._modified = False
+            shelf.close()
+
+    # ============================================= #
+
+    # Define function to close the shelves
+    def _close_shelves(self):
+        for shelf in self._shelves():
+            shelf.close()
+
+    # ============================================= #
+
+    # Define function to close the engine
+    def close(self):
+        with self._locked(fcntl and fcntl.LOCK_EX):
+            if self._read_generation() == self.generation:
+                self._close_shelves()
+            else:
+                self._discard_shelves()
+        if self.bloom is not None:
+            self.bloom.close()
+        os.close(self.lock_file)
+
+    # ============================================= #
+
+    # Define function to remove every record
+    def clear(self):
+        # Recreate the shelves empty rather than deleting keys one at a
+        # time, since dbm.dumb rewrites its directory file on every delete
+        self._close_shelves()
+        self._open_shelves('n')
+        if self.bloom is not None:
+            self.bloom.clear()
+
+        # Bump every version so nothing cached before the clear is reused
+        for reputee in list(self.versions):
+            self.versions[reputee] += 1
+
+    # ============================================= #
+
+    # Define function to delete the engine's files
+    def remove(self):
+        self._remove_files(DATABASES + (LEGACY_INDEX,))
+        for name in ('data.lock', 'dedupe.bloom'):
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+
+    # ============================================= #
+
+    # Define function to delete databases. Each dbm module names its
+    # files differently, so anything starting with a database's name
+    # is deleted.
+    def _remove_files(self, names):
+        for name in names:
+            for path in glob.glob(glob.escape(self.path(name)) + '*'):
+                os.remove(path)
+
+    # ============================================= #
+
+    # Define function to store a record if its key is new
+    def put_if_absent(self, key, record):
+        check_value(record.value)
+        return self._put(key, record, record_format.encode(record, key))
+
+    # ============================================= #
+
+    # Define function to store a batch of records. Every record is checked
+    # and encoded before the first is written, so a record that cannot be
+    # stored fails the batch without storing any of it.
+    def put_many(self, items):
+        encoded = []
+        for key, record in items:
+            check_value(record.value)
+            encoded.append((key, record, record_format.encode(record, key)))
+
+        return [self._put(key, record, data) for key, record, data in encoded]
+
+    # ============================================= #
+
+    # Define function to store a checked and encoded record if its key is new
+    def _put(self, key, record, data):
+        # Check if record is a duplicate. Keys the filter has not seen are
+        # definitely new, so only possible duplicates are looked up.
+        if self.bloom is not None and self.bloom.add(key):
+            REGISTRY.increment("reputation_storage_dedupe_filter_total", labels=(("result", "new"),))
+        else:
+            if self.bloom is not None:
+                REGISTRY.increment("reputation_storage_dedupe_filter_total", labels=(("result", "maybe"),))
+            if key in self.db:
+                return False
+
+        # Calculate the reputee's running count and sum for the feature
+        reputee = record.reputee
+        aggregate = self.aggregates.get(reputee, {})
+        count, total = aggregate.get(record.feature, (0, 0))
+        aggregate[record.feature] = (count + 1, total + record.value)
+
+        # Store record, record its key at the end of the reputee's index and count it under its reputer
+        self.db[key] = data
+        self._append(self.index, reputee.encode('utf-8'), key.encode('utf-8'))
+        self._count_reputer(record.reputer.encode('utf-8'), reputee.encode('utf-8'), record.feature)
+        self.aggregates[reputee] = aggregate
+
+        # Bump the reputee's version
+        self.versions[reputee] = self.versions.get(reputee, 0) + 1
+        return True
+
+    # ============================================= #
+
+    # Define function to add an item to the end of a list in a database
+    def _append(self, database, name, item):
+        count = self._length(database, name)
+        database[POSITION + POSITION_FORMAT.pack(count) + name] = item
+        database[COUNT + name] = str(count + 1).encode('ascii')
+
+    # ============================================= #
+
+    # Define function to get the length of a list in a database
+    def _length(self, database, name):
+        return int(database.get(COUNT + name, b'0'))
+
+    # ============================================= #
+
+    # Define function to get the item at a position of a list in a database
+    def _item(self, database, name, position):
+        return database[POSITION + POSITION_FORMAT.pack(position) + name]
+
+    # ============================================= #
+
+    # Define function to get every item of a list in a database
+    def _items(self, database, name):
+        return [self._item(database, name, position) for position in range(self._length(database, name))]
+
+    # ============================================= #
+
+    # Define function to replace every item of a list in a database,
+    # removing the list if there are none
+    def _replace_list(self, database, name, items):
+        for position, item in enumerate(items):
+            database[POSITION + POSITION_FORMAT.pack(position) + name] = item
+        for position in range(len(items), self._length(database, name)):
+            entry = POSITION + POSITION_FORMAT.pack(position) + name
+            if entry in database:
+                del database[entry]
+
+        if items:
+            database[COUNT + name] = str(len(items)).encode('ascii')
+        elif COUNT + name in database:
+            del database[COUNT + name]
+
+    # ============================================= #
+
+    # Define function to count a record under its reputer and reputee
+    def _count_reputer(self, reputer, reputee, feature):
+        entry = BREAKDOWN + LENGTH_FORMAT.pack(len(reputer)) + reputer + reputee
+        breakdown = self.reputers.get(entry)
+        if breakdown is None:
+            # Add the reputee to the reputer's list the first time the reputer reputes it
+            self._append(self.reputers, reputer, reputee)
+            breakdown = {}
+        else:
+            breakdown = pickle.loads(breakdown)
+
+        breakdown[feature] = breakdown.get(feature, 0) + 1
+        self.reputers[entry] = pickle.dumps(breakdown, pickle.HIGHEST_PROTOCOL)
+
+    # ============================================= #
+
+    # Define function to check for a reputee
+    def has_reputee(self, reputee):
+        return COUNT + reputee.encode('utf-8') in self.index
+
+    # ============================================= #
+
+    # Define function to get a reputee's version
+    def get_version(self, reputee):
+        return self.versions.get(reputee, 0)
+
+    # ============================================= #
+
+    # Define function to get every reputee's version
+    def iter_versions(self):
+        for reputee in list(self.versions):
+            yield reputee, self.versions[reputee]
+
+    # ============================================= #
+
+    # Define function to raise reputees' versions
+    def raise_versions(self, versions):
+        for reputee, version in versions.items():
+            if version > self.versions.get(reputee, 0):
+                self.versions[reputee] = version
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's records
+    def get_keys(self, reputee):
+        reputee = reputee.encode('utf-8')
+        return [self._item(self.index, reputee, position).decode('utf-8')
+                for position in range(self._length(self.index, reputee))]
+
+    # ============================================= #
+
+    # Define function to get a reputee's records
+    def get_reputes(self, reputee):
+        for key in self.get_keys(reputee):
+            yield record_format.decode(key, self.db[key])
+
+    # ============================================= #
+
+    # Define function to get a page of a reputee's records. Positions are
+    # read straight from the index, so only the page's records are loaded.
+    def get_reputes_page(self, reputee, start, limit, feature=None, reputer=None):
+        encoded = reputee.encode('utf-8')
+        count = self._length(self.index, encoded)
+        end = min(count, start + limit)
+        records = []
+        for position in range(start, end):
+            key = self._item(self.index, encoded, position)
+            record = record_format.decode(key, self.db[key])
+            if matches(record, feature, reputer):
+                records.append((position, record))
+
+        return records, end if end < count else None
+
+    # ============================================= #
+
+    # Define function to get the number of records with each feature
+    # that a reputer stored for each of its reputees
+    def get_reputer_breakdown(self, reputer):
+        encoded = reputer.encode('utf-8')
+        prefix = BREAKDOWN + LENGTH_FORMAT.pack(len(encoded)) + encoded
+        breakdown = {}
+        for position in range(self._length(self.reputers, encoded)):
+            reputee = self._item(self.reputers, encoded, position)
+            breakdown[reputee.decode('utf-8')] = pickle.loads(self.reputers[prefix + reputee])
+
+        return breakdown
+
+    # ============================================= #
+
+    # Define function to get every record
+    def iter_reputes(self):
+        for key in self._iter_keys():
+            yield record_format.decode(key, self.db[key])
+
+    # ============================================= #
+
+    # Define function to get a batch of records from a cursor. gdbm walks
+    # its keys with firstkey and nextkey, so the cursor is the last key
+    # read. Other dbm modules keep every key in memory anyway, so the
+    # cursor holds a list of the keys and the position reached in it.
+    def get_reputes_batch(self, cursor, limit):
+        records = []
+        if hasattr(self.db, 'firstkey'):
+            key = self.db.firstkey() if cursor is None else self.db.nextkey(cursor)
+            while key is not None and len(records) < limit:
+                records.append(record_format.decode(key, self.db[key]))
+                cursor, key = key, self.db.nextkey(key)
+            return records, None if key is None else cursor
+
+        keys, position = (list(self.db.keys()), 0) if cursor is None else cursor
+        for key in keys[position:position + limit]:
+            records.append(record_format.decode(key, self.db[key]))
+        position += len(records)
+        return records, (keys, position) if position < len(keys) else None
+
+    # ============================================= #
+
+    # Define function to iterate over the keys of the records. gdbm walks
+    # them one at a time rather than building a list of every key.
+    def _iter_keys(self):
+        if not hasattr(self.db, 'firstkey'):
+            yield from self.db.keys()
+            return
+
+        key = self.db.firstkey()
+        while key is not None:
+            yield key
+            key = self.db.nextkey(key)
+
+    # ============================================= #
+
+    # Define function to get the count and sum of a reputee's feature
+    def get_aggregate(self, reputee, feature):
+        return self.aggregates.get(reputee, {}).get(feature, (0, 0))
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees
+    def get_aggregates(self, reputees):
+        aggregates = {}
+        for reputee in reputees:
+            if reputee in self.aggregates:
+                aggregates[reputee] = self.aggregates[reputee]
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to get every reputee's stored aggregates
+    def iter_aggregates(self):
+        for reputee in self.aggregates:
+            yield reputee, self.aggregates[reputee]
+
+    # ============================================= #
+
+    # Define function to replace the stored aggregates and bump the
+    # versions of the reputees whose aggregates changed
+    def replace_aggregates(self, aggregates):
+        changed = changed_reputees(dict(self.iter_aggregates()), aggregates)
+        self.aggregates.clear()
+        for reputee in aggregates:
+            self.aggregates[reputee] = aggregates[reputee]
+        for reputee in changed:
+            self.versions[reputee] = self.versions.get(reputee, 0) + 1
+
+    # ============================================= #
+
+    # Define function to rebuild the reputee and reputer indexes from the
+    # database. The records do not say when they were stored, so each list
+    # is rebuilt in the database's key order rather than insertion order.
+    def rebuild_index(self):
+        for database in (self.index, self.reputers):
+            for entry in list(database.keys()):
+                del database[entry]
+
+        for key in self._iter_keys():
+            record = record_format.decode(key, self.db[key])
+            reputee = record.reputee.encode('utf-8')
+            self._append(self.index, reputee, key)
+            self._count_reputer(record.reputer.encode('utf-8'), reputee, record.feature)
+
+    # ============================================= #
+
+    # Define function to rebuild the indexes, aggregates and duplicate
+    # filter entries of a partition's reputees. The records are scanned
+    # under the shared lock, so the partitions of a shard are scanned side
+    # by side, and only writing the results takes the exclusive lock.
+    # Records are only ever added, so if their number changed in between
+    # the partition is scanned again under the exclusive lock.
+    def rebuild(self, partition=0, partitions=1):
+        with self.reading():
+            count = len(self.db)
+            scan = self._scan_partition(partition, partitions)
+
+        with self.writing():
+            if len(self.db) != count:
+                scan = self._scan_partition(partition, partitions)
+            self._write_partition(partition, partitions, *scan)
+
+        return scan[2]
+
+    # ============================================= #
+
+    # Define function to collect the keys, reputer breakdowns and aggregates
+    # of a partition's reputees in one pass over the records. Only the
+    # header of another partition's record is read to find its reputee.
+    # As in rebuild_index, keys are listed in the database's key order.
+    def _scan_partition(self, partition, partitions):
+        keys = {}
+        breakdowns = {}
+        aggregates = {}
+        for key in self._iter_keys():
+            data = self.db[key]
+            if partitions > 1 and partition_index(record_format.read_reputee(key, data), partitions) != partition:
+                continue
+
+            record = record_format.decode(key, data)
+            keys.setdefault(record.reputee, []).append(key)
+            breakdown = breakdowns.setdefault((record.reputer, record.reputee), {})
+            breakdown[record.feature] = breakdown.get(record.feature, 0) + 1
+            aggregate = aggregates.setdefault(record.reputee, {})
+            count, total = aggregate.get(record.feature, (0, 0))
+            aggregate[record.feature] = (count + 1, total + record.value)
+
+        return keys, breakdowns, aggregates
+
+    # ============================================= #
+
+    # Define function to replace the derived entries of a partition's
+    # reputees with a scan's, removing those of reputees with no records
+    def _write_partition(self, partition, partitions, keys, breakdowns, aggregates):
+        # Replace the reputee index
+        for entry in list(self.index.keys()):
+            if entry[:1] == COUNT:
+                reputee = entry[1:].decode('utf-8')
+                if reputee not in keys and partition_index(reputee, partitions) == partition:
+                    self._replace_list(self.index, entry[1:], [])
+        for reputee in keys:
+            self._replace_list(self.index, reputee.encode('utf-8'), keys[reputee])
+
+        # Replace the reputer breakdowns, grouping the reputees no longer
+        # reputed and the newly reputed ones by reputer, so each reputer's
+        # list is read and written once
+        stale = {}
+        added = {}
+        for entry in list(self.reputers.keys()):
+            if entry[:1] == BREAKDOWN:
+                start = 1 + LENGTH_FORMAT.size + LENGTH_FORMAT.unpack_from(entry, 1)[0]
+                reputer, reputee = entry[1 + LENGTH_FORMAT.size:start], entry[start:]
+                if ((reputer.decode('utf-8'), reputee.decode('utf-8')) not in breakdowns and
+                        partition_index(reputee.decode('utf-8'), partitions) == partition):
+                    del self.reputers[entry]
+                    stale.setdefault(reputer, set()).add(reputee)
+        for (reputer, reputee), breakdown in breakdowns.items():
+            reputer, reputee = reputer.encode('utf-8'), reputee.encode('utf-8')
+            entry = BREAKDOWN + LENGTH_FORMAT.pack(len(reputer)) + reputer + reputee
+            if entry not in self.reputers:
+                added.setdefault(reputer, []).append(reputee)
+            self.reputers[entry] = pickle.dumps(breakdown, pickle.HIGHEST_PROTOCOL)
+        for reputer in set(stale) | set(added):
+            reputees = [reputee for reputee in self._items(self.reputers, reputer)
+                        if reputee not in stale.get(reputer, ())]
+            listed = set(reputees)
+            reputees.extend(reputee for reputee in added.get(reputer, []) if reputee not in listed)
+            self._replace_list(self.reputers, reputer, reputees)
+
+        # Replace the aggregates and bump the versions
+        for reputee in list(self.aggregates):
+            if reputee not in aggregates and partition_index(reputee, partitions) == partition:
+                del self.aggregates[reputee]
+        for reputee in aggregates:
+            self.aggregates[reputee] = aggregates[reputee]
+            self.versions[reputee] = self.versions.get(reputee, 0) + 1
+
+        # Add the keys to the duplicate filter. Bits left by keys that are
+        # gone only cost a lookup, so the filter is not cleared.
+        if self.bloom is not None:
+            for reputee in keys:
+                for key in keys[reputee]:
+                    self.bloom.add(key.decode('utf-8'))
+        self._remove_files([LEGACY_INDEX])
+
+    # ============================================= #
+
+    # Define function to convert pickled records to the compact format in place
+    def migrate(self):
+        converted = 0
+        for key in self.db.keys():
+            data = self.db[key]
+            if record_format.is_legacy(data):
+                self.db[key] = record_format.encode(record_format.decode(key, data), key.decode('utf-8'))
+                converted += 1
+
+        # Reclaim the space freed by the smaller records if the database supports it
+        if converted and hasattr(self.db, 'reorganize'):
+            self.db.reorganize()
+
+        return converted
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to open a dbm database. gdbm takes its own lock on
+# every file it opens for writing, which would stop a second worker
+# from opening the database while the first holds it open, so gdbm
+# files are opened unlocked and the lock file serializes access instead.
+def open_database(path, flag):
+    module = None if flag == 'n' else dbm.whichdb(path)
+    if gdbm is not None and module in (None, 'dbm.gnu'):
+        return gdbm.open(path, flag + 'u')
+
+    return dbm.open(path, flag)
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
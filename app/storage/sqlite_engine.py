@@ -0,0 +1,417 @@
+# ================================================== #
+#                    SQLITE ENGINE                   #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+from app.storage.engine import changed_reputees, Engine, partition_index
+from app.storage.record import Repute
+import os
+import sqlite3
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+# Records are keyed by the rid-reputer-reputee dedupe key
+# and indexed by reputee, while the aggregates table holds
+# the running count and sum of every reputee's features.
+# The versions table counts changes to each reputee and
+# is never emptied, so versions keep counting up across
+# clears. Values and totals have no declared type, so
+# SQLite keeps each one as the integer or float it was
+# given, as the other engines do, instead of turning
+# 5.0 into 5 (NUMERIC) or 5 into 5.0 (REAL).
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reputes (
+    key TEXT PRIMARY KEY,
+    reputer TEXT NOT NULL,
+    reputee TEXT NOT NULL,
+    rid TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    value NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reputes_reputee ON reputes (reputee);
+CREATE INDEX IF NOT EXISTS reputes_reputer ON reputes (reputer, reputee);
+CREATE TABLE IF NOT EXISTS aggregates (
+    reputee TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total NOT NULL,
+    PRIMARY KEY (reputee, feature)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    reputee TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+# Largest number of parameters bound to a single query
+MAX_PARAMETERS = 500
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define SQLite storage engine object
+class SQLiteEngine(Engine):
+
+    # Define init function
+    def __init__(self, directory, prefix):
+        super(SQLiteEngine, self).__init__(directory, prefix)
+        # Create a variable to hold the database connection
+        self.connection = None
+
+    # ============================================= #
+
+    # Define function to open the engine
+    def open(self):
+        # Transactions are managed explicitly, so autocommit mode is used.
+        # The connection may be shared by threads since Data serializes access to it.
+        self.connection = sqlite3.connect(self.path('data.sqlite'), timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+        # WAL mode lets readers run alongside a writer in another process
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        # Let queries pick out the reputees of a partition during a rebuild
+        self.connection.create_function("partition_index", 2, partition_index)
+
+    # ============================================= #
+
+    # Define function to close the engine
+    def close(self):
+        self.connection.close()
+
+    # ============================================= #
+
+    # Define function to remove every record
+    def clear(self):
+        with self.transaction():
+            self.connection.execute("DELETE FROM reputes")
+            self.connection.execute("DELETE FROM aggregates")
+            # Bump every version so nothing cached before the clear is reused
+            self.connection.execute("UPDATE versions SET version = version + 1")
+
+    # ============================================= #
+
+    # Define function to delete the engine's files
+    def remove(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path('data.sqlite') + suffix):
+                os.remove(self.path('data.sqlite') + suffix)
+
+    # ============================================= #
+
+    # Define function to run statements in a single write transaction
+    def transaction(self):
+        return _Transaction(self.connection)
+
+    # ============================================= #
+
+    # Define function to store a record if its key is new
+    def put_if_absent(self, key, record):
+        with self.transaction():
+            return self._insert(key, record)
+
+    # ============================================= #
+
+    # Define function to store a batch of records in a single transaction
+    def put_many(self, items):
+        with self.transaction():
+            return [self._insert(key, record) for key, record in items]
+    # ============================================= #
+
+    # Define function to insert a record inside an open transaction
+    def _insert(self, key, record):
+        reputee = record.reputee
+        feature = record.feature
+        value = record.value
+
+        # The primary key on the dedupe key discards duplicates. Unlike OR IGNORE,
+        # ON CONFLICT only covers the key, so a NULL value still raises an error.
+        cursor = self.connection.execute("INSERT INTO reputes VALUES (?, ?, ?, ?, ?, ?) "
+                                         "ON CONFLICT (key) DO NOTHING",
+                                         (key, record.reputer, reputee, record.rid, feature, value))
+        if cursor.rowcount == 0:
+            return False
+
+        # Update the reputee's running count and sum for the feature
+        self.connection.execute("INSERT INTO aggregates VALUES (?, ?, 1, ?) "
+                                "ON CONFLICT (reputee, feature) DO UPDATE SET "
+                                "count = count + 1, total = total + excluded.total",
+                                (reputee, feature, value))
+
+        # Bump the reputee's version
+        self.connection.execute("INSERT INTO versions VALUES (?, 1) "
+                                "ON CONFLICT (reputee) DO UPDATE SET version = version + 1", (reputee,))
+        return True
+
+    # ============================================= #
+
+    # Define function to check for a reputee
+    def has_reputee(self, reputee):
+        cursor = self.connection.execute("SELECT 1 FROM reputes WHERE reputee = ? LIMIT 1", (reputee,))
+        return cursor.fetchone() is not None
+
+    # ============================================= #
+
+    # Define function to get a reputee's version
+    def get_version(self, reputee):
+        cursor = self.connection.execute("SELECT version FROM versions WHERE reputee = ?", (reputee,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    # ============================================= #
+
+    # Define function to get every reputee's version
+    def iter_versions(self):
+        return iter(self.connection.execute("SELECT reputee, version FROM versions").fetchall())
+
+    # ============================================= #
+
+    # Define function to raise reputees' versions
+    def raise_versions(self, versions):
+        with self.transaction():
+            self.connection.executemany("INSERT INTO versions VALUES (?, ?) ON CONFLICT (reputee) DO UPDATE SET "
+                                        "version = max(version, excluded.version)", versions.items())
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's records
+    def get_keys(self, reputee):
+        cursor = self.connection.execute("SELECT key FROM reputes WHERE reputee = ? ORDER BY rowid", (reputee,))
+        return [row[0] for row in cursor]
+
+    # ============================================= #
+
+    # Define function to get a reputee's records
+    def get_reputes(self, reputee):
+        cursor = self.connection.execute("SELECT reputer, reputee, rid, feature, value FROM reputes "
+                                         "WHERE reputee = ? ORDER BY rowid", (reputee,))
+        for row in cursor:
+            yield Repute(*row)
+
+    # ============================================= #
+
+    # Define function to get a page of a reputee's records. Positions are
+    # rowids, so each page is a range scan of the reputee's index (or of
+    # the reputer index when filtering by reputer).
+    def get_reputes_page(self, reputee, start, limit, feature=None, reputer=None):
+        query = "SELECT rowid, reputer, reputee, rid, feature, value FROM reputes WHERE reputee = ? AND rowid >= ?"
+        parameters = [reputee, start]
+        if feature is not None:
+            query += " AND feature = ?"
+            parameters.append(feature)
+        if reputer is not None:
+            query += " AND reputer = ?"
+            parameters.append(reputer)
+
+        rows = self.connection.execute(query + " ORDER BY rowid LIMIT ?", parameters + [limit]).fetchall()
+        records = [(row[0], Repute(*row[1:])) for row in rows]
+        return records, rows[-1][0] + 1 if len(rows) == limit else None
+
+    # ============================================= #
+
+    # Define function to count a reputer's records by reputee and feature
+    # using the reputer index
+    def get_reputer_breakdown(self, reputer):
+        cursor = self.connection.execute("SELECT reputee, feature, COUNT(*) FROM reputes WHERE reputer = ? "
+                                         "GROUP BY reputee, feature", (reputer,))
+        breakdown = {}
+        for reputee, feature, count in cursor:
+            breakdown.setdefault(reputee, {})[feature] = count
+
+        return breakdown
+
+    # ============================================= #
+
+    # Define function to get every record
+    def iter_reputes(self):
+        cursor = self.connection.execute("SELECT reputer, reputee, rid, feature, value FROM reputes ORDER BY rowid")
+        for row in cursor:
+            yield Repute(*row)
+
+    # ============================================= #
+
+    # Define function to get a batch of records from a cursor, which is the rowid of the last record read
+    def get_reputes_batch(self, cursor, limit):
+        rows = self.connection.execute("SELECT rowid, reputer, reputee, rid, feature, value FROM reputes "
+                                       "WHERE rowid > ? ORDER BY rowid LIMIT ?", (cursor or 0, limit)).fetchall()
+        return [Repute(*row[1:]) for row in rows], rows[-1][0] if len(rows) == limit else None
+
+    # ============================================= #
+
+    # Define function to get the count and sum of a reputee's feature
+    def get_aggregate(self, reputee, feature):
+        cursor = self.connection.execute("SELECT count, total FROM aggregates WHERE reputee = ? AND feature = ?",
+                                         (reputee, feature))
+        row = cursor.fetchone()
+        return (0, 0) if row is None else tuple(row)
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees
+    def get_aggregates(self, reputees):
+        aggregates = {}
+        reputees = list(set(reputees))
+
+        # Query the reputees in chunks to stay under SQLite's parameter limit
+        for start in range(0, len(reputees), MAX_PARAMETERS):
+            chunk = reputees[start:start + MAX_PARAMETERS]
+            cursor = self.connection.execute("SELECT reputee, feature, count, total FROM aggregates "
+                                             "WHERE reputee IN (" + ", ".join("?" * len(chunk)) + ")", chunk)
+            for row in cursor:
+                aggregates.setdefault(row[0], {})[row[1]] = (row[2], row[3])
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to get every reputee's stored aggregates
+    def iter_aggregates(self):
+        cursor = self.connection.execute("SELECT reputee, feature, count, total FROM aggregates ORDER BY reputee")
+        reputee = None
+        aggregate = {}
+        for row in cursor:
+            if row[0] != reputee:
+                if reputee is not None:
+                    yield reputee, aggregate
+                reputee = row[0]
+                aggregate = {}
+            aggregate[row[1]] = (row[2], row[3])
+
+        if reputee is not None:
+            yield reputee, aggregate
+
+    # ============================================= #
+
+    # Define function to replace the stored aggregates and bump the
+    # versions of the reputees whose aggregates changed
+    def replace_aggregates(self, aggregates):
+        with self.transaction():
+            changed = changed_reputees(dict(self.iter_aggregates()), aggregates)
+            self._write_aggregates(aggregates)
+            self.connection.executemany("INSERT INTO versions VALUES (?, 1) "
+                                        "ON CONFLICT (reputee) DO UPDATE SET version = version + 1",
+                                        [(reputee,) for reputee in changed])
+
+    # ============================================= #
+
+    # Define function to replace the stored aggregates of the reputees in a
+    # partition, or of every reputee by default, inside an open transaction
+    def _write_aggregates(self, aggregates, partition=0, partitions=1):
+        condition, parameters = _partition_condition(partition, partitions)
+        self.connection.execute("DELETE FROM aggregates" + condition, parameters)
+        for reputee in aggregates:
+            for feature in aggregates[reputee]:
+                count, total = aggregates[reputee][feature]
+                self.connection.execute("INSERT INTO aggregates VALUES (?, ?, ?, ?)",
+                                        (reputee, feature, count, total))
+
+    # ============================================= #
+
+    # Define function to rebuild the aggregates of a partition's reputees.
+    # They are calculated in a read transaction, so the partitions of a
+    # database are calculated side by side, and written in a single write
+    # transaction, so other connections see either the old or new ones.
+    # Records are only ever added, each with a higher rowid, so if any were
+    # added in between the aggregates are calculated again. The indexes
+    # cover every partition, so they are rebuilt with the first.
+    def rebuild(self, partition=0, partitions=1):
+        self.connection.execute("BEGIN")
+        try:
+            latest = self._latest_rowid()
+            aggregates = self._compute_aggregates(partition, partitions)
+        finally:
+            self.connection.execute("COMMIT")
+
+        with self.transaction():
+            if self._latest_rowid() != latest:
+                aggregates = self._compute_aggregates(partition, partitions)
+            if partition == 0:
+                self.connection.execute("REINDEX reputes")
+            self._write_aggregates(aggregates, partition, partitions)
+            condition, parameters = _partition_condition(partition, partitions)
+            self.connection.execute("UPDATE versions SET version = version + 1" + condition, parameters)
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to get the rowid of the latest record
+    def _latest_rowid(self):
+        return self.connection.execute("SELECT MAX(rowid) FROM reputes").fetchone()[0]
+
+    # ============================================= #
+
+    # Define function to calculate aggregates from the records
+    def compute_aggregates(self):
+        return self._compute_aggregates()
+
+    # ============================================= #
+
+    # Define function to calculate the aggregates of the reputees in a
+    # partition, or of every reputee by default, from the records
+    def _compute_aggregates(self, partition=0, partitions=1):
+        aggregates = {}
+        condition, parameters = _partition_condition(partition, partitions)
+        cursor = self.connection.execute("SELECT reputee, feature, COUNT(*), SUM(value) FROM reputes" + condition +
+                                         " GROUP BY reputee, feature", parameters)
+        for row in cursor:
+            aggregates.setdefault(row[0], {})[row[1]] = (row[2], row[3])
+
+        return aggregates
+
+
+# ================================================== #
+
+
+# Define transaction context manager
+class _Transaction(object):
+
+    # Define init function
+    def __init__(self, connection):
+        self.connection = connection
+
+    # ============================================= #
+
+    # Define function to begin the transaction
+    def __enter__(self):
+        # Take the write lock up front so concurrent writers queue instead of deadlocking
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    # ============================================= #
+
+    # Define function to commit or roll back the transaction
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+        return False
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to get the WHERE clause and parameters that pick out
+# the reputees in a partition, or nothing when there is one partition
+def _partition_condition(partition, partitions):
+    if partitions == 1:
+        return "", ()
+    return " WHERE partition_index(reputee, ?) = ?", (partitions, partition)
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
@@ -6,51 +6,450 @@
 # Last Edited: N/A                                   #
 # Last Edited By: N/A                                #
 # ================================================== #
-#                      IMPORTS                       #
+#                      IMPORTS                       #
 # ================================================== #
 
+from app.metrics import REGISTRY
+from app.storage.record import Repute, check_value
+import contextlib
+import importlib
 import os
-import shelve
+import threading
+import time
+import zlib
 
 # ================================================== #
-#                  CLASS DEFINITIONS                 #
+#                      CONSTANTS                     #
 # ================================================== #
 
+# Storage engines selectable by name, as the module and class that
+# implement them. Only the engine in use is imported, which keeps
+# sqlite3 and the log engine out of a shelve worker's startup.
+ENGINES = {"shelve": ("app.storage.shelve_engine", "ShelveEngine"),
+           "sqlite": ("app.storage.sqlite_engine", "SQLiteEngine"),
+           "log": ("app.storage.log_engine", "LogEngine")}
 
-# Define Data object
+# Directory holding every database file
+DIRECTORY = os.path.dirname(__file__)
+
+# Number of a reputee's reputes read under one lock while paging through them
+PAGE_CHUNK_SIZE = 100
+
+# Number of reputes read under one lock while iterating over every repute
+ITER_CHUNK_SIZE = 1000
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define Data object. Reputees are split across one or more shards by
+# a stable hash, each shard being a separate engine with its own files
+# and locks, so writes for reputees in different shards never wait for
+# each other. The number of shards is stored with the database and is
+# changed with manage.py reshard.
 class Data(object):
 
-    # Define init function
-    def __init__(self, mode):
-        # Crate a variable to hold the database
-        self.db = None
+    # Define init function. Options override the engine's tunable class
+    # attributes, e.g. {"bloom_capacity": 10 ** 7} for the shelve engine.
+    def __init__(self, mode, engine="shelve", options=None):
+        # Check that the requested engine exists
+        if engine not in ENGINES:
+            raise ValueError("Unknown storage engine: " + str(engine))
+
+        # Check that the engine has every option
+        for name in options or {}:
+            if name.startswith('_') or not hasattr(engine_class(engine), name):
+                raise ValueError("Unknown option for the " + engine + " engine: " + str(name))
+
+        # Crate variables to hold the database engine of every shard
+        # and the engine of the first shard (the only one unless sharded)
+        self.engines = []
+        self.engine = None
+        self.engine_name = engine
+        self.options = options or {}
         self.mode = mode
+        # Check mode and use the corresponding database
+        self.prefix = '' if mode == "Production" else 'test_'
+        # Create a lock for every shard so threads can share one open Data object
+        self.locks = []
+
+    # ============================================= #
+
+    # Define function to open every shard. The number of shards stored
+    # with the database is used unless another is given.
+    def open(self, shards=None):
+        with self.timed("open"):
+            if shards is None:
+                shards = read_shards(self.prefix, self.engine_name)
+            self.engines = [self.open_shard(index, shards) for index in range(shards)]
+            self.engine = self.engines[0]
+            self.locks = [threading.RLock() for _ in self.engines]
+
+    # ============================================= #
+
+    # Define function to create and open the engine of one shard
+    def open_shard(self, index, shards):
+        engine = self.create_shard(index, shards)
+        engine.open()
+        return engine
+
+    # ============================================= #
+
+    # Define function to create the engine of one shard without opening it
+    def create_shard(self, index, shards):
+        engine = engine_class(self.engine_name)(DIRECTORY, shard_prefix(self.prefix, index, shards))
+        for name, value in self.options.items():
+            setattr(engine, name, value)
+        return engine
+
+    # ============================================= #
+
+    # Define function to get the shard holding a reputee
+    def shard(self, reputee):
+        return shard_index(reputee, len(self.engines))
+
+    # ============================================= #
+
+    # Define function to get the paths of the scores manage.py rebuild saves for every shard
+    def scores_paths(self):
+        return [scores_path(shard_prefix(self.prefix, index, len(self.engines)), self.engine_name)
+                for index in range(len(self.engines))]
+
+    # ============================================= #
+
+    # Define function to record how long an operation takes
+    @contextlib.contextmanager
+    def timed(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            REGISTRY.observe("reputation_storage_operation_duration_seconds", time.perf_counter() - start,
+                             (("engine", self.engine_name), ("operation", operation)))
+
+    # ============================================= #
+
+    # Define function to hold a shard's thread and engine read locks
+    @contextlib.contextmanager
+    def reading(self, operation="read", shard=0):
+        with self.timed(operation):
+            with self.locks[shard]:
+                with self.engines[shard].reading():
+                    yield self.engines[shard]
+
+    # ============================================= #
+
+    # Define function to hold a shard's thread and engine write locks
+    @contextlib.contextmanager
+    def writing(self, operation="write", shard=0):
+        with self.timed(operation):
+            with self.locks[shard]:
+                with self.engines[shard].writing():
+                    yield self.engines[shard]
+
+    # ============================================= #
+
+    # Define function to add a repute to the database
+    def add(self, reputer, reputee, rid, feature, value):
+        # Store repute unless its key is a duplicate
+        with self.writing("add", self.shard(reputee)) as engine:
+            created = engine.put_if_absent(*_entry(reputer, reputee, rid, feature, value))
+
+        _count_writes([created])
+        return created
+
+    # ============================================= #
+
+    # Define function to add a batch of (reputer, reputee, rid, feature, value)
+    # reputes with one write per shard, returning whether each was new
+    def add_many(self, reputes):
+        # Group the reputes by shard, remembering where each came from
+        groups = {}
+        for position, repute in enumerate(reputes):
+            groups.setdefault(self.shard(repute[1]), []).append((position, _entry(*repute)))
+
+        created = [False] * len(reputes)
+        for shard, entries in groups.items():
+            with self.writing("add_many", shard) as engine:
+                results = engine.put_many([entry for _, entry in entries])
+            for (position, _), result in zip(entries, results):
+                created[position] = result
+
+        _count_writes(created)
+        return created
+
+    # ============================================= #
+
+    # Define function to check for a reputee
+    def has_reputee(self, reputee):
+        with self.reading("has_reputee", self.shard(reputee)) as engine:
+            return engine.has_reputee(reputee)
+
+    # ============================================= #
+
+    # Define function to get a reputee's version
+    def get_version(self, reputee):
+        with self.reading("get_version", self.shard(reputee)) as engine:
+            return engine.get_version(reputee)
+
+    # ============================================= #
+
+    # Define function to get the keys of a reputee's reputes
+    def get_keys(self, reputee):
+        with self.reading("get_keys", self.shard(reputee)) as engine:
+            return list(engine.get_keys(reputee))
+
+    # ============================================= #
+
+    # Define function to get a reputee's reputes in the POST format
+    def get_reputes(self, reputee):
+        with self.reading("get_reputes", self.shard(reputee)) as engine:
+            records = [record.to_dict() for record in engine.get_reputes(reputee)]
+
+        REGISTRY.increment("reputation_storage_records_read_total", len(records))
+        return records
+
+    # ============================================= #
+
+    # Define function to get a page of a reputee's reputes in the POST
+    # format, optionally only those with the given feature or reputer.
+    # Yields (position, repute) pairs, where position is where the page
+    # after the repute starts. The reputes are read in chunks, each under
+    # its own read lock, so a page can be streamed to a slow client
+    # without holding writers up.
+    def iter_reputes_page(self, reputee, start=0, limit=None, feature=None, reputer=None):
+        shard = self.shard(reputee)
+        remaining = limit
+        while start is not None and (remaining is None or remaining > 0):
+            size = PAGE_CHUNK_SIZE if remaining is None else min(remaining, PAGE_CHUNK_SIZE)
+            with self.reading("get_reputes_page", shard) as engine:
+                records, start = engine.get_reputes_page(reputee, start, size, feature, reputer)
+            REGISTRY.increment("reputation_storage_records_read_total", len(records))
+
+            for position, record in records:
+                yield position + 1, record.to_dict()
+            if remaining is not None:
+                remaining -= len(records)
+
+    # ============================================= #
+
+    # Define function to get the number of reputes with each feature that a
+    # reputer stored for each of its reputees. Reputers post to reputees in
+    # every shard, so each shard's reputer index is read in turn.
+    def get_reputer_breakdown(self, reputer):
+        breakdown = {}
+        for shard in range(len(self.engines)):
+            with self.reading("get_reputer_breakdown", shard) as engine:
+                breakdown.update(engine.get_reputer_breakdown(reputer))
+
+        return breakdown
+
+    # ============================================= #
+
+    # Define function to get every repute in the POST format. The reputes
+    # are read in chunks, each under its own read lock, so an export does
+    # not hold writers up. Reputes stored meanwhile may be left out.
+    def iter_reputes(self):
+        count = 0
+        try:
+            for shard in range(len(self.engines)):
+                cursor = None
+                while True:
+                    with self.reading("iter_reputes", shard) as engine:
+                        records, cursor = engine.get_reputes_batch(cursor, ITER_CHUNK_SIZE)
+                    for record in records:
+                        count += 1
+                        yield record.to_dict()
+                    if cursor is None:
+                        break
+        finally:
+            REGISTRY.increment("reputation_storage_records_read_total", count)
 
     # ============================================= #
 
-    # Define function to close open
-    def open(self):
-        directory = os.path.dirname(__file__)
-        # Check mode and open corresponding database
-        if self.mode == "Production":
-            file = os.path.join(directory, 'data.db')
-            self.db = shelve.open(file)
-        else:
-            file = os.path.join(directory, 'test_data.db')
-            self.db = shelve.open(file)
+    # Define function to get the count and sum of a reputee's feature
+    def get_aggregate(self, reputee, feature):
+        REGISTRY.increment("reputation_storage_aggregates_read_total")
+        with self.reading("get_aggregate", self.shard(reputee)) as engine:
+            return engine.get_aggregate(reputee, feature)
+
+    # ============================================= #
+
+    # Define function to get the stored aggregates of the given reputees
+    def get_aggregates(self, reputees):
+        REGISTRY.increment("reputation_storage_aggregates_read_total", len(reputees))
+        groups = {}
+        for reputee in reputees:
+            groups.setdefault(self.shard(reputee), []).append(reputee)
+
+        aggregates = {}
+        for shard, group in groups.items():
+            with self.reading("get_aggregates", shard) as engine:
+                aggregates.update(engine.get_aggregates(group))
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to get every reputee's stored aggregates
+    def iter_aggregates(self):
+        for shard in range(len(self.engines)):
+            with self.reading("iter_aggregates", shard) as engine:
+                for reputee, aggregate in engine.iter_aggregates():
+                    yield reputee, aggregate
+
+    # ============================================= #
+
+    # Define function to calculate aggregates from the raw reputes.
+    # Every reputee is in a single shard, so shards never overlap.
+    def compute_aggregates(self):
+        aggregates = {}
+        for shard in range(len(self.engines)):
+            with self.reading("compute_aggregates", shard) as engine:
+                aggregates.update(engine.compute_aggregates())
+
+        return aggregates
+
+    # ============================================= #
+
+    # Define function to rebuild the aggregates from the database
+    def rebuild_aggregates(self):
+        for shard in range(len(self.engines)):
+            with self.writing("rebuild_aggregates", shard) as engine:
+                engine.replace_aggregates(engine.compute_aggregates())
+
+    # ============================================= #
+
+    # Define function to rebuild the reputee index from the database
+    def rebuild_index(self):
+        for shard in range(len(self.engines)):
+            with self.writing("rebuild_index", shard) as engine:
+                engine.rebuild_index()
+
+    # ============================================= #
+
+    # Define function to convert records written by earlier versions
+    def migrate(self):
+        converted = 0
+        for shard in range(len(self.engines)):
+            with self.writing("migrate", shard) as engine:
+                converted += engine.migrate()
+
+        return converted
 
     # ============================================= #
 
     # Define function to clear database
     def clear(self):
-        self.db.clear()
+        for shard in range(len(self.engines)):
+            with self.writing("clear", shard) as engine:
+                engine.clear()
+
+        # Remove the scores and leaderboard made from the old reputes
+        for path in self.scores_paths() + [leaderboard_path(self.prefix, self.engine_name)]:
+            if os.path.exists(path):
+                os.remove(path)
 
     # ============================================= #
 
     # Define function to close database
     def close(self):
-        # Close the database
-        self.db.close()
+        # Close the database engine of every shard
+        for engine in self.engines:
+            engine.close()
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to get the class of a storage engine, importing its module
+def engine_class(name):
+    module, attribute = ENGINES[name]
+    return getattr(importlib.import_module(module), attribute)
+
+# ================================================== #
+
+
+# Define function to get the shard holding a reputee. The hash must
+# not change between processes or releases, so hash() is not used.
+def shard_index(reputee, shards):
+    return zlib.crc32(reputee.encode('utf-8')) % shards if shards > 1 else 0
+
+# ================================================== #
+
+
+# Define function to get the file prefix of a shard. An unsharded
+# database keeps the file names it had before sharding existed.
+def shard_prefix(prefix, index, shards):
+    return prefix if shards == 1 else "%sshard%d-of-%d_" % (prefix, index, shards)
+
+# ================================================== #
+
+
+# Define function to get the path of the file holding a database's number of shards
+def shards_path(prefix, engine):
+    return os.path.join(DIRECTORY, prefix + 'shards.' + engine)
+
+# ================================================== #
+
+
+# Define function to get the path of the file holding the scores of a shard's reputees
+def scores_path(prefix, engine):
+    return os.path.join(DIRECTORY, prefix + 'scores.' + engine)
+
+# ================================================== #
+
+
+# Define function to get the path of the leaderboard snapshot that every worker maps
+def leaderboard_path(prefix, engine):
+    return os.path.join(DIRECTORY, prefix + 'leaderboard.' + engine)
+
+# ================================================== #
+
+
+# Define function to read a database's number of shards
+def read_shards(prefix, engine):
+    try:
+        with open(shards_path(prefix, engine)) as file:
+            return int(file.read())
+    except FileNotFoundError:
+        return 1
+
+# ================================================== #
+
+
+# Define function to store a database's number of shards. The file is
+# replaced in one step, so readers see either the old or new number.
+def write_shards(prefix, engine, shards):
+    temporary = shards_path(prefix, engine) + '.tmp'
+    with open(temporary, 'w') as file:
+        file.write(str(shards))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, shards_path(prefix, engine))
+
+# ================================================== #
+
+
+# Define function to count the results of a write
+def _count_writes(created):
+    written = sum(1 for result in created if result)
+    REGISTRY.increment("reputation_storage_records_written_total", written)
+    REGISTRY.increment("reputation_storage_duplicates_total", len(created) - written)
+
+# ================================================== #
+
+
+# Define function to build the dedupe key and record for a repute. The
+# value is checked first, so a batch holding a repute that cannot be
+# stored is rejected before any of it is written.
+def _entry(reputer, reputee, rid, feature, value):
+    check_value(value)
+    record = Repute(reputer, reputee, rid, feature, value)
+    return record.key, record
 
 
 # ================================================== #
@@ -0,0 +1,146 @@
+# ================================================== #
+#                    WRITE QUEUE                     #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/02/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+from app.metrics import REGISTRY
+from app.storage.record import check_value
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+# Define write queue object. Reputes submitted by any thread are
+# collected by a single writer thread into batches of up to
+# batch_size reputes, waiting at most batch_wait seconds after the
+# first, and each batch is committed with one add_many call. Every
+# submitted repute gets a future that is resolved with whether the
+# repute was new once its batch has been committed, so callers can
+# answer as they would after add while the cost of taking the locks
+# and flushing the database is shared by the whole batch. A repute
+# that cannot be stored only fails its own future.
+class WriteQueue(object):
+
+    # Define init function. on_commit is called from the writer thread
+    # with the Data object, the batch and its results after each commit.
+    def __init__(self, data, batch_size, batch_wait, on_commit=None):
+        self.data = data
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.on_commit = on_commit
+        # Create the queue of (repute, future) pairs and start the writer thread
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="write-queue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # ============================================= #
+
+    # Define function to queue a (reputer, reputee, rid, feature, value)
+    # repute, returning a future of whether it was new. A repute whose
+    # value cannot be stored fails at once instead of joining a batch.
+    def submit(self, repute):
+        future = Future()
+        try:
+            check_value(repute[4])
+        except (TypeError, ValueError) as error:
+            future.set_exception(error)
+            return future
+
+        self.queue.put((repute, future))
+        return future
+
+    # ============================================= #
+
+    # Define function to store a repute and wait until its batch is committed
+    def add(self, repute):
+        return self.submit(repute).result()
+
+    # ============================================= #
+
+    # Define function to commit every queued repute and stop the writer thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    # ============================================= #
+
+    # Define function to collect and commit batches until the queue is closed
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            # Collect more reputes until the batch is full or the wait is over
+            batch = [item]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+    # ============================================= #
+
+    # Define function to commit a batch and resolve its futures
+    def _commit(self, batch):
+        reputes = [repute for repute, _ in batch]
+        try:
+            results = self.data.add_many(reputes)
+        except Exception as error:
+            # Store the reputes one at a time, so only those that cannot be stored fail
+            results = [error] if len(batch) == 1 else [self._add(repute) for repute in reputes]
+
+        committed = [(repute, result) for repute, result in zip(reputes, results)
+                     if not isinstance(result, Exception)]
+        if committed:
+            REGISTRY.increment("reputation_write_batches_total")
+            REGISTRY.increment("reputation_write_batch_reputes_total", len(committed))
+
+        # Run the callback before resolving the futures, so a caller sees
+        # its effects as soon as add returns. A failing callback must not
+        # stop the writer, since every later submit would then wait forever.
+        if self.on_commit is not None and committed:
+            try:
+                self.on_commit(self.data, [repute for repute, _ in committed], [result for _, result in committed])
+            except Exception:
+                pass
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    # ============================================= #
+
+    # Define function to store a single repute, returning whether it was new or the error it raised
+    def _add(self, repute):
+        try:
+            return self.data.add(*repute)
+        except Exception as error:
+            return error
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
@@ -0,0 +1,73 @@
+# ================================================== #
+#                        ASGI                        #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api.async_api import (AsyncCacheAPI, AsyncLeaderboardAPI, AsyncMetricsAPI, AsyncReputationAPI,
+                                AsyncReputerAPI, AsyncReputesAPI, create_asgi_app)
+from app.api.metrics import TimingMiddleware
+from app import config
+import atexit
+import os
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to create the app, e.g. "uvicorn --factory
+# asgi:create_app". This takes the same arguments and environment
+# variables as run.create_app, plus REPUTATION_THREADS to size the
+# pool that storage calls run on (Python's default is used when it
+# is unset).
+def create_app(mode="Production", engine=None, engine_options=None, preload=True, **settings):
+    engine = engine or config.engine()
+    if engine_options is None:
+        engine_options = config.engine_options(engine)
+    settings = dict(config.api_settings(), **settings)
+    if "REPUTATION_THREADS" in os.environ:
+        settings.setdefault("workers", int(os.environ["REPUTATION_THREADS"]))
+
+    app = create_asgi_app(middleware=[TimingMiddleware()])
+    api = AsyncReputationAPI(mode=mode, engine=engine, engine_options=engine_options, **settings)
+    app.add_route('/reputation', api)
+    app.add_route('/reputation/{reputee}', api)
+    app.add_route('/reputation/{reputee}/reputes', AsyncReputesAPI(api))
+    app.add_route('/reputers/{reputer}', AsyncReputerAPI(api))
+    app.add_route('/cache', AsyncCacheAPI(api))
+    app.add_route('/leaderboard', AsyncLeaderboardAPI(api))
+    app.add_route('/metrics', AsyncMetricsAPI(api))
+
+    # Close the worker's database handle when it shuts down
+    atexit.register(api.close)
+
+    if preload:
+        api.preload()
+    return app
+
+# ================================================== #
+
+
+# Define function to create the app the first time asgi.app is read, so
+# "uvicorn asgi:app" still works but importing this module builds nothing.
+# The leaderboard is mapped by its first request rather than while
+# every worker boots. Call create_app with --preload to map it once.
+def __getattr__(name):
+    global app
+    if name != "app":
+        raise AttributeError("module 'asgi' has no attribute " + repr(name))
+    app = create_app(preload=False)
+    return app
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
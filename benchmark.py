@@ -0,0 +1,260 @@
+# ================================================== #
+#                     BENCHMARK                      #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api.api import ReputationAPI
+from app.storage.storage import ENGINES
+from falcon import testing
+import argparse
+import datetime
+import falcon
+import platform
+import random
+import subprocess
+import sys
+import time
+
+# If ujson is available use it, otherwise use the
+# standard json library.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of reputes stored at a time while growing the dataset
+LOAD_BATCH_SIZE = 5000
+
+# Latency percentiles reported for every operation
+PERCENTILES = (50, 95, 99)
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to generate a synthetic repute. The same seed
+# and index always give the same repute, so every run of the
+# benchmark stores the same dataset.
+def make_repute(seed, index, reputees, reach_ratio):
+    generator = random.Random(seed * 1000003 + index)
+    feature = "reach" if generator.random() < reach_ratio else "clarity"
+    return {"reputer": "reputer" + str(generator.randrange(reputees * 10)),
+            "reputee": "reputee" + str(generator.randrange(reputees)),
+            "repute": {"rid": str(index), "feature": feature, "value": generator.randint(0, 10)}}
+
+# ================================================== #
+
+
+# Define function to summarize the latencies of an operation
+def summarize(latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    summary = {"requests": len(latencies),
+               "errors": errors,
+               "seconds": round(elapsed, 6),
+               "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0,
+               "mean_ms": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else 0}
+
+    # Use the nearest-rank percentile
+    for percentile in PERCENTILES:
+        rank = max(0, -(-percentile * len(latencies) // 100) - 1)
+        summary["p%d_ms" % percentile] = round(latencies[rank] * 1000, 4) if latencies else 0
+
+    return summary
+
+# ================================================== #
+
+
+# Define function to time a series of simulated requests. Requests
+# that fail (e.g. a GET of a reputee too new to be scored) are timed
+# like any other, but counted as errors.
+def measure(requests):
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for request in requests:
+        before = time.perf_counter()
+        result = request()
+        latencies.append(time.perf_counter() - before)
+        if result.status_code >= 400:
+            errors += 1
+
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+# ================================================== #
+
+
+# Define function to benchmark one storage engine at every dataset size
+def run_engine(engine, args):
+    # Serve the API the same way run.py does
+    resource = ReputationAPI(mode=args.mode, engine=engine, cache_size=args.cache_size)
+    app = falcon.API()
+    app.add_route('/reputation', resource)
+    app.add_route('/reputation/{reputee}', resource)
+    client = testing.TestClient(app)
+    headers = {"Content-Type": "application/json"}
+
+    data = resource.get_data()
+    data.clear()
+    generator = random.Random(args.seed)
+    results = []
+    stored = 0
+    posted = 0
+    try:
+        for size in sorted(args.sizes):
+            # Grow the dataset to the requested size
+            start = time.perf_counter()
+            while stored < size:
+                count = min(LOAD_BATCH_SIZE, size - stored)
+                reputes = [make_repute(args.seed, index, args.reputees, args.reach_ratio)
+                           for index in range(stored, stored + count)]
+                data.add_many([(repute["reputer"], repute["reputee"], repute["repute"]["rid"],
+                                repute["repute"]["feature"], repute["repute"]["value"]) for repute in reputes])
+                stored += count
+            load_seconds = time.perf_counter() - start
+
+            # POST reputes that have not been stored. Their rids are offset so
+            # they never collide with the reputes used to grow the dataset.
+            first = max(args.sizes) + posted
+            new = [json.dumps(make_repute(args.seed, index, args.reputees, args.reach_ratio))
+                   for index in range(first, first + args.requests)]
+            posted += args.requests
+            post = measure(lambda body=body: client.simulate_post('/reputation', body=body, headers=headers)
+                           for body in new)
+
+            # POST reputes that are already stored
+            duplicates = [json.dumps(make_repute(args.seed, generator.randrange(stored), args.reputees,
+                                                 args.reach_ratio)) for _ in range(args.requests)]
+            duplicate_post = measure(lambda body=body: client.simulate_post('/reputation', body=body,
+                                                                             headers=headers)
+                                     for body in duplicates)
+
+            # GET the scores of reputees that have been stored
+            reputees = [make_repute(args.seed, generator.randrange(stored), args.reputees,
+                                    args.reach_ratio)["reputee"] for _ in range(args.requests)]
+            get = measure(lambda reputee=reputee: client.simulate_get('/reputation/' + reputee)
+                          for reputee in reputees)
+
+            for operation, summary in (("post", post), ("duplicate_post", duplicate_post), ("get", get)):
+                summary.update({"engine": engine, "records": size, "operation": operation})
+                results.append(summary)
+            print("%s: %d records loaded in %.1fs, POST p50 %.3fms, GET p50 %.3fms" %
+                  (engine, size, load_seconds, post["p50_ms"], get["p50_ms"]), file=sys.stderr)
+    finally:
+        data.clear()
+        resource.close()
+
+    return results
+
+# ================================================== #
+
+
+# Define function to describe the code and machine a benchmark ran on
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"commit": commit,
+            "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "falcon": falcon.__version__,
+            "platform": platform.platform()}
+
+# ================================================== #
+
+
+# Define function to compare a benchmark with an earlier one
+def compare(baseline, current):
+    previous = {(result["engine"], result["records"], result["operation"]): result
+                for result in baseline["results"]}
+    lines = []
+    for result in current["results"]:
+        key = (result["engine"], result["records"], result["operation"])
+        if key not in previous:
+            continue
+
+        changes = []
+        for percentile in PERCENTILES:
+            name = "p%d_ms" % percentile
+            before = previous[key][name]
+            changes.append("%s %+.1f%%" % (name, (result[name] - before) / before * 100 if before else 0))
+        lines.append("%s %d %s: %s" % (key[0], key[1], key[2], ", ".join(changes)))
+
+    return lines
+
+
+# ================================================== #
+#                        MAIN                        #
+# ================================================== #
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure Reputation API latency as the dataset grows.")
+    parser.add_argument("--mode", default="Development",
+                        help="Database mode. The database is cleared before and after the benchmark.")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES),
+                        help="Storage engine to benchmark. May be given more than once (default: shelve).")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=[10000, 100000, 1000000], help="Comma separated dataset sizes.")
+    parser.add_argument("--reputees", type=int, default=1000, help="Number of distinct reputees.")
+    parser.add_argument("--reach-ratio", type=float, default=0.5,
+                        help="Fraction of reputes that are reach rather than clarity.")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests timed per operation and size.")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="GET response cache size (0 measures uncached GETs).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic dataset.")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, or - for stdout.")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against.")
+    args = parser.parse_args(argv)
+
+    if args.mode == "Production":
+        parser.error("the benchmark clears its database and cannot be run against Production")
+
+    report = {"environment": environment(),
+              "parameters": {"sizes": sorted(args.sizes), "reputees": args.reputees,
+                             "reach_ratio": args.reach_ratio, "requests": args.requests,
+                             "cache_size": args.cache_size, "seed": args.seed},
+              "results": []}
+    for engine in args.engine or ["shelve"]:
+        report["results"].extend(run_engine(engine, args))
+
+    # Write the results
+    output = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as destination:
+            destination.write(output + "\n")
+
+    # Report changes from the earlier results
+    if args.compare:
+        with open(args.compare) as source:
+            for line in compare(json.loads(source.read()), report):
+                print(line, file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
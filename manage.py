@@ -0,0 +1,500 @@
+# ================================================== #
+#                       MANAGE                       #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/01/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api.api import parse_repute
+from app.api.leaderboard import load_scores, save_scores, score_aggregates
+from app.storage.storage import Data, DIRECTORY, engine_class, ENGINES, read_shards, scores_path, shard_index, \
+    shard_prefix, write_shards
+import argparse
+import glob
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+# If ujson is available use it, otherwise use the
+# standard json library.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                      CONSTANTS                     #
+# ================================================== #
+
+
+# Number of lines parsed by a worker process at a time
+IMPORT_CHUNK_SIZE = 5000
+
+# Number of reputes written to a new shard at a time
+RESHARD_CHUNK_SIZE = 5000
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+# Define function to check stored aggregates against the raw reputes
+def verify(args):
+    # Open database
+    data = Data(args.mode, args.engine)
+    data.open()
+
+    # Recalculate aggregates from the raw reputes
+    expected = data.compute_aggregates()
+    drift = []
+
+    # Compare every reputee and feature seen in either the stored or recalculated aggregates
+    aggregates = dict(data.iter_aggregates())
+    for reputee in set(expected) | set(aggregates):
+        stored = aggregates.get(reputee, {})
+        for feature in set(expected.get(reputee, {})) | set(stored):
+            expected_count, expected_total = expected.get(reputee, {}).get(feature, (0, 0))
+            stored_count, stored_total = stored.get(feature, (0, 0))
+            if expected_count != stored_count or not math.isclose(expected_total, stored_total):
+                drift.append((reputee, feature, (stored_count, stored_total), (expected_count, expected_total)))
+
+    # Report any drift found
+    for reputee, feature, stored, recalculated in drift:
+        print("%s %s: stored count=%d sum=%r, expected count=%d sum=%r" %
+              (reputee, feature, stored[0], stored[1], recalculated[0], recalculated[1]))
+    print("%d reputees checked, %d aggregates drifted." % (len(expected), len(drift)))
+
+    # Replace the stored aggregates if requested
+    if drift and args.repair:
+        data.rebuild_aggregates()
+        print("Aggregates rebuilt.")
+
+    # Close database
+    data.close()
+
+    return 1 if drift and not args.repair else 0
+
+# ================================================== #
+
+
+# Define function to import reputes from an NDJSON file
+def import_reputes(args):
+    # Open database and input file
+    data = Data(args.mode, args.engine)
+    data.open()
+    source = sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')
+
+    counts = {"created": 0, "duplicate": 0, "invalid": 0}
+    start = time.time()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        # Split the file into chunks of lines and parse a bounded window of
+        # chunks at a time, so memory use does not grow with the file size
+        chunks = iter(lambda: list(itertools.islice(source, IMPORT_CHUNK_SIZE)), [])
+        window = args.workers * 4
+        while True:
+            parsed_chunks = pool.map(_parse_lines, itertools.islice(chunks, window))
+            if not parsed_chunks:
+                break
+
+            # Write each chunk's valid reputes in a single batch
+            for reputes, invalid in parsed_chunks:
+                counts["invalid"] += invalid
+                created = sum(data.add_many(reputes))
+                counts["created"] += created
+                counts["duplicate"] += len(reputes) - created
+
+            # Report progress
+            elapsed = time.time() - start
+            total = sum(counts.values())
+            print("%d reputes read (%d created, %d duplicate, %d invalid) in %.1fs, %.0f reputes/s" %
+                  (total, counts["created"], counts["duplicate"], counts["invalid"], elapsed,
+                   total / elapsed if elapsed else 0), file=sys.stderr)
+    finally:
+        pool.close()
+        pool.join()
+        if source is not sys.stdin.buffer:
+            source.close()
+        data.close()
+
+    return 1 if counts["invalid"] else 0
+
+# ================================================== #
+
+
+# Define function to parse and validate a chunk of NDJSON lines in a worker process
+def _parse_lines(lines):
+    reputes = []
+    invalid = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            reputes.append(parse_repute(json.loads(line)))
+        except (ValueError, KeyError, TypeError):
+            invalid += 1
+
+    return reputes, invalid
+
+# ================================================== #
+
+
+# Define function to export every repute to an NDJSON file
+def export_reputes(args):
+    # Open database and output file
+    data = Data(args.mode, args.engine)
+    data.open()
+    destination = sys.stdout if args.file == '-' else open(args.file, 'w')
+
+    count = 0
+    start = time.time()
+    try:
+        # Write the reputes one at a time as they are read
+        for record in data.iter_reputes():
+            destination.write(json.dumps(record) + "\n")
+            count += 1
+    finally:
+        if destination is not sys.stdout:
+            destination.close()
+        data.close()
+
+    elapsed = time.time() - start
+    print("%d reputes written in %.1fs, %.0f reputes/s" % (count, elapsed, count / elapsed if elapsed else 0),
+          file=sys.stderr)
+    return 0
+
+
+# ================================================== #
+
+
+# Define function to convert records written by earlier versions in place
+def migrate(args):
+    # Open database
+    data = Data(args.mode, args.engine)
+    data.open()
+
+    start = time.time()
+    try:
+        converted = data.migrate()
+    finally:
+        data.close()
+
+    print("%d reputes converted in %.1fs" % (converted, time.time() - start), file=sys.stderr)
+    return 0
+
+
+# ================================================== #
+
+
+# Define function to split or merge the database's shards. The API must be
+# stopped first. Every old shard is read once, by its own worker process,
+# which writes each of its reputes to the new shard it belongs in. The
+# database only switches to the new shards once all of them have been
+# written, so an interrupted reshard loses nothing.
+def reshard(args):
+    if args.shards < 1:
+        print("The number of shards must be at least 1.", file=sys.stderr)
+        return 1
+
+    data = Data(args.mode, args.engine)
+    current = read_shards(data.prefix, args.engine)
+    if current == args.shards:
+        print("The database already has %d shards." % current, file=sys.stderr)
+        return 0
+
+    # Remove anything left in the new shards by an interrupted reshard
+    for index in range(args.shards):
+        target = data.open_shard(index, args.shards)
+        try:
+            with target.writing():
+                target.clear()
+        finally:
+            target.close()
+
+    # Engines that only one process may open are copied one shard at a time
+    workers = min(args.workers if engine_class(args.engine).multiprocess else 1, current)
+    start = time.time()
+    total = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = [(args.mode, args.engine, current, args.shards, index) for index in range(current)]
+        for index, count in pool.imap_unordered(_split_shard, tasks):
+            total += count
+            print("Shard %d of %d copied with %d reputes in %.1fs" % (index + 1, current, count,
+                                                                     time.time() - start), file=sys.stderr)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Switch to the new shards, then delete the old ones and their saved scores
+    write_shards(data.prefix, args.engine, args.shards)
+    for index in range(current):
+        data.create_shard(index, current).remove()
+        path = scores_path(shard_prefix(data.prefix, index, current), args.engine)
+        if os.path.exists(path):
+            os.remove(path)
+
+    print("%d reputes moved from %d to %d shards in %.1fs" % (total, current, args.shards, time.time() - start),
+          file=sys.stderr)
+    return 0
+
+# ================================================== #
+
+
+# Define function to copy the reputes of one old shard into the new
+# shards in a worker process. Every reputee's version is copied too, so
+# versions keep counting up from where they were and an ETag handed
+# out before the reshard never matches different scores after it.
+def _split_shard(task):
+    mode, engine, current, shards, index = task
+    data = Data(mode, engine)
+    source = data.open_shard(index, current)
+    targets = [data.open_shard(target_index, shards) for target_index in range(shards)]
+    count = 0
+    try:
+        with source.reading():
+            chunks = [[] for _ in targets]
+            for record in source.iter_reputes():
+                target_index = shard_index(record.reputee, shards)
+                chunks[target_index].append((record.key, record))
+                if len(chunks[target_index]) >= RESHARD_CHUNK_SIZE:
+                    count += _write_chunk(targets[target_index], chunks[target_index])
+                    chunks[target_index] = []
+            for target, chunk in zip(targets, chunks):
+                count += _write_chunk(target, chunk)
+
+            versions = [{} for _ in targets]
+            for reputee, version in source.iter_versions():
+                versions[shard_index(reputee, shards)][reputee] = version
+        for target, target_versions in zip(targets, versions):
+            with target.writing():
+                target.raise_versions(target_versions)
+    finally:
+        source.close()
+        for target in targets:
+            target.close()
+
+    return index, count
+
+# ================================================== #
+
+
+# Define function to write a chunk of (key, record) pairs to a shard
+def _write_chunk(engine, chunk):
+    with engine.writing():
+        return sum(engine.put_many(chunk))
+
+# ================================================== #
+
+
+# Define function to rebuild everything derived from the reputes after a
+# scoring change or restoring a backup. Every shard is split into
+# partitions of its reputees, and each partition is rebuilt and then
+# scored by a worker process, so even an unsharded database is rebuilt
+# in parallel. Once every partition of a shard is finished their scores
+# are combined and saved for the leaderboard. Finished partitions are
+# recorded in a progress file, so an interrupted rebuild carries on
+# where it stopped.
+def rebuild(args):
+    data = Data(args.mode, args.engine)
+    shards = read_shards(data.prefix, args.engine)
+    path = os.path.join(DIRECTORY, data.prefix + 'rebuild.' + args.engine)
+
+    # Resume with the partitions of an earlier run unless told to start over
+    # or given a different number. Engines that only one process may open
+    # are rebuilt whole, one shard at a time.
+    multiprocess = engine_class(args.engine).multiprocess
+    previous, done = (None, set()) if args.restart else _read_progress(path, shards)
+    if not multiprocess:
+        partitions = 1
+    elif args.partitions:
+        partitions = args.partitions
+    else:
+        partitions = previous or max(1, -(-args.workers // shards))
+    if partitions != previous:
+        done = set()
+
+    # Rebuild the finished partitions again if their scores are missing
+    done = set((index, partition) for index, partition in done
+               if os.path.exists(_partition_scores_path(data.prefix, args.engine, index, shards, partition,
+                                                        partitions)))
+    pending = [(index, partition) for index in range(shards) for partition in range(partitions)
+               if (index, partition) not in done]
+    if done:
+        print("Resuming with %d of %d partitions already rebuilt." % (len(done), shards * partitions),
+              file=sys.stderr)
+
+    workers = max(1, min(args.workers if multiprocess else 1, len(pending)))
+    start = time.time()
+    total = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = [(args.mode, args.engine, shards, index, partition, partitions) for index, partition in pending]
+        for index, partition, reputees, scored in pool.imap_unordered(_rebuild_partition, tasks):
+            done.add((index, partition))
+            # Save the shard's scores before recording its last partition,
+            # so a shard recorded as finished always has them
+            if partitions > 1 and all((index, other) in done for other in range(partitions)):
+                _merge_scores(data.prefix, args.engine, index, shards, partitions)
+            _write_progress(path, shards, partitions, done)
+            total += reputees
+            print("Partition %d of %d of shard %d of %d rebuilt with %d reputees (%d scored) in %.1fs, "
+                  "%d of %d partitions done" % (partition + 1, partitions, index + 1, shards, reputees, scored,
+                                                time.time() - start, len(done), shards * partitions),
+                  file=sys.stderr)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Remove the progress and the scores of every partition
+    os.remove(path)
+    for index in range(shards):
+        for partial in glob.glob(scores_path(shard_prefix(data.prefix, index, shards), args.engine) + '.part*'):
+            os.remove(partial)
+    print("%d reputees in %d partitions of %d shards rebuilt in %.1fs" %
+          (total, len(pending), shards, time.time() - start), file=sys.stderr)
+    return 0
+
+# ================================================== #
+
+
+# Define function to rebuild and score one partition of a shard in a worker process
+def _rebuild_partition(task):
+    mode, engine, shards, index, partition, partitions = task
+    data = Data(mode, engine)
+    target = data.open_shard(index, shards)
+    try:
+        aggregates = target.rebuild(partition, partitions)
+    finally:
+        target.close()
+
+    # Score the reputees the same way a GET does and save them in one step
+    scores = score_aggregates(aggregates.items())
+    save_scores(_partition_scores_path(data.prefix, engine, index, shards, partition, partitions), scores)
+    return index, partition, len(aggregates), len(scores)
+
+# ================================================== #
+
+
+# Define function to get the path of the file holding the scores of a
+# partition of a shard. A shard rebuilt whole saves the shard's scores.
+def _partition_scores_path(prefix, engine, index, shards, partition, partitions):
+    path = scores_path(shard_prefix(prefix, index, shards), engine)
+    return path if partitions == 1 else "%s.part%d-of-%d" % (path, partition, partitions)
+
+# ================================================== #
+
+
+# Define function to combine the scores of every partition of a shard
+# into the shard's scores. They are dated by the oldest partition's, so
+# the leaderboard never takes them for newer than they are.
+def _merge_scores(prefix, engine, index, shards, partitions):
+    created = time.time()
+    scores = {}
+    for partition in range(partitions):
+        saved = load_scores(_partition_scores_path(prefix, engine, index, shards, partition, partitions))
+        created = min(created, saved[0])
+        scores.update(saved[1])
+
+    save_scores(scores_path(shard_prefix(prefix, index, shards), engine), scores, created)
+
+# ================================================== #
+
+
+# Define function to read the number of partitions and the (shard,
+# partition) pairs finished by an earlier rebuild. The progress is
+# ignored if the database has been resharded since.
+def _read_progress(path, shards):
+    try:
+        with open(path) as file:
+            progress = json.loads(file.read())
+    except (OSError, ValueError):
+        return None, set()
+
+    if progress.get("shards") != shards or "partitions" not in progress:
+        return None, set()
+    return progress["partitions"], set(tuple(pair) for pair in progress["done"])
+
+# ================================================== #
+
+
+# Define function to record the partitions a rebuild has finished. The file
+# is replaced in one step, so an interrupted write never loses progress.
+def _write_progress(path, shards, partitions, done):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        file.write(json.dumps({"shards": shards, "partitions": partitions, "done": sorted(done)}))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+# ================================================== #
+#                        MAIN                        #
+# ================================================== #
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reputation API maintenance commands.")
+    parser.add_argument("--mode", default="Production", help="Database mode (Production or Development).")
+    parser.add_argument("--engine", default="shelve", choices=sorted(ENGINES), help="Storage engine.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    verify_parser = commands.add_parser("verify", help="Check stored aggregates against the raw reputes.")
+    verify_parser.add_argument("--repair", action="store_true", help="Rebuild the aggregates if any drifted.")
+    verify_parser.set_defaults(func=verify)
+
+    import_parser = commands.add_parser("import", help="Import reputes from an NDJSON file.")
+    import_parser.add_argument("file", help="NDJSON file of reputes in the POST format, or - for stdin.")
+    import_parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                               help="Number of processes used to parse the file.")
+    import_parser.set_defaults(func=import_reputes)
+
+    export_parser = commands.add_parser("export", help="Export every repute to an NDJSON file.")
+    export_parser.add_argument("file", help="File to write, or - for stdout.")
+    export_parser.set_defaults(func=export_reputes)
+
+    migrate_parser = commands.add_parser("migrate", help="Convert reputes stored by earlier versions to the "
+                                                         "compact record format.")
+    migrate_parser.set_defaults(func=migrate)
+
+    reshard_parser = commands.add_parser("reshard", help="Split or merge the database's shards. The API must be "
+                                                         "stopped first.")
+    reshard_parser.add_argument("shards", type=int, help="New number of shards.")
+    reshard_parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                                help="Number of processes used to write the new shards.")
+    reshard_parser.set_defaults(func=reshard)
+
+    rebuild_parser = commands.add_parser("rebuild", help="Rebuild the indexes and aggregates from the raw reputes "
+                                                         "and save every reputee's scores.")
+    rebuild_parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                                help="Number of processes used to rebuild the partitions.")
+    rebuild_parser.add_argument("--partitions", type=int,
+                                help="Number of partitions each shard's reputees are split into (by default "
+                                     "enough to give every worker one, or those of an interrupted rebuild).")
+    rebuild_parser.add_argument("--restart", action="store_true",
+                                help="Rebuild every partition, even those finished by an interrupted rebuild.")
+    rebuild_parser.set_defaults(func=rebuild)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
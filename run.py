@@ -1,28 +1,68 @@
 # ================================================== #
-#                        RUN                         #
+#                        RUN                         #
 # ================================================== #
 # Author: Brady Hammond                              #
 # Created: 12/01/2017                                #
 # Last Edited: N/A                                   #
 # Last Edited By: N/A                                #
 # ================================================== #
-#                      IMPORTS                       #
+#                      IMPORTS                       #
 # ================================================== #
 
 
-from app.api.api import ReputationAPI
+from app.api.api import CacheAPI, LeaderboardAPI, ReputationAPI, ReputerAPI, ReputesAPI
+from app.api.metrics import MetricsAPI, TimingMiddleware
+from app import config
+import atexit
 import falcon
 
 
 # ================================================== #
-#                        MAIN                        #
+#                FUNCTION DEFINITIONS                #
 # ================================================== #
 
 
-app = falcon.API()
-api = ReputationAPI()
-app.add_route('/reputation/', api)
-app.add_route('/reputation/{reputee}', api)
+# Define function to create the app. The engine, its options and any
+# ReputationAPI setting that is not given are read from the environment
+# (see app/config.py). With preload the leaderboard is mapped before the
+# app is returned, so "gunicorn --preload 'run:create_app()'" builds it
+# once in the master and every worker shares it.
+def create_app(mode="Production", engine=None, engine_options=None, preload=True, **settings):
+    engine = engine or config.engine()
+    if engine_options is None:
+        engine_options = config.engine_options(engine)
+    settings = dict(config.api_settings(), **settings)
+
+    app = falcon.API(middleware=[TimingMiddleware()])
+    api = ReputationAPI(mode=mode, engine=engine, engine_options=engine_options, **settings)
+    app.add_route('/reputation/', api)
+    app.add_route('/reputation/{reputee}', api)
+    app.add_route('/reputation/{reputee}/reputes', ReputesAPI(api))
+    app.add_route('/reputers/{reputer}', ReputerAPI(api))
+    app.add_route('/cache', CacheAPI(api))
+    app.add_route('/leaderboard', LeaderboardAPI(api))
+    app.add_route('/metrics', MetricsAPI(api))
+
+    # Close the worker's database handle when it shuts down
+    atexit.register(api.close)
+
+    if preload:
+        api.preload()
+    return app
+
+# ================================================== #
+
+
+# Define function to create the app the first time run.app is read, so
+# "gunicorn run:app" still works but importing this module builds nothing.
+# The leaderboard is mapped by its first request rather than while
+# every worker boots. Call create_app with --preload to map it once.
+def __getattr__(name):
+    global app
+    if name != "app":
+        raise AttributeError("module 'run' has no attribute " + repr(name))
+    app = create_app(preload=False)
+    return app
 
 
 # ================================================== #
@@ -10,14 +10,29 @@
 # ================================================== #
 
 
-from app.api.api import ReputationAPI
+from app.api import processor
+from app.api.api import CacheAPI, LeaderboardAPI, ReputationAPI, ReputerAPI, ReputesAPI
+from app.api.async_api import (AsyncCacheAPI, AsyncLeaderboardAPI, AsyncMetricsAPI, AsyncReputationAPI,
+                               AsyncReputerAPI, AsyncReputesAPI, asgi, create_asgi_app)
+from app.api.metrics import MetricsAPI, TimingMiddleware
+from app.api.cache import ResponseCache
+from app.api.leaderboard import Leaderboard
+from app.metrics import REGISTRY
 from app.storage.storage import Data
+from concurrent.futures import ThreadPoolExecutor
 import falcon
 from falcon import testing
 try:
     import ujson as json
 except ImportError:
     import json
+import os
+import run
+import struct
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 
@@ -27,18 +42,40 @@ import unittest
 
 
 class APITestCase(testing.TestCase):
+    engine = "shelve"
+    resource_class = ReputationAPI
+    cache_class = CacheAPI
+    leaderboard_class = LeaderboardAPI
+    metrics_class = MetricsAPI
+    reputes_class = ReputesAPI
+    reputer_class = ReputerAPI
+    resource_options = {}
+    write_operation = "add"
+
     def setUp(self):
         super(APITestCase, self).setUp()
-        self.app = falcon.API()
-        api = ReputationAPI(mode="Development")
-        self.app.add_route('/reputation/', api)
-        self.app.add_route('/reputation/{reputee}', api)
+        self.app = self.create_app()
+        self.resource = self.resource_class(mode="Development", engine=self.engine, **self.resource_options)
+        self.app.add_route('/reputation', self.resource)
+        self.app.add_route('/reputation/{reputee}', self.resource)
+        self.app.add_route('/reputation/{reputee}/reputes', self.reputes_class(self.resource))
+        self.app.add_route('/reputers/{reputer}', self.reputer_class(self.resource))
+        self.app.add_route('/cache', self.cache_class(self.resource))
+        self.app.add_route('/leaderboard', self.leaderboard_class(self.resource))
+        self.app.add_route('/metrics', self.metrics_class(self.resource))
+        REGISTRY.clear()
+
+    # ============================================= #
+
+    def create_app(self):
+        return falcon.API(middleware=[TimingMiddleware()])
 
     # ============================================= #
 
     def tearDown(self):
         super(APITestCase, self).tearDown()
-        data = Data("Development")
+        self.resource.close()
+        data = Data("Development", self.engine)
         data.open()
         data.clear()
         data.close()
@@ -177,6 +214,600 @@ class TestAPI(APITestCase):
         self.assertEqual(result.text, '{"reputee":"Test","clout":{"score":0.6416666667,"confidence":0.5},"reach":{"score":4.5,"confidence":0.5},"clarity":{"score":8.3333333333,"confidence":0.5}}')
 
 
+    # ============================================= #
+
+    def test_post_invalid_value(self):
+        for value in ("7", None, True, [1], 2 ** 63):
+            result = self.simulate_post('/reputation', body=json.dumps({"reputer": "Test", "reputee": "Test",
+                                        "repute": {"rid": "1", "feature": "clarity", "value": value}}),
+                                        headers={"Content-Type": "application/json"})
+            self.assertEqual(result.status_code, 400)
+
+        # Nothing was stored, so the repute can still be created
+        result = self.simulate_post('/reputation', body=json.dumps({"reputer": "Test", "reputee": "Test", "repute":
+                                    {"rid": "1", "feature": "clarity", "value": 7}}),
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 201)
+
+    # ============================================= #
+
+    def test_post_long_strings(self):
+        long = "x" * 65536
+        for reputer, rid, feature in ((long, "1", "clarity"), ("Test", long, "clarity"), ("Test", "1", long)):
+            result = self.simulate_post('/reputation', body=json.dumps({"reputer": reputer, "reputee": "Test",
+                                        "repute": {"rid": rid, "feature": feature, "value": 7}}),
+                                        headers={"Content-Type": "application/json"})
+            self.assertEqual(result.status_code, 400)
+
+        # A long item fails on its own in a bulk POST, and the longest strings allowed are stored
+        result = self.simulate_post('/reputation', body=json.dumps([
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": long, "feature": "clarity", "value": 10}},
+            {"reputer": long[1:], "reputee": "Test", "repute": {"rid": long[1:], "feature": "reach", "value": 4}}]),
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual([item["status"] for item in json.loads(result.text)["results"]], [400, 201])
+
+    # ============================================= #
+
+    def test_post_bulk_array(self):
+        result = self.simulate_post('/reputation', body=json.dumps([
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": "1", "feature": "clarity", "value": 10}},
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": "1", "feature": "clarity", "value": 10}},
+            {"reputer": "Test", "reputee": "Test", "wrong_key": {"rid": "2", "feature": "clarity", "value": 10}},
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": "3", "feature": "reach", "value": 4}}]),
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.text)
+        self.assertEqual((body["created"], body["duplicate"], body["invalid"]), (2, 1, 1))
+        self.assertEqual([item["status"] for item in body["results"]], [201, 200, 400, 201])
+        self.assertEqual(body["results"][1]["message"], "rid-1 already exists.")
+
+    # ============================================= #
+
+    def test_post_bulk_wrong_types(self):
+        result = self.simulate_post('/reputation', body=json.dumps([
+            {"reputer": 7, "reputee": "Test", "repute": {"rid": "1", "feature": "clarity", "value": 10}},
+            {"reputer": "Test", "reputee": ["Test"], "repute": {"rid": "2", "feature": "clarity", "value": 10}},
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": "3", "feature": "reach", "value": "4"}},
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": 4, "feature": "reach", "value": 4}},
+            {"reputer": "Test", "reputee": "Test", "repute": {"rid": "5", "feature": "reach", "value": 2 ** 63}}]),
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.text)
+        self.assertEqual((body["created"], body["duplicate"], body["invalid"]), (1, 0, 4))
+        self.assertEqual([item["status"] for item in body["results"]], [400, 400, 400, 201, 400])
+
+    # ============================================= #
+
+    def test_post_bulk_ndjson(self):
+        lines = [json.dumps({"reputer": "Test", "reputee": "Test", "repute": {"rid": "1", "feature": "clarity",
+                                                                              "value": 10}}),
+                 '{"reputer": "Test",',
+                 json.dumps({"reputer": "Test", "reputee": "Test", "repute": {"rid": "2", "feature": "clarity",
+                                                                              "value": 8}})]
+        result = self.simulate_post('/reputation', body="\n".join(lines) + "\n",
+                                    headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.text)
+        self.assertEqual([item["status"] for item in body["results"]], [201, 422, 201])
+
+    # ============================================= #
+
+    def test_post_bulk_large(self):
+        reputes = [{"reputer": "Test", "reputee": "Test", "repute": {"rid": str(rid), "feature": "reach",
+                                                                     "value": 5}} for rid in range(1200)]
+        result = self.simulate_post('/reputation', body=json.dumps(reputes),
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.text)["created"], 1200)
+
+        result = self.simulate_get('/reputation/Test')
+        self.assertEqual(json.loads(result.text)["reach"], {"score": 5, "confidence": 1})
+
+    # ============================================= #
+
+    def test_post_bulk_malformed_array(self):
+        result = self.simulate_post('/reputation', body='[{"reputer": "Test", "reputee": "Test", "repute": '
+                                                         '{"rid": "1", "feature": "reach", "value": 5}}, {"rep',
+                                    headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.text)
+        self.assertEqual([item["status"] for item in body["results"]], [201, 422])
+
+
+    # ============================================= #
+
+    def test_get_batch(self):
+        reputes = [{"reputer": "Test", "reputee": reputee, "repute": {"rid": str(rid), "feature": feature,
+                                                                      "value": value}}
+                   for reputee, count in (("A", 3), ("B", 8))
+                   for rid, (feature, value) in enumerate([("clarity", 9), ("reach", 4)] * count)]
+        reputes.append({"reputer": "Test", "reputee": "C", "repute": {"rid": "1", "feature": "reach", "value": 1}})
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+
+        for numpy in (processor.load_numpy(), None):
+            processor.numpy, original = numpy, processor.numpy
+            try:
+                result = self.simulate_get('/reputation/', query_string='reputee=A&reputee=Missing&reputee=B'
+                                                                        '&reputee=C')
+            finally:
+                processor.numpy = original
+            self.assertEqual(result.status_code, 200)
+            results = json.loads(result.text)["results"]
+
+            # Compare the reprs, so an int and a float of the same value differ
+            self.assertEqual(repr(results[0]), repr(json.loads(self.simulate_get('/reputation/A').text)))
+            self.assertEqual(results[1], {"reputee": "Missing", "status": 400, "title": "Error",
+                                          "description": "Reputee could not be found."})
+            self.assertEqual(repr(results[2]), repr(json.loads(self.simulate_get('/reputation/B').text)))
+            self.assertEqual(results[3]["status"], 500)
+
+
+    # ============================================= #
+
+    def test_get_cached(self):
+        repute = {"reputer": "Test", "reputee": "Test", "repute": {"rid": "reach", "feature": "reach", "value": 4}}
+        reputes = [dict(repute, repute={"rid": str(rid), "feature": "clarity", "value": 8}) for rid in range(8)]
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+        first = self.simulate_get('/reputation/Test').text
+        self.assertEqual(self.simulate_get('/reputation/Test').text, first)
+        stats = json.loads(self.simulate_get('/cache').text)
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+        # A POST through another worker's API object invalidates the cached response
+        other = ReputationAPI(mode="Development", engine=self.engine)
+        other.on_post(falcon.Request(testing.create_environ(body=json.dumps(repute))), falcon.Response())
+        other.close()
+
+        second = self.simulate_get('/reputation/Test').text
+        self.assertNotEqual(second, first)
+        self.assertEqual(json.loads(second)["reach"]["score"], 4)
+        stats = json.loads(self.simulate_get('/cache').text)
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    # ============================================= #
+
+    def test_get_after_repair(self):
+        repute = {"reputer": "Test", "reputee": "Test", "repute": {"rid": "reach", "feature": "reach", "value": 4}}
+        reputes = [dict(repute, repute={"rid": str(rid), "feature": "clarity", "value": 8}) for rid in range(8)]
+        self.simulate_post('/reputation', body=json.dumps(reputes + [repute]),
+                           headers={"Content-Type": "application/json"})
+        expected = self.simulate_get('/reputation/Test').text
+
+        # Cache a response built from drifted aggregates
+        data = self.resource.get_data()
+        with data.writing() as engine:
+            engine.replace_aggregates({"Test": {"clarity": (8, 64), "reach": (1, 9)}})
+        drifted = self.simulate_get('/reputation/Test')
+        self.assertNotEqual(drifted.text, expected)
+
+        # Repairing the aggregates changes the version, so the cached response and its ETag are not reused
+        data.rebuild_aggregates()
+        repaired = self.simulate_get('/reputation/Test', headers={"If-None-Match": drifted.headers["ETag"]})
+        self.assertEqual(repaired.status_code, 200)
+        self.assertEqual(repaired.text, expected)
+
+    # ============================================= #
+
+    def test_get_conditional(self):
+        repute = {"reputer": "Test", "reputee": "Test", "repute": {"rid": "reach", "feature": "reach", "value": 4}}
+        reputes = [dict(repute, repute={"rid": str(rid), "feature": "clarity", "value": 8}) for rid in range(8)]
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+        first = self.simulate_get('/reputation/Test')
+        etag = first.headers["ETag"]
+        scored = REGISTRY.get("reputation_processor_reputees_scored_total")
+
+        # An unchanged reputee is answered with 304 without being scored
+        for header in (etag, "W/" + etag, '"other", ' + etag):
+            result = self.simulate_get('/reputation/Test', headers={"If-None-Match": header})
+            self.assertEqual(result.status, falcon.HTTP_304)
+            self.assertEqual(result.headers["ETag"], etag)
+            self.assertEqual(result.text, "")
+        self.assertEqual(REGISTRY.get("reputation_processor_reputees_scored_total"), scored)
+
+        # A new repute changes the ETag, while a duplicate does not
+        self.simulate_post('/reputation', body=json.dumps(reputes[0]))
+        self.assertEqual(self.simulate_get('/reputation/Test', headers={"If-None-Match": etag}).status,
+                         falcon.HTTP_304)
+        self.simulate_post('/reputation', body=json.dumps(repute))
+        second = self.simulate_get('/reputation/Test', headers={"If-None-Match": etag})
+        self.assertEqual(second.status, falcon.HTTP_200)
+        self.assertNotEqual(second.headers["ETag"], etag)
+        self.assertEqual(json.loads(second.text)["reach"]["score"], 4)
+
+    # ============================================= #
+
+    def test_get_reputes(self):
+        reputes = [{"reputer": "R" + str(rid % 3), "reputee": "Test",
+                    "repute": {"rid": str(rid), "feature": "reach" if rid % 2 else "clarity", "value": rid % 10}}
+                   for rid in range(250)]
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+
+        # Walk every page, following the cursor on the last line
+        pages = []
+        query = 'limit=100'
+        while query is not None:
+            result = self.simulate_get('/reputation/Test/reputes', query_string=query)
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.headers["Content-Type"], "application/x-ndjson")
+            lines = [json.loads(line) for line in result.text.splitlines()]
+            pages.append(lines[:-1])
+            cursor = lines[-1]["next_cursor"]
+            query = None if cursor is None else 'limit=100&cursor=' + cursor
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+        self.assertEqual([record for page in pages for record in page], reputes)
+
+        # Filter by feature and reputer
+        result = self.simulate_get('/reputation/Test/reputes', query_string='feature=reach&reputer=R1&limit=10')
+        lines = [json.loads(line) for line in result.text.splitlines()]
+        expected = [repute for repute in reputes if repute["reputer"] == "R1" and repute["repute"]["feature"] == "reach"]
+        self.assertEqual(lines[:-1], expected[:10])
+        result = self.simulate_get('/reputation/Test/reputes', query_string='feature=reach&reputer=R1&limit=100&'
+                                                                            'cursor=' + lines[-1]["next_cursor"])
+        lines = [json.loads(line) for line in result.text.splitlines()]
+        self.assertEqual(lines, expected[10:] + [{"next_cursor": None}])
+
+    # ============================================= #
+
+    def test_get_reputes_invalid(self):
+        self.simulate_post('/reputation', body=json.dumps({"reputer": "R", "reputee": "Test",
+                                                           "repute": {"rid": "1", "feature": "reach", "value": 1}}))
+        for path, query in (('/reputation/Missing/reputes', ''), ('/reputation/Test/reputes', 'limit=0'),
+                            ('/reputation/Test/reputes', 'limit=x'), ('/reputation/Test/reputes', 'cursor=abc'),
+                            ('/reputation/Test/reputes', 'feature=reach&feature=clarity'),
+                            ('/reputation/Test/reputes', 'cursor=WzBd&cursor=WzBd')):
+            self.assertEqual(self.simulate_get(path, query_string=query).status, falcon.HTTP_400)
+
+    # ============================================= #
+
+    def test_get_reputer(self):
+        # Flood reputee A with reach reputes, and post a few to B and C
+        reputes = [{"reputer": "Flooder", "reputee": "A", "repute": {"rid": str(rid), "feature": "reach", "value": 10}}
+                   for rid in range(30)]
+        reputes += [{"reputer": "Flooder", "reputee": reputee, "repute": {"rid": reputee + str(rid),
+                     "feature": "clarity", "value": 1}} for reputee, count in (("B", 3), ("C", 2)) for rid in range(count)]
+        reputes.append({"reputer": "Other", "reputee": "A", "repute": {"rid": "other", "feature": "reach", "value": 1}})
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+
+        result = self.simulate_get('/reputers/Flooder', query_string='limit=2')
+        self.assertEqual(result.status, falcon.HTTP_200)
+        self.assertEqual(json.loads(result.text), {
+            "reputer": "Flooder", "count": 35, "features": {"reach": 30, "clarity": 5}, "reputee_count": 3,
+            "reputees": [{"reputee": "A", "count": 30, "features": {"reach": 30}},
+                         {"reputee": "B", "count": 3, "features": {"clarity": 3}}]})
+        self.assertEqual(json.loads(self.simulate_get('/reputers/Other').text)["reputees"],
+                         [{"reputee": "A", "count": 1, "features": {"reach": 1}}])
+
+        self.assertEqual(self.simulate_get('/reputers/Missing').status, falcon.HTTP_400)
+        self.assertEqual(self.simulate_get('/reputers/Flooder', query_string='limit=0').status, falcon.HTTP_400)
+
+    # ============================================= #
+
+    def test_leaderboard(self):
+        # Reputee N gets N clarity reputes of value N and N reach reputes of value 10 - N
+        reputes = [{"reputer": "Test", "reputee": "R" + str(count), "repute": {"rid": feature + str(rid),
+                    "feature": feature, "value": count if feature == "clarity" else 10 - count}}
+                   for count in range(1, 10) for rid in range(count) for feature in ("clarity", "reach")]
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+
+        # Every entry matches what a GET returns
+        result = self.simulate_get('/leaderboard', query_string='by=clarity&limit=3')
+        self.assertEqual(result.status_code, 200)
+        body = json.loads(result.text)
+        self.assertEqual([item["reputee"] for item in body["results"]], ["R9", "R8", "R7"])
+        self.assertEqual(body["results"][0], json.loads(self.simulate_get('/reputation/R9').text))
+
+        # Walk the rest of the ranking with the cursor
+        result = self.simulate_get('/leaderboard', query_string='by=clarity&limit=3&cursor=' + body["next_cursor"])
+        body = json.loads(result.text)
+        self.assertEqual([item["reputee"] for item in body["results"]], ["R6", "R5", "R4"])
+        result = self.simulate_get('/leaderboard', query_string='by=clarity&limit=3&cursor=' + body["next_cursor"])
+        body = json.loads(result.text)
+        # R1 and R2 have 0 confidence in both features, so they cannot be scored
+        self.assertEqual([item["reputee"] for item in body["results"]], ["R3"])
+        self.assertIsNone(body["next_cursor"])
+
+        # Reach is ranked the other way and can be filtered by confidence
+        result = self.simulate_get('/leaderboard', query_string='by=reach&min_confidence=1')
+        self.assertEqual([item["reputee"] for item in json.loads(result.text)["results"]], ["R6", "R7", "R8", "R9"])
+
+        # A POST moves its reputee without a rebuild
+        scores = [item["clout"]["score"] for item in json.loads(self.simulate_get('/leaderboard').text)["results"]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.simulate_post('/reputation', body=json.dumps({"reputer": "Test", "reputee": "R3", "repute":
+                           {"rid": "extra", "feature": "clarity", "value": 100}}),
+                           headers={"Content-Type": "application/json"})
+        result = self.simulate_get('/leaderboard', query_string='by=clarity&limit=1')
+        self.assertEqual(json.loads(result.text)["results"][0], json.loads(self.simulate_get('/reputation/R3').text))
+
+    # ============================================= #
+
+    def test_leaderboard_shared(self):
+        reputes = [{"reputer": "Test", "reputee": "R" + str(count), "repute": {"rid": feature + str(rid),
+                    "feature": feature, "value": count}}
+                   for count in range(1, 6) for rid in range(6) for feature in ("clarity", "reach")]
+        self.simulate_post('/reputation', body=json.dumps(reputes), headers={"Content-Type": "application/json"})
+        expected = [item["reputee"] for item in json.loads(self.simulate_get('/leaderboard').text)["results"]]
+        self.assertEqual(expected, ["R5", "R4", "R3", "R2", "R1"])
+
+        # Another worker maps the snapshot written by the first instead of scoring every reputee
+        REGISTRY.clear()
+        other = Leaderboard()
+        results, next_cursor = other.page(self.resource.get_data(), "clout", 3)
+        self.assertEqual(REGISTRY.get("reputation_processor_reputees_scored_total"), 0)
+        self.assertEqual([reputee for reputee, _ in results], expected[:3])
+        results, next_cursor = other.page(self.resource.get_data(), "clout", 3, cursor=next_cursor)
+        self.assertEqual([reputee for reputee, _ in results], expected[3:])
+        self.assertIsNone(next_cursor)
+
+        # A rebuilt snapshot includes the reputees rescored since the last one
+        self.simulate_post('/reputation', body=json.dumps({"reputer": "Test", "reputee": "R1", "repute":
+                           {"rid": "extra", "feature": "clarity", "value": 100}}),
+                           headers={"Content-Type": "application/json"})
+        self.resource.leaderboard.refresh_interval = 0
+        result = self.simulate_get('/leaderboard', query_string='limit=1')
+        self.assertEqual(json.loads(result.text)["results"][0], json.loads(self.simulate_get('/reputation/R1').text))
+        self.assertEqual(self.resource.leaderboard.scores, {})
+
+    # ============================================= #
+
+    def test_leaderboard_rebuild_unlocked(self):
+        data = self.resource.get_data()
+        data.add_many([("Test", "R1", feature + str(rid), feature, 5) for rid in range(6)
+                       for feature in ("clarity", "reach")])
+        board = Leaderboard(refresh_interval=0)
+        board.page(data, "clout", 10)
+
+        # Hold up the next rebuild until a rescore has finished
+        started = threading.Event()
+        release = threading.Event()
+        rebuild = board.rebuild
+
+        def slow_rebuild(*args):
+            started.set()
+            release.wait(5)
+            rebuild(*args)
+
+        board.rebuild = slow_rebuild
+        pages = []
+        reader = threading.Thread(target=lambda: pages.append(board.page(data, "clout", 10)))
+        reader.start()
+        self.assertTrue(started.wait(5))
+
+        data.add_many([("Test", "R2", feature + str(rid), feature, 8) for rid in range(6)
+                       for feature in ("clarity", "reach")])
+        writer = threading.Thread(target=board.update, args=(data, ["R2"]))
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        release.set()
+        reader.join(5)
+
+        # The rebuilt snapshot includes the rescored reputee
+        self.assertEqual([reputee for reputee, _ in pages[0][0]], ["R2", "R1"])
+        board.snapshot.close()
+
+    # ============================================= #
+
+    def test_leaderboard_invalid(self):
+        for query_string in ('by=fame', 'limit=0', 'limit=ten', 'min_confidence=2', 'cursor=!', 'cursor=a&cursor=b'):
+            result = self.simulate_get('/leaderboard', query_string=query_string)
+            self.assertEqual(result.status_code, 400)
+
+    # ============================================= #
+
+    def test_metrics(self):
+        repute = {"reputer": "Test", "reputee": "Test", "repute": {"rid": "1", "feature": "reach", "value": 4}}
+        self.simulate_post('/reputation', body=json.dumps(repute), headers={"Content-Type": "application/json"})
+        self.simulate_post('/reputation', body=json.dumps(repute), headers={"Content-Type": "application/json"})
+        self.simulate_get('/reputation/Missing')
+
+        result = self.simulate_get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.headers['content-type'].startswith('text/plain'))
+        lines = result.text.splitlines()
+        self.assertIn('reputation_requests_total{method="POST",route="/reputation",status="201"} 1', lines)
+        self.assertIn('reputation_requests_total{method="POST",route="/reputation",status="200"} 1', lines)
+        self.assertIn('reputation_requests_total{method="GET",route="/reputation/{reputee}",status="400"} 1',
+                      lines)
+        self.assertIn('reputation_request_duration_seconds_count{method="POST",route="/reputation"} 2', lines)
+        self.assertIn('# TYPE reputation_request_duration_seconds histogram', lines)
+        self.assertIn('reputation_storage_records_written_total 1', lines)
+        self.assertIn('reputation_storage_duplicates_total 1', lines)
+        self.assertIn('reputation_storage_operation_duration_seconds_count{engine="%s",operation="%s"} 2'
+                      % (self.engine, self.write_operation), lines)
+        self.assertIn('reputation_cache_misses_total 1', lines)
+
+    # ============================================= #
+
+    def test_cache_eviction(self):
+        cache = ResponseCache(2)
+        cache.put("A", 1, "a")
+        cache.put("B", 1, "b")
+        self.assertEqual(cache.get("A", 1), "a")
+        cache.put("C", 1, "c")
+        self.assertIsNone(cache.get("B", 1))
+        self.assertIsNone(cache.get("A", 2))
+        self.assertEqual(cache.stats(), {"size": 2, "max_size": 2, "hits": 1, "misses": 2, "evictions": 1})
+
+
+# ================================================== #
+
+
+class TestSQLiteAPI(TestAPI):
+    engine = "sqlite"
+
+
+# ================================================== #
+
+
+class TestLogAPI(TestAPI):
+    engine = "log"
+
+    # ============================================= #
+
+    @unittest.skip("A log can only be opened by one process at a time.")
+    def test_get_cached(self):
+        pass
+
+
+# ================================================== #
+
+
+class TestBatchedAPI(TestAPI):
+    resource_options = {"write_batch_size": 16, "write_batch_wait": 0.005}
+    write_operation = "add_many"
+
+    # ============================================= #
+
+    def test_post_concurrent(self):
+        reputes = [{"reputer": "Test", "reputee": "Test" + str(rid % 4), "repute": {"rid": str(rid),
+                    "feature": "reach", "value": 5}} for rid in range(32)]
+        # Post every repute twice at once, so duplicates land in the same batches
+        bodies = [json.dumps(repute) for repute in reputes] * 2
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(lambda body: self.simulate_post('/reputation', body=body), bodies))
+
+        # Each repute is created exactly once, and every response waited for its commit
+        created = [json.loads(result.text)["message"] for result in results if result.status == falcon.HTTP_201]
+        self.assertEqual(sorted(created), sorted('rid-' + str(rid) + ' successfully created.' for rid in range(32)))
+        self.assertEqual(len(self.resource.get_data().get_keys("Test0")), 8)
+        self.assertLess(REGISTRY.get("reputation_write_batches_total"), 64)
+        self.assertEqual(REGISTRY.get("reputation_write_batch_reputes_total"), 64)
+
+    # ============================================= #
+
+    def test_write_queue_failures(self):
+        writer = self.resource.get_writer()
+        data = writer.data
+
+        # A repute whose value cannot be stored fails without joining a batch
+        futures = [writer.submit(("Test", "Test", str(rid), "reach", 5)) for rid in range(5)]
+        self.assertRaises(TypeError, writer.submit(("Test", "Test", "bad", "reach", "oops")).result)
+        self.assertEqual([future.result() for future in futures], [True] * 5)
+
+        # A batch the database rejects is stored one repute at a time, so only the failing one fails
+        def add_many(reputes):
+            if any(repute[2] == "broken" for repute in reputes):
+                raise RuntimeError("broken")
+            return Data.add_many(data, reputes)
+
+        data.add_many = add_many
+        data.add = lambda *repute: add_many([repute])[0]
+        try:
+            futures = [writer.submit(("Test", "Test", rid, "reach", 5)) for rid in ("5", "broken", "6", "0")]
+            self.assertEqual(futures[0].result(), True)
+            self.assertRaises(RuntimeError, futures[1].result)
+            self.assertEqual([future.result() for future in futures[2:]], [True, False])
+        finally:
+            del data.add_many
+            del data.add
+        self.assertEqual(len(data.get_keys("Test")), 7)
+
+    # ============================================= #
+
+    def test_write_queue_engine_failure(self):
+        writer = self.resource.get_writer()
+        data = writer.data
+
+        # A batch with a repute the engine cannot encode stores none of it
+        long_rid = "x" * 70000
+        self.assertRaises(struct.error, data.add_many, [("Test", "Test", "1", "reach", 5),
+                                                        ("Test", "Test", long_rid, "reach", 5)])
+        self.assertFalse(data.has_reputee("Test"))
+
+        # So the reputes retried one at a time are created rather than found
+        futures = [writer.submit(("Test", "Test", rid, "reach", 5)) for rid in ("1", long_rid, "2")]
+        self.assertEqual(futures[0].result(), True)
+        self.assertRaises(struct.error, futures[1].result)
+        self.assertEqual(futures[2].result(), True)
+        self.assertEqual(sorted(data.get_keys("Test")), ["1-Test-Test", "2-Test-Test"])
+
+
+# ================================================== #
+
+
+@unittest.skipIf(asgi is None, "falcon.asgi requires Falcon 3.0 or later.")
+class TestAsyncAPI(TestAPI):
+    resource_class = AsyncReputationAPI
+    cache_class = AsyncCacheAPI
+    leaderboard_class = AsyncLeaderboardAPI
+    metrics_class = AsyncMetricsAPI
+    reputes_class = AsyncReputesAPI
+    reputer_class = AsyncReputerAPI
+
+    # ============================================= #
+
+    def create_app(self):
+        return create_asgi_app(middleware=[TimingMiddleware()])
+
+
+# ================================================== #
+
+
+class TestAsyncBatchedAPI(TestAsyncAPI):
+    resource_options = {"write_batch_size": 16, "write_batch_wait": 0.005}
+    write_operation = "add_many"
+
+
+# ================================================== #
+
+
+class TestStartup(unittest.TestCase):
+    # Seconds a new process may take to import and create the app
+    cold_start_budget = 2.0
+
+    def tearDown(self):
+        super(TestStartup, self).tearDown()
+        data = Data("Development")
+        data.open()
+        data.clear()
+        data.close()
+
+    # ============================================= #
+
+    def test_cold_start(self):
+        data = Data("Development")
+        data.open()
+        data.add_many([("Test", "R" + str(rid % 10), str(rid), "reach" if rid % 2 else "clarity", 5)
+                       for rid in range(200)])
+        data.close()
+
+        # Build the leaderboard snapshot the way a preloading master does
+        run.create_app(mode="Development", engine="shelve")
+
+        # A new worker maps it rather than scoring every reputee, and
+        # imports neither NumPy nor the engines it does not use
+        script = ("import sys\n"
+                  "import run\n"
+                  "run.create_app(mode='Development', engine='shelve')\n"
+                  "from app.metrics import REGISTRY\n"
+                  "print(REGISTRY.get('reputation_processor_reputees_scored_total'))\n"
+                  "print(' '.join(sorted(set(sys.modules) & {'numpy', 'sqlite3', 'app.storage.log_engine'})))\n")
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(output.decode().split("\n"), ["0", "", ""])
+        self.assertLess(elapsed, self.cold_start_budget, "Cold start took %.3fs" % elapsed)
+
+    # ============================================= #
+
+    def test_lazy_app(self):
+        # Reading run.app builds the app without mapping the leaderboard,
+        # which a worker started without --preload leaves to a request
+        preloaded = []
+        preload = ReputationAPI.preload
+        ReputationAPI.preload = lambda api: preloaded.append(api)
+        try:
+            vars(run).pop("app", None)
+            self.assertIsInstance(run.app, falcon.API)
+        finally:
+            ReputationAPI.preload = preload
+            vars(run).pop("app", None)
+        self.assertEqual(preloaded, [])
+
+
 # ================================================== #
 
 
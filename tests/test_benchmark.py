@@ -0,0 +1,79 @@
+# ================================================== #
+#                   TEST BENCHMARK                   #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/04/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.storage.storage import Data
+import benchmark
+import os
+import tempfile
+import unittest
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            self.assertEqual(benchmark.main(["--mode", "Development", "--sizes", "300,100", "--reputees", "5",
+                                             "--requests", "10", "--output", output]), 0)
+            with open(output) as source:
+                report = json.loads(source.read())
+
+        self.assertEqual(report["parameters"]["sizes"], [100, 300])
+        self.assertEqual([(result["records"], result["operation"]) for result in report["results"]],
+                         [(size, operation) for size in (100, 300) for operation in ("post", "duplicate_post", "get")])
+        for result in report["results"]:
+            self.assertEqual((result["requests"], result["errors"]), (10, 0))
+            self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+            self.assertLessEqual(result["p95_ms"], result["p99_ms"])
+
+        # The benchmark leaves its database empty
+        data = Data("Development")
+        data.open()
+        self.assertFalse(data.has_reputee("reputee0"))
+        data.close()
+
+    # ============================================= #
+
+    def test_same_dataset(self):
+        self.assertEqual(benchmark.make_repute(1, 42, 100, 0.5), benchmark.make_repute(1, 42, 100, 0.5))
+        self.assertNotEqual(benchmark.make_repute(1, 42, 100, 0.5), benchmark.make_repute(2, 42, 100, 0.5))
+
+    # ============================================= #
+
+    def test_compare(self):
+        baseline = {"results": [{"engine": "shelve", "records": 10, "operation": "get",
+                                 "p50_ms": 1.0, "p95_ms": 2.0, "p99_ms": 4.0}]}
+        current = {"results": [{"engine": "shelve", "records": 10, "operation": "get",
+                                "p50_ms": 1.5, "p95_ms": 2.0, "p99_ms": 2.0}]}
+        self.assertEqual(benchmark.compare(baseline, current),
+                         ["shelve 10 get: p50_ms +50.0%, p95_ms +0.0%, p99_ms -50.0%"])
+
+
+# ================================================== #
+
+
+if __name__  == '__main__':
+    unittest.main()
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #
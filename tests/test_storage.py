@@ -0,0 +1,836 @@
+# ================================================== #
+#                    TEST STORAGE                    #
+# ================================================== #
+# Author: Brady Hammond                              #
+# Created: 12/04/2017                                #
+# Last Edited: N/A                                   #
+# Last Edited By: N/A                                #
+# ================================================== #
+#                      IMPORTS                       #
+# ================================================== #
+
+
+from app.api.leaderboard import Leaderboard, save_scores, score_aggregates
+from app.metrics import REGISTRY
+from app.storage.async_storage import AsyncData
+from app.storage import record
+from app.storage import shelve_engine
+from app.storage import storage
+from app.storage.bloom import BloomFilter
+from app.storage.engine import partition_index
+from app.storage.record import Repute
+from app.storage.storage import Data, DIRECTORY, engine_class, read_shards
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import dbm
+import glob
+import json
+import manage
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+
+# ================================================== #
+#                FUNCTION DEFINITIONS                #
+# ================================================== #
+
+
+def add_reputes(engine, reputer, count):
+    data = Data("Development", engine)
+    data.open()
+    for rid in range(count):
+        data.add(reputer, "Test", str(rid), "reach", 1)
+    data.close()
+
+
+# ================================================== #
+#                  CLASS DEFINITIONS                 #
+# ================================================== #
+
+
+class StorageTestCase(unittest.TestCase):
+    engine = "shelve"
+
+    def setUp(self):
+        super(StorageTestCase, self).setUp()
+        self.data = Data("Development", self.engine)
+        self.data.open()
+
+    # ============================================= #
+
+    def tearDown(self):
+        super(StorageTestCase, self).tearDown()
+        self.data.clear()
+        self.data.close()
+
+
+# ================================================== #
+
+
+class TestStorage(StorageTestCase):
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Data, "Development", "unknown")
+
+    # ============================================= #
+
+    def test_unknown_option(self):
+        self.assertRaises(ValueError, Data, "Development", self.engine, {"unknown": 1})
+        self.assertRaises(ValueError, Data, "Development", self.engine, {"_reset": 1})
+
+    # ============================================= #
+
+    def test_add_duplicate(self):
+        self.assertTrue(self.data.add("Reputer", "Test", "1", "clarity", 10))
+        self.assertFalse(self.data.add("Reputer", "Test", "1", "clarity", 10))
+
+    # ============================================= #
+
+    def test_add_invalid_value(self):
+        self.assertRaises(TypeError, self.data.add, "Reputer", "Test", "1", "clarity", "7")
+        self.assertRaises(TypeError, self.data.add_many, [("Reputer", "Test", "2", "clarity", 7),
+                                                          ("Reputer", "Test", "3", "clarity", None)])
+        self.assertFalse(self.data.has_reputee("Test"))
+
+        # The store can still be opened and the reputes stored with valid values
+        self.data.close()
+        self.data.open()
+        self.assertTrue(self.data.add("Reputer", "Test", "1", "clarity", 7))
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (1, 7))
+
+    # ============================================= #
+
+    def test_iter_reputes_chunks(self):
+        self.data.add_many([("Reputer", "Test" + str(rid % 3), str(rid), "reach", rid) for rid in range(25)])
+        chunk_size = storage.ITER_CHUNK_SIZE
+        storage.ITER_CHUNK_SIZE = 10
+        try:
+            reputes = self.data.iter_reputes()
+            exported = [next(reputes) for _ in range(5)]
+
+            # The read lock is not held between chunks, so another process can write
+            if engine_class(self.engine).multiprocess:
+                other = Data("Development", self.engine)
+                other.open()
+                writer = threading.Thread(target=other.add, args=("Reputer", "Test0", "25", "reach", 1))
+                writer.start()
+                writer.join(5)
+                self.assertFalse(writer.is_alive())
+                other.close()
+            exported.extend(reputes)
+        finally:
+            storage.ITER_CHUNK_SIZE = chunk_size
+
+        rids = [repute["repute"]["rid"] for repute in exported]
+        self.assertEqual(len(rids), len(set(rids)))
+        self.assertLessEqual(set(str(rid) for rid in range(25)), set(rids))
+
+    # ============================================= #
+
+    def test_value_range(self):
+        for value in (2 ** 63, -2 ** 63 - 1):
+            self.assertRaises(ValueError, self.data.add, "Reputer", "Test", "1", "reach", value)
+        self.assertFalse(self.data.has_reputee("Test"))
+
+        # Integers and floats are read back as they were stored
+        for rid, value in enumerate((2 ** 63 - 1, -2 ** 63, 5.0, 5)):
+            self.assertTrue(self.data.add("Reputer", "Test", str(rid), "reach", value))
+        values = [repute["repute"]["value"] for repute in self.data.get_reputes("Test")]
+        self.assertEqual(values, [2 ** 63 - 1, -2 ** 63, 5.0, 5])
+        self.assertEqual([type(value) for value in values], [int, int, float, int])
+        self.assertIs(type(self.data.get_aggregate("Test", "reach")[1]), float)
+
+    # ============================================= #
+
+    def test_reputee_index(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.add("Reputer", "Test", "2", "reach", 4)
+        self.data.add("Reputer", "Other", "3", "reach", 6)
+
+        self.assertTrue(self.data.has_reputee("Test"))
+        self.assertFalse(self.data.has_reputee("Missing"))
+        self.assertEqual(self.data.get_keys("Test"), ["1-Reputer-Test", "2-Reputer-Test"])
+        self.assertEqual([record['repute']['value'] for record in self.data.get_reputes("Other")], [6])
+
+    # ============================================= #
+
+    def test_rebuild_index(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.rebuild_index()
+
+        self.assertEqual(self.data.get_keys("Test"), ["1-Reputer-Test"])
+
+    # ============================================= #
+
+    def test_reputer_breakdown(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.add("Reputer", "Test", "2", "reach", 4)
+        self.data.add("Reputer", "Test", "2", "reach", 4)
+        self.data.add("Reputer", "Other", "3", "reach", 6)
+        self.data.add("Someone", "Test", "4", "reach", 6)
+        expected = {"Test": {"clarity": 1, "reach": 1}, "Other": {"reach": 1}}
+        self.assertEqual(self.data.get_reputer_breakdown("Reputer"), expected)
+        self.assertEqual(self.data.get_reputer_breakdown("Missing"), {})
+
+        # The index survives being rebuilt and reopened
+        self.data.rebuild_index()
+        self.assertEqual(self.data.get_reputer_breakdown("Reputer"), expected)
+        self.data.close()
+        self.data.open()
+        self.assertEqual(self.data.get_reputer_breakdown("Reputer"), expected)
+        self.assertEqual(self.data.get_reputer_breakdown("Someone"), {"Test": {"reach": 1}})
+
+    # ============================================= #
+
+    def test_shared_handles(self):
+        other = Data("Development", self.engine)
+        other.open()
+        self.assertFalse(other.has_reputee("Test"))
+
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.assertTrue(other.has_reputee("Test"))
+        self.assertFalse(other.add("Reputer", "Test", "1", "clarity", 10))
+        self.assertTrue(other.add("Reputer", "Test", "2", "clarity", 6))
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (2, 16))
+        other.close()
+    # ============================================= #
+
+    def test_concurrent_processes(self):
+        processes = [multiprocessing.Process(target=add_reputes, args=(self.engine, "Reputer" + str(i), 20))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        self.assertEqual(len(self.data.get_keys("Test")), 80)
+        self.assertEqual(self.data.get_aggregate("Test", "reach"), (80, 80))
+    # ============================================= #
+
+    def test_aggregates(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.add("Reputer", "Test", "2", "clarity", 7)
+        self.data.add("Reputer", "Test", "2", "clarity", 7)
+
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (2, 17))
+        self.assertEqual(self.data.get_aggregate("Test", "reach"), (0, 0))
+        self.assertEqual(self.data.compute_aggregates(), {"Test": {"clarity": (2, 17)}})
+
+    # ============================================= #
+
+    def test_async_data(self):
+        async def add_and_read(data):
+            created = await asyncio.gather(*[data.add("Reputer", "Test", str(rid % 10), "reach", 5)
+                                             for rid in range(20)])
+            return created, await data.get_aggregate("Test", "reach"), await data.has_reputee("Test")
+
+        with ThreadPoolExecutor(4) as executor:
+            loop = asyncio.new_event_loop()
+            try:
+                created, aggregate, found = loop.run_until_complete(add_and_read(AsyncData(self.data, executor)))
+            finally:
+                loop.close()
+
+        self.assertEqual(created.count(True), 10)
+        self.assertEqual(aggregate, (10, 50))
+        self.assertTrue(found)
+
+    # ============================================= #
+
+    def test_verify_aggregates(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.engine.replace_aggregates({"Test": {"clarity": (3, 10)}})
+        self.data.close()
+
+        arguments = ["--mode", "Development", "--engine", self.engine, "verify"]
+        self.assertEqual(manage.main(arguments), 1)
+        self.assertEqual(manage.main(arguments + ["--repair"]), 0)
+        self.assertEqual(manage.main(arguments), 0)
+
+        self.data.open()
+
+
+    # ============================================= #
+
+    def test_import_export(self):
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, "import.jsonl")
+        destination = os.path.join(directory, "export.jsonl")
+        with open(source, "w") as file:
+            for rid in range(6000):
+                file.write('{"reputer": "Reputer", "reputee": "Test%d", "repute": {"rid": %d, "feature": "reach", '
+                           '"value": 5}}\n' % (rid % 10, rid))
+            file.write('{"reputer": "Reputer", "reputee": "Test0", "repute": {"rid": 0, "feature": "reach", '
+                       '"value": 5}}\n')
+            file.write('{"reputer": "Reputer"\n')
+        self.data.close()
+
+        arguments = ["--mode", "Development", "--engine", self.engine]
+        self.assertEqual(manage.main(arguments + ["import", source, "--workers", "2"]), 1)
+        self.assertEqual(manage.main(arguments + ["export", destination]), 0)
+
+        self.data.open()
+        self.assertEqual(self.data.get_aggregate("Test3", "reach"), (600, 3000))
+        self.assertEqual(self.data.get_keys("Test3")[0], "3-Reputer-Test3")
+        with open(destination) as file:
+            self.assertEqual(sum(1 for line in file), 6000)
+
+    # ============================================= #
+
+    def test_rebuild(self):
+        for rid in range(30):
+            self.data.add("Reputer", "Test" + str(rid % 2), str(rid), "clarity" if rid % 3 else "reach", rid % 10)
+        aggregates = self.data.compute_aggregates()
+        version = self.data.get_version("Test0")
+        self.data.engine.replace_aggregates({"Test0": {"clarity": (3, 10)}})
+        self.data.close()
+
+        arguments = ["--mode", "Development", "--engine", self.engine, "rebuild", "--workers", "2"]
+        self.assertEqual(manage.main(arguments), 0)
+
+        self.data.open()
+        self.assertEqual(dict(self.data.iter_aggregates()), aggregates)
+        self.assertGreater(self.data.get_version("Test0"), version)
+        self.assertEqual(len(self.data.get_keys("Test1")), 15)
+        self.assertEqual(self.data.get_reputer_breakdown("Reputer")["Test0"], {"clarity": 10, "reach": 5})
+        self.assertFalse(self.data.add("Reputer", "Test0", "0", "reach", 0))
+
+        # A new leaderboard starts from the saved scores instead of scoring every reputee
+        REGISTRY.clear()
+        results, _ = Leaderboard().page(self.data, "clout", 10)
+        self.assertEqual(REGISTRY.get("reputation_processor_reputees_scored_total"), 0)
+        scores = score_aggregates(self.data.iter_aggregates())
+        self.assertEqual(results, sorted(scores.items(), key=lambda item: (-item[1][0][0], item[0])))
+        self.assertEqual(len(results), 2)
+
+
+# ================================================== #
+
+
+class TestSQLiteStorage(TestStorage):
+    engine = "sqlite"
+
+    def test_null_value(self):
+        self.assertRaises(sqlite3.IntegrityError, self.data.engine.put_if_absent, "1-Reputer-Test",
+                          Repute("Reputer", "Test", "1", "clarity", None))
+        self.assertFalse(self.data.has_reputee("Test"))
+        self.assertTrue(self.data.add("Reputer", "Test", "1", "clarity", 7))
+
+    # ============================================= #
+
+    def test_rebuild_concurrent_add(self):
+        for rid in range(10):
+            self.data.add("Reputer", "Test", str(rid), "reach", 1)
+        engine = self.data.engine
+        compute = engine._compute_aggregates
+        other = Data("Development", self.engine)
+        other.open()
+
+        # Add a repute between calculating the aggregates and writing them
+        def compute_then_add(*args):
+            aggregates = compute(*args)
+            if not other.has_reputee("Added"):
+                other.add("Reputer", "Added", "10", "reach", 5)
+            return aggregates
+
+        engine._compute_aggregates = compute_then_add
+        try:
+            aggregates = engine.rebuild()
+        finally:
+            del engine._compute_aggregates
+            other.close()
+        self.assertEqual(aggregates["Added"], {"reach": (1, 5)})
+        self.assertEqual(self.data.get_aggregate("Test", "reach"), (10, 10))
+        self.assertEqual(self.data.get_aggregate("Added", "reach"), (1, 5))
+
+
+# ================================================== #
+
+
+class TestSharding(StorageTestCase):
+    data_file = "data.db"
+
+    def tearDown(self):
+        super(TestSharding, self).tearDown()
+        # Put the database back in a single shard for the other tests
+        if read_shards(self.data.prefix, self.engine) != 1:
+            manage.main(["--mode", "Development", "--engine", self.engine, "reshard", "1"])
+
+    # ============================================= #
+
+    def reshard(self, shards):
+        self.data.close()
+        arguments = ["--mode", "Development", "--engine", self.engine, "reshard", str(shards), "--workers", "2"]
+        self.assertEqual(manage.main(arguments), 0)
+        self.data = Data("Development", self.engine)
+        self.data.open()
+
+    # ============================================= #
+
+    def test_reshard(self):
+        reputes = [("Reputer" + str(i % 3), "Reputee" + str(i % 20), str(i), "reach" if i % 2 else "clarity", i % 10)
+                   for i in range(200)]
+        self.assertEqual(self.data.add_many(reputes), [True] * 200)
+        aggregates = self.data.compute_aggregates()
+        data_file = self.data.engine.path(self.data_file)
+        self.data.clear()
+        self.data.add_many(reputes)
+        versions = dict((reputee, self.data.get_version(reputee)) for reputee in aggregates)
+
+        # Split the reputees across four shards and delete the old files
+        self.reshard(4)
+        self.assertEqual(len(self.data.engines), 4)
+        self.assertEqual(dict((reputee, self.data.get_version(reputee)) for reputee in aggregates), versions)
+        self.assertEqual(glob.glob(data_file + '*'), [])
+        self.assertEqual(dict(self.data.iter_aggregates()), aggregates)
+        self.assertEqual(self.data.compute_aggregates(), aggregates)
+        self.assertEqual(len(list(self.data.iter_reputes())), 200)
+
+        # Each reputee is held by a single shard
+        for reputee in aggregates:
+            holders = [engine.has_reputee(reputee) for engine in self.data.engines]
+            self.assertEqual(holders.count(True), 1)
+            self.assertTrue(holders[self.data.shard(reputee)])
+            self.assertEqual(len(self.data.get_keys(reputee)), 10)
+
+        # Duplicates are still found, and batches keep their order across shards
+        self.assertEqual(self.data.add_many([reputes[0], ("Reputer", "Reputee0", "new", "reach", 1), reputes[1]]),
+                         [False, True, False])
+        self.assertEqual(self.data.get_aggregates(["Reputee0", "Reputee1", "Missing"]),
+                         {"Reputee0": {"clarity": (10, 0), "reach": (1, 1)}, "Reputee1": aggregates["Reputee1"]})
+
+        # Merge them back into one, keeping the versions counting up
+        self.reshard(1)
+        self.assertEqual(len(self.data.engines), 1)
+        self.assertEqual(self.data.get_version("Reputee0"), versions["Reputee0"] + 1)
+        self.assertEqual(len(list(self.data.iter_reputes())), 201)
+        self.assertEqual(self.data.get_aggregate("Reputee0", "reach"), (1, 1))
+
+    # ============================================= #
+
+    def test_rebuild_resume(self):
+        self.data.add_many([("Reputer", "Reputee" + str(i % 20), str(i), "reach", 1) for i in range(100)])
+        self.reshard(2)
+        aggregates = self.data.compute_aggregates()
+        for engine in self.data.engines:
+            with engine.writing():
+                engine.replace_aggregates({"Drifted": {"reach": (1, 1)}})
+        self.data.close()
+
+        # Record every partition but the last one of the second shard as
+        # finished by an interrupted rebuild, which resumes with its partitions
+        partitions = 2 if engine_class(self.engine).multiprocess else 1
+        done = [[index, partition] for index in range(2) for partition in range(partitions)][:-1]
+        progress = os.path.join(DIRECTORY, self.data.prefix + "rebuild." + self.engine)
+        with open(progress, "w") as file:
+            file.write(json.dumps({"shards": 2, "partitions": partitions, "done": done}))
+        for index, partition in done:
+            path = manage._partition_scores_path(self.data.prefix, self.engine, index, 2, partition, partitions)
+            save_scores(path, {})
+        arguments = ["--mode", "Development", "--engine", self.engine, "rebuild", "--workers", "2"]
+        self.assertEqual(manage.main(arguments), 0)
+        self.assertFalse(os.path.exists(progress))
+        self.assertEqual(glob.glob(os.path.join(DIRECTORY, self.data.prefix + "*scores." + self.engine + ".part*")),
+                         [])
+
+        self.data.open()
+        expected = {reputee: aggregate for reputee, aggregate in aggregates.items()
+                    if self.data.shard(reputee) == 1 and partition_index(reputee, partitions) == partitions - 1}
+        self.assertTrue(expected)
+        expected["Drifted"] = {"reach": (1, 1)}
+        self.assertEqual(dict(self.data.iter_aggregates()), expected)
+        self.data.close()
+
+        # Starting over rebuilds every partition
+        self.assertEqual(manage.main(arguments + ["--restart", "--partitions", "3"]), 0)
+        self.data.open()
+        self.assertEqual(dict(self.data.iter_aggregates()), aggregates)
+
+    # ============================================= #
+
+    def test_unchanged(self):
+        self.assertEqual(manage.main(["--mode", "Development", "--engine", self.engine, "reshard", "1"]), 0)
+        self.assertEqual(manage.main(["--mode", "Development", "--engine", self.engine, "reshard", "0"]), 1)
+        self.assertEqual(read_shards(self.data.prefix, self.engine), 1)
+
+# ================================================== #
+
+
+class TestSQLiteSharding(TestSharding):
+    engine = "sqlite"
+    data_file = "data.sqlite"
+
+# ================================================== #
+
+
+class TestLogSharding(TestSharding):
+    engine = "log"
+    data_file = "log"
+
+# ================================================== #
+
+
+class TestDedupeFilter(StorageTestCase):
+    def test_fast_path(self):
+        REGISTRY.clear()
+        self.assertTrue(self.data.add("Reputer", "Test", "1", "clarity", 10))
+        self.assertFalse(self.data.add("Reputer", "Test", "1", "clarity", 10))
+        self.assertEqual(REGISTRY.get("reputation_storage_dedupe_filter_total", (("result", "new"),)), 1)
+        self.assertEqual(REGISTRY.get("reputation_storage_dedupe_filter_total", (("result", "maybe"),)), 1)
+
+    # ============================================= #
+
+    def test_persisted(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.close()
+        self.data.open()
+        self.assertIn("1-Reputer-Test", self.data.engine.bloom)
+        self.assertFalse(self.data.add("Reputer", "Test", "1", "clarity", 10))
+
+        self.data.clear()
+        self.assertNotIn("1-Reputer-Test", self.data.engine.bloom)
+
+    # ============================================= #
+
+    def test_rebuilt_when_missing(self):
+        for rid in range(50):
+            self.data.add("Reputer", "Test", str(rid), "clarity", 1)
+        self.data.close()
+        os.remove(self.data.engine.path('dedupe.bloom'))
+
+        self.data.open()
+        self.assertEqual(self.data.add_many([("Reputer", "Test", str(rid), "clarity", 1) for rid in range(45, 55)]),
+                         [False] * 5 + [True] * 5)
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (55, 55))
+
+    # ============================================= #
+
+    def test_disabled(self):
+        self.data.close()
+        self.data = Data("Development", self.engine, {"bloom_capacity": 0})
+        self.data.open()
+        self.assertIsNone(self.data.engine.bloom)
+        self.assertTrue(self.data.add("Reputer", "Test", "1", "clarity", 10))
+        self.assertFalse(self.data.add("Reputer", "Test", "1", "clarity", 10))
+
+# ================================================== #
+
+
+@unittest.skipIf(shelve_engine.gdbm is None, "dbm.gnu is not available")
+class TestGNUDatabase(StorageTestCase):
+    def setUp(self):
+        super(TestGNUDatabase, self).setUp()
+        # Recreate the files, which dbm.open then creates with gdbm
+        self.data.close()
+        self.data.engine.remove()
+        self.data.open()
+
+    # ============================================= #
+
+    def test_gnu_database(self):
+        self.assertEqual(dbm.whichdb(self.data.engine.path('data.db')), 'dbm.gnu')
+
+    # ============================================= #
+
+    def test_shared_handles(self):
+        TestStorage.test_shared_handles(self)
+
+    # ============================================= #
+
+    def test_concurrent_processes(self):
+        TestStorage.test_concurrent_processes(self)
+
+# ================================================== #
+
+
+class TestRecordMigration(StorageTestCase):
+    def test_migrate(self):
+        for rid in range(5):
+            self.data.add("Reputer", "Test", str(rid), "clarity", rid)
+        self.data.close()
+
+        # Store the reputes the way earlier versions did, as pickled dictionaries
+        database = dbm.open(self.data.engine.path('data.db'), 'w')
+        for key in database.keys():
+            database[key] = pickle.dumps(record.decode(key, database[key]).to_dict(), 3)
+        database.close()
+
+        # Pickled reputes can still be read before they are migrated
+        self.data.open()
+        expected = [{"reputer": "Reputer", "reputee": "Test", "repute": {"rid": str(rid), "feature": "clarity",
+                                                                           "value": rid}} for rid in range(5)]
+        self.assertEqual(self.data.get_reputes("Test"), expected)
+        self.data.close()
+
+        arguments = ["--mode", "Development", "--engine", self.engine, "migrate"]
+        self.assertEqual(manage.main(arguments), 0)
+        database = dbm.open(self.data.engine.path('data.db'), 'r')
+        self.assertFalse(any(record.is_legacy(database[key]) for key in database.keys()))
+        database.close()
+
+        self.data.open()
+        self.assertEqual(self.data.get_reputes("Test"), expected)
+        self.assertEqual(self.data.migrate(), 0)
+        self.assertFalse(self.data.add("Reputer", "Test", "1", "clarity", 1))
+
+# ================================================== #
+
+
+class TestShelveRebuild(StorageTestCase):
+    def test_rebuild_reputer_lists(self):
+        for rid in range(6):
+            self.data.add("Reputer", "Test" + str(rid), str(rid), "reach", rid)
+        self.data.add("Other", "Test0", "6", "clarity", 6)
+
+        # Lose the reputer index and leave a breakdown with no records behind it
+        engine = self.data.engine
+        for entry in list(engine.reputers.keys()):
+            del engine.reputers[entry]
+        engine._count_reputer(b"Ghost", b"Test1", "reach")
+        engine._count_reputer(b"Reputer", b"Test2", "reach")
+
+        for partition in range(3):
+            engine.rebuild(partition, 3)
+        expected = dict(("Test" + str(rid), {"reach": 1}) for rid in range(6))
+        self.assertEqual(self.data.get_reputer_breakdown("Reputer"), expected)
+        self.assertEqual(self.data.get_reputer_breakdown("Other"), {"Test0": {"clarity": 1}})
+        self.assertEqual(self.data.get_reputer_breakdown("Ghost"), {})
+        self.assertEqual(sorted(engine._items(engine.reputers, b"Reputer")),
+                         [("Test" + str(rid)).encode('utf-8') for rid in range(6)])
+
+# ================================================== #
+
+
+class TestRecordFormat(unittest.TestCase):
+    def test_round_trip(self):
+        for repute in (Repute("Reputer", "Test", "1", "reach", 5),
+                       Repute("Reputer", "Test", "1", "clarity", 2.5),
+                       Repute("Rep-uter", "Tést-2", "a-b", "clarity", -7),
+                       Repute("Reputer", "Test", "1", "fame", 2 ** 70),
+                       Repute("Reputer", "Test", "1", "reach", True),
+                       Repute("", "", "", "", None)):
+            self.assertEqual(record.decode(repute.key, record.encode(repute, repute.key)), repute)
+            self.assertEqual(record.decode(repute.key.encode('utf-8'), record.encode(repute, repute.key)), repute)
+            # Reputes stored under another key keep their own strings
+            self.assertEqual(record.decode("other", record.encode(repute, "other")), repute)
+
+    # ============================================= #
+
+    def test_compact(self):
+        repute = Repute("Reputer", "Test", "44cd865e-d987-11e7-9296-cec278b6b50a", "clarity", 10)
+        self.assertEqual(len(record.encode(repute, repute.key)), 13)
+        self.assertLess(len(record.encode(repute, repute.key)), len(pickle.dumps(repute.to_dict())) / 5)
+        self.assertFalse(record.is_legacy(record.encode(repute, repute.key)))
+
+    # ============================================= #
+
+    def test_legacy(self):
+        repute = Repute("Reputer", "Test", "1", "reach", 5)
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(repute.to_dict(), protocol)
+            self.assertTrue(record.is_legacy(data))
+            self.assertEqual(record.decode(repute.key, data), repute)
+
+# ================================================== #
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        super(TestBloomFilter, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.bloom")
+
+    # ============================================= #
+
+    def tearDown(self):
+        super(TestBloomFilter, self).tearDown()
+        self.directory.cleanup()
+
+    # ============================================= #
+
+    def test_error_rate(self):
+        bloom = BloomFilter(self.path, 2000, 0.01)
+        self.assertTrue(bloom.open())
+        self.assertGreater(sum(bloom.add("key" + str(i)) for i in range(2000)), 1950)
+        self.assertTrue(all("key" + str(i) in bloom for i in range(2000)))
+        false_positives = sum("other" + str(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        bloom.close()
+
+    # ============================================= #
+
+    def test_keeps_existing_size(self):
+        bloom = BloomFilter(self.path, 100, 0.01)
+        bloom.open()
+        bloom.add("key")
+        bloom.close()
+
+        resized = BloomFilter(self.path, 10000, 0.001)
+        self.assertFalse(resized.open())
+        self.assertEqual((resized.bits, resized.hashes), (bloom.bits, bloom.hashes))
+        self.assertIn("key", resized)
+        resized.close()
+
+    # ============================================= #
+
+    def test_damaged(self):
+        with open(self.path, 'wb') as destination:
+            destination.write(b'not a filter')
+        bloom = BloomFilter(self.path, 100, 0.01)
+        self.assertTrue(bloom.open())
+        self.assertNotIn("key", bloom)
+        bloom.close()
+
+
+# ================================================== #
+
+
+class TestLogStorage(TestStorage):
+    engine = "log"
+
+    # ============================================= #
+
+    @unittest.skip("A log can only be opened by one process at a time.")
+    def test_shared_handles(self):
+        pass
+
+    # ============================================= #
+
+    @unittest.skip("A log can only be opened by one process at a time.")
+    def test_concurrent_processes(self):
+        pass
+
+    # ============================================= #
+
+    def test_second_process_rejected(self):
+        self.assertRaises(RuntimeError, Data("Development", self.engine).open)
+
+    # ============================================= #
+
+    def test_truncated_tail(self):
+        self.data.add("Reputer", "Test", "1", "clarity", 10)
+        self.data.add("Reputer", "Test", "2", "clarity", 6)
+        segment = self.data.engine._segment_path(self.data.engine.segments[-1])
+        self.data.close()
+
+        # Cut the last record short and throw away the checkpoint
+        os.truncate(segment, os.path.getsize(segment) - 3)
+        os.remove(self.data.engine._checkpoint_path())
+
+        self.data.open()
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (1, 10))
+        self.assertTrue(self.data.add("Reputer", "Test", "2", "clarity", 6))
+        self.assertEqual(self.data.get_aggregate("Test", "clarity"), (2, 16))
+
+    # ============================================= #
+
+    def test_compaction(self):
+        self.data.engine.segment_size = 200
+        self.data.engine.compaction_segments = 2
+        for rid in range(20):
+            self.data.add("Reputer", "Test" + str(rid % 2), str(rid), "reach", rid)
+        self.assertGreater(len(self.data.engine.segments), 2)
+
+        self.assertTrue(self.data.engine.compact())
+        self.assertEqual(len(self.data.engine.segments), 2)
+        self.assertEqual([record['repute']['value'] for record in self.data.get_reputes("Test1")],
+                         list(range(1, 20, 2)))
+
+        # Reopen from the checkpoint and from a full replay
+        for checkpoint in (True, False):
+            self.data.close()
+            if not checkpoint:
+                os.remove(self.data.engine._checkpoint_path())
+            self.data.open()
+            self.assertEqual(self.data.get_aggregate("Test0", "reach"), (10, 90))
+            self.assertEqual(self.data.get_keys("Test0")[:2], ["0-Reputer-Test0", "2-Reputer-Test0"])
+            self.assertEqual(len(list(self.data.iter_reputes())), 20)
+
+    # ============================================= #
+
+    def test_interrupted_compaction(self):
+        engine = self.data.engine
+        engine.segment_size = 200
+        engine.compaction_segments = 2
+        for rid in range(20):
+            self.data.add("Reputer", "Test" + str(rid % 2), str(rid), "reach", rid)
+        sealed = engine.segments[1:-1]
+        copies = {}
+        for segment in sealed:
+            with open(engine._segment_path(segment), 'rb') as file:
+                copies[segment] = file.read()
+        self.assertTrue(engine.compact())
+
+        # Put back the segments a compaction removes last, as if it was interrupted
+        self.data.close()
+        os.remove(engine._checkpoint_path())
+        for segment, data in copies.items():
+            with open(engine._segment_path(segment), 'wb') as file:
+                file.write(data)
+        self.data.open()
+        self.assertGreater(len(self.data.engine.segments), 2)
+        self.assertEqual(sorted(repute["repute"]["value"] for repute in self.data.iter_reputes()), list(range(20)))
+        self.assertEqual(self.data.get_aggregate("Test0", "reach"), (10, 90))
+
+    # ============================================= #
+
+    def test_compaction_merges_once(self):
+        engine = self.data.engine
+        engine.segment_size = 200
+        engine.compaction_segments = 2
+        for rid in range(20):
+            self.data.add("Reputer", "Test" + str(rid % 2), str(rid), "reach", rid)
+        self.assertTrue(engine.compact())
+        self.assertFalse(engine.compact())
+        merged = engine._segment_path(engine.segments[0])
+        size = os.path.getsize(merged)
+
+        # Rebuilds log a version entry for every reputee, and only the last ones are kept
+        for _ in range(3):
+            with self.data.writing() as writing:
+                writing.rebuild()
+        versions = (self.data.get_version("Test0"), self.data.get_version("Test1"))
+        for rid in range(20, 40):
+            self.data.add("Reputer", "Test" + str(rid % 2), str(rid), "reach", rid)
+
+        # Only the segments written since the last compaction are merged
+        self.assertTrue(engine.compact())
+        self.assertEqual(len(engine.segments), 3)
+        self.assertEqual(os.path.getsize(merged), size)
+        reputees = [json.loads(payload[1:].decode('utf-8'))[0] for _, payload in engine._scan(engine.segments[1], 0)
+                    if payload[:1] == b'V']
+        self.assertIn("Test0", reputees)
+        self.assertEqual(len(reputees), len(set(reputees)))
+
+        self.data.close()
+        os.remove(engine._checkpoint_path())
+        self.data.open()
+        self.assertEqual(self.data.get_version("Test0"), versions[0] + 10)
+        self.assertEqual(self.data.get_version("Test1"), versions[1] + 10)
+        self.assertEqual(len(list(self.data.iter_reputes())), 40)
+
+    # ============================================= #
+
+    def test_invalid_value_not_logged(self):
+        self.assertRaises(TypeError, self.data.engine.put_if_absent, "1-Reputer-Test",
+                          Repute("Reputer", "Test", "1", "clarity", "7"))
+        self.data.close()
+        os.remove(self.data.engine._checkpoint_path())
+        self.data.open()
+        self.assertFalse(self.data.has_reputee("Test"))
+
+
+# ================================================== #
+
+
+if __name__  == '__main__':
+    unittest.main()
+
+
+# ================================================== #
+#                        EOF                         #
+# ================================================== #